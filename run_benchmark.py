@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+import argparse
+import sys
+
+import pigpio
+from sync_tools import benchmark
+
+parser = argparse.ArgumentParser(description="Benchmark wave compilation, switchover and PPS lock convergence")
+parser.add_argument('-o', '--output', default='benchmark_results.json', help="JSON file to save the results to")
+parser.add_argument('-c', '--compare', help="Baseline JSON results to check for regressions")
+parser.add_argument('-t', '--tolerance', type=float, default=0.2, help="Allowed fractional slowdown before reporting a regression")
+parser.add_argument('--pigpiod', action='store_true', help="Run the update benchmarks against the local pigpiod instead of the simulator")
+parser.add_argument('--quick', action='store_true', help="Run a reduced matrix")
+args = parser.parse_args()
+
+pi = None
+if args.pigpiod:
+    pi = pigpio.pi()
+    if not pi.connected:
+        exit(0)
+
+if args.quick:
+    report = benchmark.run_all(trigger_counts=[1, 6], frequencies=[10, 1000], duties=[0.5], phases=[0], pi=pi)
+else:
+    report = benchmark.run_all(pi=pi)
+
+if pi is not None:
+    pi.stop()
+
+print (benchmark.format_report(report))
+benchmark.save(report, args.output)
+print ("Results saved to %s"%args.output)
+
+if args.compare:
+    regressions = benchmark.compare(benchmark.load(args.compare), report, args.tolerance)
+    for key, metric, old_value, new_value in regressions:
+        print ("REGRESSION %s %s: %s -> %s"%(key, metric, old_value, new_value))
+    if regressions:
+        sys.exit(1)
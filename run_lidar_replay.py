@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+import argparse
+import time
+
+from sync_tools import lidar_phase
+
+from signal_processor import SignalProcessor
+
+parser = argparse.ArgumentParser(description="Send Velodyne packets from a capture, or synthetic ones, to test locking camera phases to a LiDAR without one")
+parser.add_argument('--pcap', help="pcap capture of the LiDAR to replay, instead of synthetic packets")
+parser.add_argument('--rpm', type=float, default=600.0, help="Rotation of the synthetic LiDAR")
+parser.add_argument('--azimuth', type=float, default=0.0, help="Azimuth of the synthetic LiDAR at the top of the hour, in degrees")
+parser.add_argument('--packet-rate', type=float, default=754.0, help="Data packets per second of the synthetic LiDAR")
+parser.add_argument('--seconds', type=float, default=60.0, help="Length of the synthetic packet stream, sent again once sent")
+parser.add_argument('--host', default='127.0.0.1', help="Host receiving the packets")
+parser.add_argument('--port', type=int, default=lidar_phase.DATA_PORT, help="UDP port of the data packets")
+parser.add_argument('--position-port', type=int, default=lidar_phase.POSITION_PORT, help="UDP port of the position packets, -1 for none")
+parser.add_argument('--pps-status', type=int, default=lidar_phase.PPS_LOCKED, help="PPS status reported by the position packets")
+parser.add_argument('--speed', type=float, default=1.0, help="Replay speed of a capture")
+args = parser.parse_args()
+
+if args.pcap:
+    packets = lidar_phase.read_pcap(args.pcap, args.port)
+    print ("Replaying %d data packets from %s"%(len(packets), args.pcap))
+else:
+    # Timestamps from the system clock, so the packets match the output PPS of a synchronized Pi
+    start = int((time.time() % 3600) * 1e6)
+    packets = lidar_phase.synthetic_packets(int(args.seconds * args.packet_rate), args.rpm, args.azimuth, start, args.packet_rate)
+    print ("Sending a LiDAR spinning at %.1f RPM, at azimuth %.2f degrees at the top of the hour"%(args.rpm, args.azimuth))
+
+sp = SignalProcessor()
+replayer = lidar_phase.packet_replayer(packets, args.host, args.port, args.position_port if args.position_port != -1 else None,
+                                       args.speed, loop=not args.pcap, pps_status=args.pps_status)
+replayer.start()
+while not sp.exit_now and replayer.running:
+    sp.wait(1.0)
+replayer.stop()
+print ("Sent %d data packets"%replayer.sent)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+import argparse
+import json
+
+from sync_tools import replay
+
+parser = argparse.ArgumentParser(description="Replay recorded input PPS edges through the PPS lock loop to tune its settings")
+parser.add_argument('ticks', help="File of input PPS rising edge ticks, one per line (or a .npy array)")
+parser.add_argument('--record', type=int, metavar='GPIO', help="Record the input PPS rising edges of a GPIO to the file until interrupted, instead of replaying")
+parser.add_argument('--slack-threshold', type=float, nargs='+', default=[replay.SLACK_THRESHOLD], help="PPS_slack_threshold values to try, in microseconds")
+parser.add_argument('--overtime-reject', type=float, nargs='+', default=[replay.OVERTIME_REJECT], help="PPS_overtime_reject values to try, in microseconds")
+parser.add_argument('--lock-threshold', type=float, default=replay.LOCK_THRESHOLD, help="Slack within which the output counts as locked, in microseconds")
+parser.add_argument('--latency', type=int, default=replay.UPDATE_LATENCY, help="Time from an output PPS edge to the corrected wave being sent, in microseconds")
+parser.add_argument('--max-lock-time', type=float, help="Leave out settings locking later than this many seconds")
+parser.add_argument('--processes', type=int, help="Processes to replay with, all cores by default")
+parser.add_argument('--engine', action='store_true', help="Replay through the waveform engine on the simulated backend instead (slower, but covers the servo and holdover)")
+parser.add_argument('--servo', type=float, nargs=2, metavar=('KP', 'KI'), help="Replay through the engine with the PPS servo and these gains")
+parser.add_argument('--holdover', action='store_true', help="Replay through the engine with the holdover enabled")
+parser.add_argument('--top', type=int, default=10, help="Number of best settings to print")
+parser.add_argument('-o', '--output', help="JSON file to save the results of all settings to")
+args = parser.parse_args()
+
+if args.record is not None:
+    import pigpio
+    from signal_processor import SignalProcessor
+
+    pi = pigpio.pi()
+    if not pi.connected:
+        exit(0)
+    sp = SignalProcessor()
+    recorder = replay.tick_recorder(pi, args.record, args.ticks)
+    recorder.start()
+    print ("Recording input PPS rising edges on GPIO%d to %s, interrupt to stop"%(args.record, args.ticks))
+    while not sp.exit_now:
+        sp.wait()
+    recorder.stop()
+    pi.stop()
+    print ("Recorded %d edges"%recorder.count)
+    exit(0)
+
+ticks = replay.load_ticks(args.ticks)
+print ("Replaying %d input PPS edges over %.1f hours"%(len(ticks), (ticks[-1] - ticks[0]) / 3.6e9 if len(ticks) else 0.0))
+
+names = ['slack_threshold', 'overtime_reject']
+lanes = replay.grid(slack_threshold=args.slack_threshold, overtime_reject=args.overtime_reject)
+if args.engine or args.servo or args.holdover:
+    kp, ki = args.servo if args.servo else (None, None)
+    rows = []
+    for slack_threshold, overtime_reject in zip(lanes['slack_threshold'], lanes['overtime_reject']):
+        row = {'slack_threshold': float(slack_threshold), 'overtime_reject': float(overtime_reject)}
+        row.update(replay.replay_engine(ticks, slack_threshold, overtime_reject, args.lock_threshold, kp, ki, args.holdover))
+        rows.append(row)
+else:
+    rows = replay.sweep(ticks, lanes, args.processes, lock_threshold=args.lock_threshold, update_latency=args.latency)
+
+ranked = replay.best(rows, max_lock_time=args.max_lock_time)
+print (replay.format_rows(ranked[:args.top], names))
+if not ranked:
+    print ("No settings locked")
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump([dict((name, None if value != value else value) for name, value in row.items()) for row in rows], f, indent=2, sort_keys=True)
+    print ("Results saved to %s"%args.output)
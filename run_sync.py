@@ -1,49 +1,342 @@
 #!/usr/bin/python -u
+import time
+start_time = time.time()    # Before the imports, which take a while on a Pi
+
+import argparse
+import socket
+import struct
+import sys
+
 import pigpio
+from sync_tools import cluster
+from sync_tools import lidar_phase
+from sync_tools import pps_servo
+from sync_tools import resource_planner
+from sync_tools import service
 from sync_tools import sync_generator
+from sync_tools import telemetry
+from sync_tools import wave_compiler
 
 import sync_config as cfg
-from sync_tools import utils
 
 from signal_processor import SignalProcessor
 
+try:
+    from importlib import reload
+except ImportError:
+    pass    # Python 2 builtin
+
+parser = argparse.ArgumentParser(description="Generate the PPS and trigger outputs configured in sync_config.py")
+parser.add_argument('--dry-run', action='store_true', help="Check the configuration against the pigpio wave resources, print the report and exit")
+args = parser.parse_args()
+
+def check_cluster(cfg, plan):
+    """
+    Adds the problems of the cluster settings to the resource plan of the configuration.
+    """
+    if cfg.CLUSTER_ROLE not in (None, 'coordinator', 'follower'):
+        plan.problems.append("CLUSTER_ROLE must be None, 'coordinator' or 'follower'")
+    elif cfg.CLUSTER_ROLE == 'coordinator':
+        try:
+            cluster.trigger_specs(cfg.CLUSTER_TRIGGERS)
+        except ValueError as e:
+            plan.problems.append('cluster triggers: %s' % e)
+
+# Configurations that cannot be generated fail here rather than on the device.
+# The wave is compiled by the check, before connecting, and the generator starts with it compiled.
+segments = wave_compiler.segment_store()
+revision = resource_planner.local_revision()
+plan = resource_planner.config_plan(cfg, revision, segments=segments)
+check_cluster(cfg, plan)
+if args.dry_run or not plan.fits():
+    print (resource_planner.format_report(plan))
+    sys.exit(0 if plan.fits() else 1)
+
 pi = pigpio.pi()
 if not pi.connected:
     exit(0)
 
 generator = sync_generator.waveform_engine(pi)
+generator.start_time = start_time
+generator.segments = segments
+if revision:
+    generator.hardware_revision = revision
+NMEA_destinations = set()
+output_paths = {}
+cluster_nodes = {'settings': None, 'follower': None, 'coordinator': None}
+lidar = {'settings': None, 'tracker': None}
+
+def apply_config(cfg):
+    """
+    Applies the configuration to the generator, changing only what differs from the running
+    settings, so a reload keeps the output waveform running.
+    The outputs are started before synchronization, NMEA spoofing and the trigger log are set up,
+    so the sensors are triggered as soon as possible after a cold start.
+    """
+    if generator.PPS_input_gpio != cfg.PPS_INPUT_GPIO:
+        if generator.callbacks_set:
+            generator.stop_PPS_input_sychronization()
+        if cfg.PPS_INPUT_GPIO != -1:
+            generator.set_PPS_input_gpio(cfg.PPS_INPUT_GPIO)
+            print ("Input PPS signal on GPIO%d"%cfg.PPS_INPUT_GPIO)
+        else:
+            generator.PPS_input_gpio = -1
+
+    sources = [cfg.PPS_INPUT_GPIO] + list(cfg.PPS_INPUT_BACKUP_GPIOS) if cfg.PPS_INPUT_GPIO != -1 and (cfg.VALIDATE_PPS_INPUT or cfg.PPS_INPUT_BACKUP_GPIOS) else []
+    validation = (tuple(sources), cfg.PPS_INPUT_GLITCH_FILTER, cfg.PPS_INPUT_MIN_WIDTH, cfg.PPS_INPUT_MAX_WIDTH) if sources else None
+    if (generator.PPS_sources.settings() if generator.PPS_sources is not None else None) != validation:
+        if generator.callbacks_set:
+            generator.stop_PPS_input_sychronization()
+        if validation is not None:
+            generator.set_PPS_sources(*validation)
+            if len(sources) > 1:
+                print ("Backup input PPS signals on GPIO%s" % ", GPIO".join(str(gpio) for gpio in sources[1:]))
+        else:
+            generator.set_PPS_sources([])
+
+    if cfg.PPS_OUTPUT_GPIO != -1 and (generator.PPS_output_gpio != cfg.PPS_OUTPUT_GPIO or generator.PPS_duty_cycle_fraction != cfg.PPS_OUTPUT_DUTY):
+        generator.set_PPS_output_gpio(cfg.PPS_OUTPUT_GPIO)
+        generator.set_PPS_output_duty(cfg.PPS_OUTPUT_DUTY)
+        print ("Output PPS signal on GPIO%d with duty cycle of %.2f"%(cfg.PPS_OUTPUT_GPIO, cfg.PPS_OUTPUT_DUTY))
+
+    # The triggers of a cluster node are set by the plan of its coordinator
+    if cfg.CLUSTER_ROLE is None:
+        triggers = {}
+        for output_trigger_gpio, output_trigger_frequency, output_trigger_phase, output_trigger_duty in zip(cfg.TRIGGER_GPIOS, cfg.TRIGGER_FREQUENCIES, cfg.TRIGGER_PHASES, cfg.TRIGGER_DUTYS):
+            if output_trigger_gpio != -1:
+                triggers[output_trigger_gpio] = (output_trigger_gpio, wave_compiler.rational_frequency(output_trigger_frequency), output_trigger_phase, output_trigger_duty)
+        current = dict((trigger[0], trigger) for trigger in generator.triggers())
+        # The phases of the cameras locked to the LiDAR are kept
+        if lidar['tracker'] is not None:
+            for camera in lidar['tracker'].cameras:
+                if camera.gpio in triggers and camera.gpio in current:
+                    triggers[camera.gpio] = triggers[camera.gpio][:2] + (current[camera.gpio][2],) + triggers[camera.gpio][3:]
+        for gpio in current:
+            if gpio not in triggers:
+                generator.remove_trigger_gpio(gpio)
+                print ("Removed output trigger signal on GPIO%d"%gpio)
+        for output_trigger_gpio, output_trigger_frequency, output_trigger_phase, output_trigger_duty in triggers.values():
+            if current.get(output_trigger_gpio) != triggers[output_trigger_gpio]:
+                generator.add_trigger_gpio(output_trigger_gpio, output_trigger_frequency, output_trigger_phase, output_trigger_duty)
+                print ("Output trigger signal on GPIO%d with frequency %sHz, phase %d degrees and duty cycle of %.2f"%(output_trigger_gpio, wave_compiler.format_frequency(output_trigger_frequency), output_trigger_phase, output_trigger_duty))
+
+        if generator.hyperperiod_epoch != cfg.HYPERPERIOD_EPOCH:
+            generator.set_hyperperiod_epoch(cfg.HYPERPERIOD_EPOCH)
+
+    if generator.wave_chaining != cfg.USE_WAVE_CHAINS:
+        generator.set_wave_chaining(cfg.USE_WAVE_CHAINS)
+        if cfg.USE_WAVE_CHAINS:
+            print ("Compressing output waveform into a wave chain")
+
+    hardware = (cfg.USE_HARDWARE_OUTPUTS, cfg.HARDWARE_MIN_FREQUENCY, cfg.HARDWARE_PHASE_TOLERANCE, cfg.HARDWARE_PWM_RESTART_INTERVAL)
+    if (generator.hardware_offload, generator.hardware_min_frequency, generator.hardware_phase_tolerance, generator.hardware_pwm_restart_interval) != hardware:
+        generator.set_hardware_offload(*hardware)
+
+    if cfg.USE_PPS_SERVO and generator.PPS_servo is None:
+        generator.set_PPS_servo(pps_servo.pps_servo(kp=cfg.PPS_SERVO_KP, ki=cfg.PPS_SERVO_KI))
+        print ("Disciplining output PPS with a PI servo")
+    elif cfg.USE_PPS_SERVO:
+        generator.PPS_servo.set_gains(cfg.PPS_SERVO_KP, cfg.PPS_SERVO_KI)
+    elif generator.PPS_servo is not None:
+        generator.set_PPS_servo(None)
 
-if (cfg.PPS_INPUT_GPIO != -1):
-    generator.set_PPS_input_gpio(cfg.PPS_INPUT_GPIO)
-    print ("Input PPS signal on GPIO%d"%cfg.PPS_INPUT_GPIO)
+    generator.update()
 
-if (cfg.PPS_OUTPUT_GPIO != -1):
-    generator.set_PPS_output_gpio(cfg.PPS_OUTPUT_GPIO)
-    generator.set_PPS_output_duty(cfg.PPS_OUTPUT_DUTY)
-    print ("Output PPS signal on GPIO%d with duty cycle of %.2f"%(cfg.PPS_OUTPUT_GPIO, cfg.PPS_OUTPUT_DUTY))
+    if generator.holdover_enabled != cfg.USE_PPS_HOLDOVER:
+        generator.set_PPS_holdover(cfg.USE_PPS_HOLDOVER, cfg.PPS_REACQUIRE_STEP)
+    generator.PPS_reacquire_step = cfg.PPS_REACQUIRE_STEP
 
-for output_trigger_gpio, output_trigger_frequency, output_trigger_phase, output_trigger_duty in zip(cfg.TRIGGER_GPIOS, cfg.TRIGGER_FREQUENCIES, cfg.TRIGGER_PHASES, cfg.TRIGGER_DUTYS):
-    if output_trigger_gpio != -1:
-        generator.add_trigger_gpio(output_trigger_gpio, output_trigger_frequency, output_trigger_phase, output_trigger_duty)
-        print ("Output trigger signal on GPIO%d with frequency %dHz, phase %d degrees and duty cycle of %.2f"%(output_trigger_gpio, output_trigger_frequency, output_trigger_phase, output_trigger_duty))
+    if generator.edge_script_enabled != cfg.USE_EDGE_SCRIPT:
+        generator.set_edge_script(cfg.USE_EDGE_SCRIPT)
+        if cfg.USE_EDGE_SCRIPT and generator.callbacks_set:
+            print ("Timing PPS edges with a pigpiod script")
 
-if cfg.USE_SYNC and cfg.PPS_INPUT_GPIO != -1 and cfg.PPS_OUTPUT_GPIO != -1:
-    generator.start_PPS_input_sychronization()
-    print ("Synchronizing to input PPS pulse")
+    if cfg.USE_SYNC and cfg.PPS_INPUT_GPIO != -1 and cfg.PPS_OUTPUT_GPIO != -1:
+        if not generator.callbacks_set:
+            generator.start_PPS_input_sychronization()
+            print ("Synchronizing to input PPS pulse{}".format(", timing edges with a pigpiod script" if generator.edge_script is not None else ""))
+    elif generator.callbacks_set:
+        generator.stop_PPS_input_sychronization()
 
-if cfg.SEND_DUMMY_NMEA and cfg.USE_SYNC:
-    if utils.check_ip_port_open(cfg.NMEA_DESTINATION_HOST, cfg.NMEA_DESTINATION_PORT):
-        generator.start_NMEA_spoof(cfg.NMEA_DESTINATION_PORT, cfg.NMEA_DESTINATION_HOST)
-        print ("Generating (fake) NMEA messages")
-    else:
-        print ("Device with IP: {} on port: {} is not responding. Cannot spoof NMEA sentence.".format(cfg.NMEA_DESTINATION_HOST, cfg.NMEA_DESTINATION_PORT))
+    if cfg.USE_SYNC and cfg.PPS_INPUT_GPIO != -1 and (cfg.REFCLOCK_SHM_UNIT != -1 or cfg.REFCLOCK_SOCKET is not None):
+        refclock = (cfg.REFCLOCK_SHM_UNIT if cfg.REFCLOCK_SHM_UNIT != -1 else None, cfg.REFCLOCK_SOCKET, cfg.REFCLOCK_PULSE)
+        if generator.refclock is None or generator.refclock.settings() != refclock:
+            try:
+                generator.start_refclock(*refclock)
+                print ("Feeding input PPS edges to the system clock through {}".format(" and ".join(
+                    (["NTP SHM unit %d"%cfg.REFCLOCK_SHM_UNIT] if cfg.REFCLOCK_SHM_UNIT != -1 else []) + ([cfg.REFCLOCK_SOCKET] if cfg.REFCLOCK_SOCKET is not None else []))))
+            except OSError as e:
+                print ("Reference clock not started: {}".format(e))
+    elif generator.refclock is not None:
+        generator.stop_refclock()
+
+    if cfg.SEND_DUMMY_NMEA and cfg.USE_SYNC:
+        for host, port, protocol in cfg.NMEA_DESTINATIONS:
+            if (host, port, protocol) in NMEA_destinations:
+                continue
+            # Connects in the background, all destinations at once
+            generator.start_NMEA_spoof(port, host, protocol)
+            NMEA_destinations.add((host, port, protocol))
+            print ("Generating (fake) NMEA messages to {}:{} over {}".format(host, port, protocol.upper()))
+    elif NMEA_destinations:
+        generator.stop_NMEA_spoof()
+        NMEA_destinations.clear()
+
+    if cfg.TRIGGER_LOG_DIRECTORY is not None and cfg.PPS_OUTPUT_GPIO != -1:
+        if generator.trigger_log is not None and generator.trigger_log.directory != cfg.TRIGGER_LOG_DIRECTORY:
+            generator.stop_trigger_log()
+        if generator.trigger_log is None:
+            generator.start_trigger_log(cfg.TRIGGER_LOG_DIRECTORY, cfg.TRIGGER_LOG_FILE_RECORDS, cfg.TRIGGER_LOG_MAX_FILES)
+            print ("Logging trigger edge times to {}".format(cfg.TRIGGER_LOG_DIRECTORY))
+    elif generator.trigger_log is not None:
+        generator.stop_trigger_log()
+
+    node = cfg.CLUSTER_NODE if cfg.CLUSTER_NODE is not None else socket.gethostname()
+    settings = (cfg.CLUSTER_ROLE, node, cfg.CLUSTER_GROUP, cfg.CLUSTER_PORT, cfg.CLUSTER_INTERFACE)
+    if cluster_nodes['settings'] != settings:
+        for role in ('coordinator', 'follower'):
+            if cluster_nodes[role] is not None:
+                cluster_nodes[role].stop()
+                cluster_nodes[role] = None
+        cluster_nodes['settings'] = None
+        if cfg.CLUSTER_ROLE is not None:
+            try:
+                cluster_nodes['follower'] = cluster.cluster_follower(generator, node, cfg.CLUSTER_GPIOS, cfg.CLUSTER_GROUP, cfg.CLUSTER_PORT, cfg.CLUSTER_INTERFACE)
+                cluster_nodes['follower'].start()
+                if cfg.CLUSTER_ROLE == 'coordinator':
+                    cluster_nodes['coordinator'] = cluster.cluster_coordinator(node, cfg.CLUSTER_TRIGGERS, cfg.HYPERPERIOD_EPOCH, generator, cfg.CLUSTER_GROUP, cfg.CLUSTER_PORT, cfg.CLUSTER_INTERFACE)
+                    cluster_nodes['coordinator'].start()
+                cluster_nodes['settings'] = settings
+                print ("Cluster {} {} on {}:{}".format(cfg.CLUSTER_ROLE, node, cfg.CLUSTER_GROUP, cfg.CLUSTER_PORT))
+            except socket.error as e:
+                print ("Cluster not joined: {}".format(e))
+    if cluster_nodes['follower'] is not None:
+        cluster_nodes['follower'].gpios = list(cfg.CLUSTER_GPIOS)
+    if cluster_nodes['coordinator'] is not None:
+        cluster_nodes['coordinator'].epoch = cfg.HYPERPERIOD_EPOCH
+        cluster_nodes['coordinator'].set_triggers(cfg.CLUSTER_TRIGGERS)
+
+    settings = (cfg.LIDAR_PORT, cfg.LIDAR_POSITION_PORT) if cfg.LIDAR_PORT != -1 else None
+    if lidar['settings'] != settings:
+        if lidar['tracker'] is not None:
+            lidar['tracker'].stop()
+            lidar['tracker'] = None
+        lidar['settings'] = None
+        if settings is not None:
+            position_port = cfg.LIDAR_POSITION_PORT if cfg.LIDAR_POSITION_PORT != -1 else None
+            tracker = lidar_phase.lidar_phase_tracker(generator, cfg.LIDAR_CAMERAS, cfg.LIDAR_PORT, position_port, tolerance=cfg.LIDAR_PHASE_TOLERANCE, require_pps=position_port is not None)
+            try:
+                tracker.start()
+                lidar['tracker'] = tracker
+                lidar['settings'] = settings
+                print ("Locking the phases of {} camera triggers to the LiDAR packets on UDP port {}".format(len(cfg.LIDAR_CAMERAS), cfg.LIDAR_PORT))
+            except socket.error as e:
+                print ("LiDAR packets not received: {}".format(e))
+    if lidar['tracker'] is not None:
+        lidar['tracker'].set_cameras(cfg.LIDAR_CAMERAS)
+        lidar['tracker'].tolerance = cfg.LIDAR_PHASE_TOLERANCE
+
+    # Applies what the steps above changed, such as a wave chain rebuilt for the trigger log
+    generator.update()
+
+    paths = generator.output_paths()
+    for gpio, path in paths.items():
+        if output_paths.get(gpio) != path:
+            print ("Output on GPIO%d generated by %s"%(gpio, path))
+    output_paths.clear()
+    output_paths.update(paths)
+
+def reload_config():
+    """
+    Rereads sync_config.py on SIGHUP and applies the changes.
+    """
+    global cfg
+    try:
+        cfg = reload(cfg)
+    except Exception as e:
+        print ("Configuration not reloaded: {}".format(e))
+        return
+    plan = resource_planner.config_plan(cfg, suggest=False)
+    check_cluster(cfg, plan)
+    if not plan.fits():
+        print (resource_planner.format_report(plan))
+        print ("Configuration not reloaded, run_sync.py --dry-run suggests placements that fit")
+        return
+    print ("Reloading configuration")
+
+    def reloaded(error):
+        if error is not None:
+            print ("Configuration reload failed: {}".format(error))
+        if metrics is not None:
+            metrics.coordinator = cluster_nodes['coordinator']
+            metrics.lidar = lidar['tracker']
+
+    # Applied from the thread updating the wave, at the next output PPS edge or housekeeping,
+    # as the runtime control changes are
+    generator.schedule_change(lambda config=cfg: apply_config(config), reloaded)
 
-generator.update()
 sp = SignalProcessor()
+apply_config(cfg)
+first_edge, lock = generator.startup_times()
+status = None
+if first_edge is not None:
+    status = "First output edge %.0f ms after start" % (first_edge * 1000)
+    print (status)
+
+metrics = None
+if cfg.METRICS_PORT != -1:
+    try:
+        metrics = telemetry.metrics_server(generator, cfg.METRICS_PORT, coordinator=cluster_nodes['coordinator'], lidar=lidar['tracker'])
+        metrics.start()
+        print ("Serving synchronization metrics on http://127.0.0.1:%d/metrics"%cfg.METRICS_PORT)
+    except OSError as e:
+        metrics = None
+        print ("Metrics not served: {}".format(e))
+
+control = None
+if cfg.CONTROL_SOCKET is not None or cfg.CONTROL_PORT != -1:
+    from sync_tools import control_server    # Python 3 only
+    control = control_server.control_server(generator, cfg.CONTROL_SOCKET, cfg.CONTROL_PORT if cfg.CONTROL_PORT != -1 else None)
+    control.start()
+    print ("Accepting control commands on {}".format(cfg.CONTROL_SOCKET if cfg.CONTROL_SOCKET is not None else "127.0.0.1:%d"%cfg.CONTROL_PORT))
+
+def housekeeping():
+    """
+    Runs the generator housekeeping and reports the first lock to systemd.
+    """
+    global lock
+    generator.housekeeping()
+    if lock is None and generator.lock_time is not None:
+        lock = generator.startup_times()[1]
+        print ("Output PPS locked %.1f s after start" % lock)
+        service.notify("STATUS=Output PPS locked %.1f s after start" % lock)
+
+def healthy():
+    """
+    Probes pigpiod for the watchdog, as pi.connected only changes when the connection is stopped.
+    """
+    try:
+        pi.get_current_tick()
+    except (pigpio.error, socket.error, struct.error):
+        return False
+    return pi.connected
 
-while not sp.exit_now:
-    pass
-print ("Shutting down signals, exiting...")
+runtime = service.service_runtime(sp, housekeeping=housekeeping, reload=reload_config, healthy=healthy)
+runtime.ready(status)
+try:
+    runtime.run()
+finally:
+    # Stops the outputs even if housekeeping raised
+    print ("Shutting down signals, exiting...")
 
-generator.cancel()
-pi.stop()
+    for role in ('coordinator', 'follower'):
+        if cluster_nodes[role] is not None:
+            cluster_nodes[role].stop()
+    if lidar['tracker'] is not None:
+        lidar['tracker'].stop()
+    if control is not None:
+        control.stop()
+    if metrics is not None:
+        metrics.stop()
+    generator.cancel()
+    pi.stop()
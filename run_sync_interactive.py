@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
+import sys
+
 import pigpio
+from sync_tools import resource_planner
 from sync_tools import sync_generator
+from sync_tools import wave_compiler
 
 input_PPS_gpio = None
 PPS_in = -1
@@ -59,12 +63,15 @@ for i in range(num_triggers):
             trigger_frequency = 1
             while not output_trigger_frequency:
                 output_trigger_frequency = raw_input("Enter output trigger %d frequency: "%i)
-                if output_trigger_frequency.isdigit() and 0 < int(output_trigger_frequency) < 10001:
-                    trigger_frequency = int(output_trigger_frequency)
+                try:
+                    trigger_frequency = wave_compiler.rational_frequency(output_trigger_frequency)
+                except ValueError:
+                    trigger_frequency = 0
+                if 0 < trigger_frequency < 10001:
                     output_trigger_frequency = True
                 else:
                     output_trigger_frequency = None
-                    print("Enter an integer between 0 and 1000")
+                    print("Enter a number between 0 and 10000, such as 10, 7.5 or 30000/1001")
             output_trigger_phase = None
             trigger_phase = 0
             while not output_trigger_phase:
@@ -95,6 +102,10 @@ if (PPS_in != -1) and (PPS_out != -1):
             print("Enter either 'y' for yes or 'n' for no")
             sync_option = None
 
+plan = resource_planner.plan(PPS_out, 0.2, [(gpio, frequency, phase, 0.5) for gpio, frequency, phase in trigger_out], revision=resource_planner.local_revision())
+if not plan.fits():
+    print (resource_planner.format_report(plan))
+    sys.exit(1)
 
 pi = pigpio.pi()
 if not pi.connected:
@@ -112,7 +123,7 @@ if (PPS_out != -1):
 
 for output_trigger in trigger_out:
     generator.add_trigger_gpio(output_trigger[0], output_trigger[1], output_trigger[2])
-    print ("Output trigger signal on GPIO%d with frequency %dHz and phase %d degrees"%(output_trigger[0], output_trigger[1], output_trigger[2]))
+    print ("Output trigger signal on GPIO%d with frequency %sHz and phase %d degrees"%(output_trigger[0], wave_compiler.format_frequency(output_trigger[1]), output_trigger[2]))
 
 if use_sync:
     generator.start_PPS_input_sychronization()
@@ -1,11 +1,29 @@
 #!/usr/bin/env python
 import signal
+import threading
 
 class SignalProcessor:
   exit_now = False
+  reload_now = False
   def __init__(self):
+    self.event = threading.Event()
     signal.signal(signal.SIGINT, self.exit_gracefully)
     signal.signal(signal.SIGTERM, self.exit_gracefully)
+    signal.signal(signal.SIGHUP, self.reload)
 
   def exit_gracefully(self, signum, frame):
-    self.exit_now = True
\ No newline at end of file
+    self.exit_now = True
+    self.event.set()
+
+  def reload(self, signum, frame):
+    self.reload_now = True
+    self.event.set()
+
+  def wait(self, timeout=None):
+    """
+    Blocks until a signal arrives or the timeout in seconds passes.
+    Returns True if a signal arrived, and clears it.
+    """
+    signalled = self.event.wait(timeout)
+    self.event.clear()
+    return signalled
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 PPS_INPUT_GPIO = -1         # 0-31. Use -1 for inactive
+PPS_INPUT_BACKUP_GPIOS = [] # Further input PPS signals taking over from PPS_INPUT_GPIO, i.e. [17] for a second GNSS receiver
 PPS_OUTPUT_GPIO = 2         # 0-31. Use -1 for inactive
 PPS_OUTPUT_DUTY = 0.2       # Fractional duty cycle
 
@@ -11,7 +12,7 @@ TRIGGER4_GPIO = 6
 TRIGGER5_GPIO = 7
 TRIGGER6_GPIO = 8
 
-TRIGGER1_FREQUENCY = 10     # Integer number in Hertz
+TRIGGER1_FREQUENCY = 10     # In Hertz, whole or rational, i.e. 7.5 or '30000/1001'
 TRIGGER2_FREQUENCY = 10
 TRIGGER3_FREQUENCY = 10
 TRIGGER4_FREQUENCY = 10
@@ -36,9 +37,68 @@ USE_SYNC = False
 if PPS_INPUT_GPIO > 0:
     USE_SYNC = True         # Enable synchronization to PPS input when available
 
+USE_WAVE_CHAINS = False     # Compress high frequency triggers into a pigpio wave chain
+HYPERPERIOD_EPOCH = 0       # UTC second the multi-second waves of rational trigger frequencies are aligned to
+
+USE_HARDWARE_OUTPUTS = False    # Generate triggers on PWM (GPIO12, 13, 18, 19) and clock (GPIO4, 6, 20) pins by hardware
+HARDWARE_MIN_FREQUENCY = 1000   # Lowest trigger frequency generated by hardware in Hertz
+HARDWARE_PHASE_TOLERANCE = 50.0 # Phase error of a hardware output against the output PPS requiring a restart in microseconds
+HARDWARE_PWM_RESTART_INTERVAL = 600  # Shortest expected time between PWM restarts, which cancel the wave, in seconds. Use 0 to always use PWM
+
+USE_PPS_SERVO = False       # Discipline the output PPS with a PI servo instead of stepping the phase
+PPS_SERVO_KP = 0.3          # Proportional gain per PPS period
+PPS_SERVO_KI = 0.05         # Integral gain per PPS period
+
+USE_PPS_HOLDOVER = True     # Keep disciplining the output PPS from an oscillator model when the input PPS is lost
+PPS_REACQUIRE_STEP = 10     # Largest phase step per second when the input PPS comes back without servo, in microseconds
+
+VALIDATE_PPS_INPUT = False  # Check the input PPS edges and pulse widths (always done with backup inputs), and choose between the input PPS signals
+PPS_INPUT_GLITCH_FILTER = 100   # pigpiod glitch filter of the input PPS GPIOs in microseconds. Use 0 for inactive
+PPS_INPUT_MIN_WIDTH = 1000      # Shortest valid input PPS pulse in microseconds
+PPS_INPUT_MAX_WIDTH = 900000    # Longest valid input PPS pulse in microseconds
+
+USE_EDGE_SCRIPT = False     # Time the PPS edges with a script in pigpiod, polled by the service, instead of a callback per edge
+
+METRICS_PORT = 9108         # Local port serving synchronization metrics in Prometheus text format. Use -1 for inactive
+
+CONTROL_SOCKET = None       # Unix socket path for runtime control (Python 3), i.e. '/run/sync_control.sock'. Use None for inactive
+CONTROL_PORT = -1           # Local TCP port for runtime control (Python 3). Use -1 for inactive
+
+TRIGGER_LOG_DIRECTORY = None    # Directory logging the UTC time of every trigger edge, i.e. '/var/log/sync/triggers'. Use None for inactive
+TRIGGER_LOG_FILE_RECORDS = 4194304  # Edges per log file (16 bytes each)
+TRIGGER_LOG_MAX_FILES = 64      # Log files kept, the oldest ones are deleted
+
+REFCLOCK_SHM_UNIT = -1      # NTP shared memory unit the input PPS edges are fed to chrony or ntpd through, i.e. 0 for 'refclock SHM 0'. Use -1 for inactive
+REFCLOCK_SOCKET = None      # chrony SOCK refclock socket path the input PPS edges are sent to, i.e. '/var/run/chrony.sync.sock'. Use None for inactive
+REFCLOCK_PULSE = False      # Send only the phase over the SOCK refclock, leaving the seconds to other sources
+
+LIDAR_PORT = -1             # UDP port of the Velodyne data packets the camera trigger phases are locked to, i.e. 2368. Use -1 for inactive
+LIDAR_POSITION_PORT = 8308  # UDP port of its position packets, which report its PPS lock. Use -1 if they are not forwarded
+LIDAR_PHASE_TOLERANCE = 0.1 # Azimuth error at mid-exposure, as a fraction of the camera field of view, before a phase is updated
+
+# Cameras locked to the LiDAR rotation as (gpio, azimuth, fov, delay): the trigger GPIO, the mounting azimuth and
+# horizontal field of view in degrees clockwise from the LiDAR front, and the trigger to mid-exposure delay in microseconds
+LIDAR_CAMERAS = [(TRIGGER1_GPIO, 0, 90, 0)]
+
+CLUSTER_ROLE = None         # 'coordinator' or 'follower' to share the triggers of a rig between Pis, replacing the TRIGGER settings. Use None for a single Pi
+CLUSTER_NODE = None         # Name of this Pi in the cluster. Use None for the host name
+CLUSTER_GROUP = '239.255.80.1'  # UDP multicast group and port of the cluster
+CLUSTER_PORT = 9110
+CLUSTER_INTERFACE = '0.0.0.0'   # Address of the network interface the cluster is reached on, or '0.0.0.0' for the default one
+CLUSTER_GPIOS = [3, 4, 5, 6, 7, 8]  # GPIOs of this Pi the coordinator may place triggers without a GPIO on
+
+# Triggers of the whole cluster, read by the coordinator, as (name, frequency, phase, duty, node, gpio).
+# A phase of None spreads the triggers of a frequency evenly over their period. Without node and gpio,
+# the coordinator places the trigger on the Pi with the most free GPIOs.
+CLUSTER_TRIGGERS = [('camera1', 10, None, 0.5, 'pi1', 3), ('camera2', 10, None, 0.5, 'pi2', 3)]
+
 SEND_DUMMY_NMEA = False     # Enable spoof NMEA messages
 NMEA_DESTINATION_PORT = 10110
 NMEA_DESTINATION_HOST = '192.168.1.201'
+NMEA_DESTINATION_PROTOCOL = 'tcp'   # 'tcp' or 'udp'
+
+# Further sensors can be added as (host, port, protocol)
+NMEA_DESTINATIONS = [(NMEA_DESTINATION_HOST, NMEA_DESTINATION_PORT, NMEA_DESTINATION_PROTOCOL)]
 
 TRIGGER_GPIOS = [TRIGGER1_GPIO, TRIGGER2_GPIO, TRIGGER3_GPIO,
                     TRIGGER4_GPIO, TRIGGER5_GPIO, TRIGGER6_GPIO]
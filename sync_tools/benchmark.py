@@ -0,0 +1,614 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  benchmark.py
+#
+#  Benchmarks for wave compilation, wave switchover and PPS lock convergence.
+#  Runs against the simulated pigpio backend by default, or against a live pigpiod,
+#  where the callback latency is measured as well.
+#
+
+import bisect
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+import hardware_outputs
+import pigpio
+import pigpio_sim
+import pps_servo
+import resource_planner
+import sync_generator
+import telemetry
+import timebase
+import trigger_log
+import wave_compiler
+
+TRIGGER_COUNTS = [1, 2, 6, 12, 20]
+FREQUENCIES = [1, 10, 100, 1000, 10000]
+DUTIES = [0.1, 0.5]
+PHASES = [0, 90]
+CHAINING = [False, True]
+SERVO = [False, True]
+
+PPS_INPUT_GPIO = 27
+PPS_OUTPUT_GPIO = 2
+FIRST_TRIGGER_GPIO = 3
+
+
+class timed_pi:
+
+    def __init__(self, pi):
+        """
+        Wraps a pigpio.pi (or simulated_pi) handle, counting round trips and the wall time spent in them.
+        """
+        self.pi = pi
+        self.round_trips = 0
+        self.pi_time = 0.0
+        self.pulses_sent = 0
+        self.wave_pulses = 0
+        self.pending_pulses = 0
+
+    def reset(self):
+        self.round_trips = 0
+        self.pi_time = 0.0
+        self.pulses_sent = 0
+        self.wave_pulses = 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self.pi, name)
+        if not callable(attribute):
+            return attribute
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            result = attribute(*args, **kwargs)
+            self.pi_time += time.time() - start
+            self.round_trips += 1
+            if name == 'wave_add_generic':
+                self.pulses_sent += len(args[0])
+                self.pending_pulses = result
+            elif name == 'wave_create':
+                self.wave_pulses += self.pending_pulses
+            return result
+        return timed
+
+
+def _configure(generator, trigger_count, frequency, duty, phase, chaining):
+    generator.set_wave_chaining(chaining)
+    generator.set_PPS_output_gpio(PPS_OUTPUT_GPIO)
+    for i in range(trigger_count):
+        generator.add_trigger_gpio(FIRST_TRIGGER_GPIO + i, frequency, (phase * i) % 360, duty)
+
+
+def benchmark_update(trigger_count, frequency, duty, phase, chaining=False, pi=None):
+    """
+    Measures the cost of compiling and switching a wave for one trigger configuration.
+    The first update starts the wave, the second one measures a synchronized switchover.
+    """
+    result = {
+        'benchmark': 'update',
+        'triggers': trigger_count,
+        'frequency': frequency,
+        'duty': duty,
+        'phase': phase,
+        'chaining': chaining,
+    }
+    simulated = pi is None
+    if simulated:
+        pi = pigpio_sim.simulated_pi()
+    timed = timed_pi(pi)
+    generator = sync_generator.waveform_engine(timed)
+    _configure(generator, trigger_count, frequency, duty, phase, chaining)
+    # The GPIO modes are set before the wave is built, but are not part of it
+    generator.apply_modes()
+
+    try:
+        timed.reset()
+        start = time.time()
+        generator.update()
+        result['first_update_time'] = time.time() - start
+        result['build_time'] = result['first_update_time'] - timed.pi_time
+        result['pulses_sent'] = timed.pulses_sent
+        result['wave_pulses'] = timed.wave_pulses
+        result['round_trips'] = timed.round_trips
+
+        if simulated:
+            pi.advance(250000)
+        generator.set_PPS_output_offset(1000.0)
+        timed.reset()
+        start = time.time()
+        generator.update()
+        result['switch_update_time'] = time.time() - start
+        result['switch_build_time'] = result['switch_update_time'] - timed.pi_time
+        result['switch_round_trips'] = timed.round_trips
+        if simulated:
+            # The switchover is confirmed on the following output PPS edges
+            pi.advance(int(generator.handover_timeout * generator.PPS_output_cycle_time))
+            result['switch_latency'] = generator.switch_latency
+        result['error'] = None
+    except pigpio.error as e:
+        result['error'] = str(e)
+    finally:
+        generator.cancel()
+    return result
+
+
+def benchmark_hardware_outputs(frequency=5000, offload=True, seconds=30, drift_ppm=2.0, pwm_restart_interval=hardware_outputs.MIN_PWM_RESTART_INTERVAL):
+    """
+    Measures the wave built for triggers on the hardware PWM and clock pins (and one slow trigger)
+    with and without hardware outputs, and the phase errors and restarts of the hardware outputs
+    while synchronized to an input PPS drifting against the Pi oscillator. PWM restarts cancel the
+    wave, so they are counted apart; with pwm_restart_interval 0, PWM is used however often it drifts.
+    """
+    result = {
+        'benchmark': 'hardware',
+        'frequency': frequency,
+        'offload': offload,
+        'drift_ppm': drift_ppm,
+        'pwm_restart_interval': pwm_restart_interval,
+    }
+    pi = pigpio_sim.simulated_pi()
+    timed = timed_pi(pi)
+    generator = sync_generator.waveform_engine(timed)
+    generator.set_PPS_input_gpio(PPS_INPUT_GPIO)
+    generator.set_PPS_output_gpio(PPS_OUTPUT_GPIO)
+    for gpio, duty in ((12, 0.25), (13, 0.5), (4, 0.5)):
+        generator.add_trigger_gpio(gpio, frequency, 90, duty)
+    generator.add_trigger_gpio(FIRST_TRIGGER_GPIO, 10, 0, 0.5)
+    generator.set_hardware_offload(offload, pwm_restart_interval=pwm_restart_interval)
+    pi.add_PPS_source(PPS_INPUT_GPIO, first_edge=pi.now + 300000, drift_ppm=drift_ppm)
+    try:
+        timed.reset()
+        start = time.time()
+        generator.update()
+        result['first_update_time'] = time.time() - start
+        result['build_time'] = result['first_update_time'] - timed.pi_time
+        result['wave_pulses'] = timed.wave_pulses
+        result['paths'] = dict((str(gpio), path) for gpio, path in generator.output_paths().items())
+        generator.start_PPS_input_sychronization()
+        result['synchronized_paths'] = dict((str(gpio), path) for gpio, path in generator.output_paths().items())
+        pwm_commands = pi.command_counts['hardware_PWM']
+        errors = []
+        for second in range(seconds):
+            pi.advance(1000000)
+            generator.housekeeping()
+            errors.extend(abs(output.phase_error) for output in generator.hardware_outputs.values() if output.phase_error is not None)
+        result['max_phase_error'] = max(errors) if errors else None
+        result['realignments'] = generator.hardware_realignments
+        result['pwm_restarts'] = pi.command_counts['hardware_PWM'] - pwm_commands
+        result['rebuilds'] = generator.rebuild_count
+        result['switch_timeouts'] = generator.handover_timeouts
+        result['lock'] = generator.lock_state()
+        result['error'] = None
+    except (ValueError, pigpio.error) as e:
+        result['error'] = str(e)
+    finally:
+        generator.cancel()
+    return result
+
+
+def _synchronized(pi, trigger_count, frequency, chaining, servo):
+    generator = sync_generator.waveform_engine(pi)
+    generator.set_PPS_input_gpio(PPS_INPUT_GPIO)
+    _configure(generator, trigger_count, frequency, 0.5, 0, chaining)
+    if servo:
+        generator.set_PPS_servo(pps_servo.pps_servo())
+    generator.start_PPS_input_sychronization()
+    generator.update()
+    return generator
+
+
+def benchmark_cold_start(trigger_count=6, frequency=10, precompiled=True, servo=True, max_seconds=60, seed=1):
+    """
+    Measures a start as run_sync.py makes it, after the resource check: the round trips and simulated time
+    until the first wave is transmitted, the wall time spent getting there, of which the build time is spent
+    on the host rather than in pigpiod calls, and the simulated time until the output PPS locks to a GNSS PPS
+    input. With precompiled, the generator takes over the wave compiled by the resource check, otherwise it
+    compiles the wave again, which shows in the segments compiled and the build time: the pigpiod calls are
+    the same either way.
+    """
+    triggers = [(FIRST_TRIGGER_GPIO + i, frequency, 0, 0.5) for i in range(trigger_count)]
+    segments = wave_compiler.segment_store()
+    resource_planner.plan(PPS_OUTPUT_GPIO, 0.2, triggers, servo=servo, segments=segments)
+    if not precompiled:
+        segments = wave_compiler.segment_store()
+    misses = segments.misses
+    start = time.time()
+
+    pi = pigpio_sim.simulated_pi()
+    pi.add_PPS_source(PPS_INPUT_GPIO, first_edge=pi.now + 300000, drift_ppm=20.0, jitter=2.0, seed=seed)
+    timed = timed_pi(pi)
+    generator = sync_generator.waveform_engine(timed)
+    generator.segments = segments
+    start_tick = pi.now
+    generator.set_PPS_input_gpio(PPS_INPUT_GPIO)
+    generator.set_PPS_output_gpio(PPS_OUTPUT_GPIO)
+    for trigger in triggers:
+        generator.add_trigger_gpio(*trigger)
+    if servo:
+        generator.set_PPS_servo(pps_servo.pps_servo())
+    generator.update()
+    first_edge_time = time.time() - start
+    first_edge_ticks = pi.now - start_tick
+    round_trips = timed.round_trips
+    build_time = first_edge_time - timed.pi_time
+    compiled = segments.misses - misses
+    generator.start_PPS_input_sychronization()
+
+    lock_ticks = None
+    for second in range(max_seconds):
+        pi.advance(1000000)
+        if generator.lock_state() == pps_servo.LOCKED:
+            lock_ticks = pi.now - start_tick
+            break
+    generator.cancel()
+
+    return {
+        'benchmark': 'cold_start',
+        'triggers': trigger_count,
+        'frequency': frequency,
+        'precompiled': precompiled,
+        'servo': servo,
+        'first_edge_time': first_edge_time,
+        'build_time': build_time,
+        'compiled_segments': compiled,
+        'first_edge_ticks': first_edge_ticks,
+        'first_edge_round_trips': round_trips,
+        'lock_ticks': lock_ticks,
+    }
+
+
+def benchmark_convergence(trigger_count=6, frequency=10, initial_offset=300000, drift_ppm=20.0, jitter=2.0, chaining=False, servo=False, settle_cycles=5, max_seconds=60, seed=1):
+    """
+    Measures the time for the PPS lock loop to bring the output PPS within the slack threshold
+    of a simulated GNSS PPS input, and how many wave rebuilds it took.
+    Converged means the slack stayed within the threshold for settle_cycles consecutive PPS periods.
+    A run that does not converge within max_seconds has no convergence time and reports an error.
+    """
+    pi = pigpio_sim.simulated_pi(record_edges=True)
+    pi.add_PPS_source(PPS_INPUT_GPIO, first_edge=pi.now + initial_offset, drift_ppm=drift_ppm, jitter=jitter, seed=seed)
+    generator = _synchronized(pi, trigger_count, frequency, chaining, servo)
+
+    start_tick = pi.now
+    converged_at = None
+    for second in range(max_seconds):
+        pi.advance(1000000)
+        slacks = _edge_slacks(pi, pi.now - 500000)
+        in_lock = 0
+        for tick, slack in slacks:
+            if abs(slack) <= generator.PPS_slack_threshold:
+                in_lock += 1
+                if in_lock == settle_cycles:
+                    converged_at = tick - start_tick
+                    break
+            else:
+                in_lock = 0
+        if converged_at is not None:
+            break
+    generator.cancel()
+
+    return {
+        'benchmark': 'convergence',
+        'triggers': trigger_count,
+        'frequency': frequency,
+        'initial_offset': initial_offset,
+        'drift_ppm': drift_ppm,
+        'jitter': jitter,
+        'chaining': chaining,
+        'servo': servo,
+        'converged': converged_at is not None,
+        'convergence_time': converged_at,
+        'error': None if converged_at is not None else 'not converged within %d s' % max_seconds,
+        'rebuilds': generator.rebuild_count - 1,
+        'round_trips': pi.command_count(),
+        'slacks': [slack for tick, slack in slacks],
+    }
+
+
+def benchmark_tracking(trigger_count=6, frequency=10, drift_ppm=13.37, jitter=2.0, chaining=False, servo=False, settle_seconds=60, seconds=300, seed=1):
+    """
+    Measures how the PPS lock loop holds the output PPS once it has settled: wave rebuilds per hour
+    and the error of the output PPS against the jitter free input PPS.
+    """
+    pi = pigpio_sim.simulated_pi(record_edges=True)
+    source = pi.add_PPS_source(PPS_INPUT_GPIO, first_edge=pi.now + 300000, drift_ppm=drift_ppm, jitter=jitter, seed=seed)
+    generator = _synchronized(pi, trigger_count, frequency, chaining, servo)
+    pi.advance(settle_seconds * 1000000)
+    start_tick = pi.now
+    rebuilds = generator.rebuild_count
+    pi.advance(seconds * 1000000)
+    generator.cancel()
+
+    nominal = [source.nominal_edge(count) for count in range(settle_seconds + seconds + 2)]
+    errors = []
+    for tick, gpio, level in pi.edges:
+        if gpio == PPS_OUTPUT_GPIO and level == 1 and tick >= start_tick:
+            i = bisect.bisect_left(nominal, tick)
+            errors.append(min((tick - nominal[j] for j in (i - 1, i) if 0 <= j < len(nominal)), key=abs))
+    return {
+        'benchmark': 'tracking',
+        'triggers': trigger_count,
+        'frequency': frequency,
+        'drift_ppm': drift_ppm,
+        'jitter': jitter,
+        'chaining': chaining,
+        'servo': servo,
+        'rebuilds_per_hour': (generator.rebuild_count - rebuilds) * 3600.0 / seconds,
+        'rms_error': (sum(error * error for error in errors) / len(errors)) ** 0.5 if errors else None,
+        'max_error': max(abs(error) for error in errors) if errors else None,
+    }
+
+
+def _edge_slacks(pi, until):
+    """
+    Returns (tick, slack) for every output PPS rising edge before the given tick, where slack is the
+    time from the closest input PPS rising edge, taken from the simulated edge timeline.
+    """
+    inputs = [tick for tick, gpio, level in pi.edges if gpio == PPS_INPUT_GPIO and level == 1]
+    slacks = []
+    for tick, gpio, level in pi.edges:
+        if gpio == PPS_OUTPUT_GPIO and level == 1 and tick < until and inputs:
+            i = bisect.bisect_left(inputs, tick)
+            closest = [inputs[j] for j in (i - 1, i) if 0 <= j < len(inputs)]
+            slacks.append((tick, min((tick - j for j in closest), key=abs)))
+    return slacks
+
+
+def benchmark_callback_latency(pi, main_loop='wait', frequency=100, seconds=10):
+    """
+    Measures the pigpio callback latency on a live pigpiod while the main thread spins (as run_sync.py
+    did) or blocks (as the service runtime does): the delay from an output edge to its callback
+    reading the current tick, which includes one round trip to pigpiod.
+    """
+    half_period = int(500000 / frequency)
+    latencies = []
+
+    def callback(gpio, level, tick):
+        latencies.append(pigpio.tickDiff(tick, pi.get_current_tick()))
+
+    pi.set_mode(PPS_OUTPUT_GPIO, pigpio.OUTPUT)
+    pi.wave_add_generic([pigpio.pulse(1 << PPS_OUTPUT_GPIO, 0, half_period), pigpio.pulse(0, 1 << PPS_OUTPUT_GPIO, half_period)])
+    wave = pi.wave_create()
+    pi.wave_send_repeat(wave)
+    edge_callback = pi.callback(PPS_OUTPUT_GPIO, pigpio.RISING_EDGE, callback)
+    start = time.time()
+    if main_loop == 'spin':
+        while time.time() - start < seconds:
+            pass
+    else:
+        threading.Event().wait(seconds)
+    edge_callback.cancel()
+    pi.wave_tx_stop()
+    pi.wave_delete(wave)
+
+    latencies.sort()
+    return {
+        'benchmark': 'callback',
+        'main_loop': main_loop,
+        'frequency': frequency,
+        'callbacks': len(latencies),
+        'median_latency': latencies[len(latencies) // 2] if latencies else None,
+        'p99_latency': latencies[int(len(latencies) * 0.99)] if latencies else None,
+        'max_latency': latencies[-1] if latencies else None,
+    }
+
+
+def benchmark_telemetry(events=100000):
+    """
+    Measures the cost of recording a telemetry event on the callback path, and of computing the
+    statistics of a full telemetry buffer.
+    """
+    buffer = telemetry.telemetry_buffer()
+    record = buffer.record
+    start = time.time()
+    for i in range(events):
+        record(telemetry.INPUT, i, 1000000.0)
+    record_time = (time.time() - start) / events
+    start = time.time()
+    telemetry.statistics(buffer)
+    return {
+        'benchmark': 'telemetry',
+        'record_time': record_time,
+        'statistics_time': time.time() - start,
+    }
+
+
+def benchmark_trigger_log(trigger_count=20, frequency=200, seconds=3600, queries=100, seed=1):
+    """
+    Logs the trigger edges of seconds PPS periods to a temporary directory and measures the time to
+    write a period and to query the edges of one trigger over one second and over one minute.
+    """
+    generator = sync_generator.waveform_engine(pigpio_sim.simulated_pi())
+    _configure(generator, trigger_count, frequency, 0.5, 90, False)
+    timeline = generator.compile()
+    clock = timebase.timebase()
+    directory = tempfile.mkdtemp(prefix='trigger_log')
+    first_second = 1600000000
+    try:
+        writer = trigger_log.trigger_log_writer(directory, clock, file_records=1 << 20, max_files=1 << 16)
+        writer.start()
+        start = time.time()
+        for second in range(seconds + 1):
+            tick = (second * 1000000) & 0xFFFFFFFF
+            clock.add_anchor(tick, first_second + second)
+            writer.edge(tick, timeline, PPS_OUTPUT_GPIO)
+            while len(writer.edges) > writer.edges.maxlen // 2:
+                time.sleep(0.001)
+        while writer.edges:
+            time.sleep(0.001)
+        writer.stop()
+        write_time = (time.time() - start) / seconds
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+        reader = trigger_log.trigger_log_reader(directory)
+        random_source = random.Random(seed)
+        query_times = {}
+        for span in (1, 60):
+            start = time.time()
+            for i in range(queries):
+                begin = first_second + random_source.uniform(0, seconds - span)
+                reader.edges(FIRST_TRIGGER_GPIO, begin, begin + span)
+            query_times[span] = (time.time() - start) / queries
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'benchmark': 'trigger_log',
+        'triggers': trigger_count,
+        'frequency': frequency,
+        'seconds': seconds,
+        'records': writer.written,
+        'log_bytes': size,
+        'write_time': write_time,
+        'query_time': query_times[1],
+        'minute_query_time': query_times[60],
+    }
+
+
+def run_all(trigger_counts=TRIGGER_COUNTS, frequencies=FREQUENCIES, duties=DUTIES, phases=PHASES, chaining=CHAINING, servo=SERVO, pi=None):
+    """
+    Runs the full benchmark matrix and returns the results as a JSON serializable dictionary.
+    """
+    results = []
+    for trigger_count in trigger_counts:
+        for frequency in frequencies:
+            for duty in duties:
+                for phase in phases:
+                    for chain in chaining:
+                        results.append(benchmark_update(trigger_count, frequency, duty, phase, chain, pi))
+    if pi is None:
+        for drift_ppm, jitter in [(0.0, 0.0), (20.0, 2.0), (-50.0, 10.0)]:
+            for chain in chaining:
+                for servo_mode in servo:
+                    results.append(benchmark_convergence(drift_ppm=drift_ppm, jitter=jitter, chaining=chain, servo=servo_mode))
+        for drift_ppm, jitter in [(13.37, 2.0), (-47.3, 10.0)]:
+            for servo_mode in servo:
+                results.append(benchmark_tracking(drift_ppm=drift_ppm, jitter=jitter, servo=servo_mode))
+        for frequency in (1500, 5000):
+            for offload, pwm_restart_interval in ((False, 0), (True, hardware_outputs.MIN_PWM_RESTART_INTERVAL), (True, 0)):
+                results.append(benchmark_hardware_outputs(frequency, offload, pwm_restart_interval=pwm_restart_interval))
+        for precompiled in (False, True):
+            results.append(benchmark_cold_start(precompiled=precompiled))
+        results.append(benchmark_telemetry())
+        results.append(benchmark_trigger_log())
+    else:
+        for main_loop in ('spin', 'wait'):
+            results.append(benchmark_callback_latency(pi, main_loop))
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'backend': 'simulated' if pi is None else 'pigpiod',
+        'results': results,
+    }
+
+
+def save(report, filename):
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _key(result):
+    return tuple(result.get(k) for k in ('benchmark', 'triggers', 'frequency', 'duty', 'phase', 'chaining', 'servo', 'drift_ppm', 'jitter', 'main_loop', 'offload', 'pwm_restart_interval', 'precompiled'))
+
+
+def compare(baseline, report, tolerance=0.2, metrics=('build_time', 'first_update_time', 'switch_update_time', 'switch_build_time', 'round_trips', 'switch_round_trips', 'wave_pulses', 'convergence_time', 'rebuilds', 'rebuilds_per_hour', 'rms_error', 'p99_latency', 'record_time', 'write_time', 'query_time', 'first_edge_ticks', 'first_edge_round_trips')):
+    """
+    Compares a report against a baseline report.
+    Returns a list of (key, metric, baseline value, new value) for metrics that got worse by more than tolerance,
+    and for runs that converged in the baseline but no longer do.
+    """
+    baseline_results = dict((_key(result), result) for result in baseline['results'])
+    regressions = []
+    for result in report['results']:
+        old = baseline_results.get(_key(result))
+        if old is None:
+            continue
+        if old.get('converged') and result.get('converged') is False:
+            regressions.append((_key(result), 'converged', True, False))
+        for metric in metrics:
+            old_value = old.get(metric)
+            new_value = result.get(metric)
+            if old_value is None or new_value is None:
+                continue
+            if new_value > old_value * (1.0 + tolerance) and new_value - old_value > 1e-4:
+                regressions.append((_key(result), metric, old_value, new_value))
+    return regressions
+
+
+def format_report(report):
+    lines = []
+    lines.append('%-8s %5s %6s %5s %5s %5s %9s %9s %9s %9s %6s %11s' % ('bench', 'trig', 'freq', 'duty', 'phase', 'chain', 'pulses', 'build ms', 'update ms', 'shift ms', 'trips', 'switch us'))
+    for result in report['results']:
+        if result['benchmark'] == 'update':
+            if result['error'] is not None:
+                lines.append('%-8s %5d %6d %5.2f %5d %5s  %s' % ('update', result['triggers'], result['frequency'], result['duty'], result['phase'], result['chaining'], result['error']))
+                continue
+            lines.append('%-8s %5d %6d %5.2f %5d %5s %9d %9.2f %9.2f %9.2f %6d %11s' % (
+                'update', result['triggers'], result['frequency'], result['duty'], result['phase'], result['chaining'],
+                result['wave_pulses'], result['build_time'] * 1000, result['first_update_time'] * 1000,
+                result['switch_build_time'] * 1000, result['round_trips'], result.get('switch_latency', '-')))
+    for result in report['results']:
+        if result['benchmark'] == 'convergence':
+            if result.get('error') is not None:
+                lines.append('convergence: drift %.1f ppm, jitter %.1f us, chaining %s, servo %s -> %s, %d rebuilds, %d round trips' % (
+                    result['drift_ppm'], result['jitter'], result['chaining'], result.get('servo', False), result['error'], result['rebuilds'], result['round_trips']))
+                continue
+            lines.append('convergence: drift %.1f ppm, jitter %.1f us, chaining %s, servo %s -> %s us, %d rebuilds, %d round trips' % (
+                result['drift_ppm'], result['jitter'], result['chaining'], result.get('servo', False), result['convergence_time'], result['rebuilds'], result['round_trips']))
+    for result in report['results']:
+        if result['benchmark'] == 'tracking':
+            lines.append('tracking: drift %.2f ppm, jitter %.1f us, servo %s -> %.0f rebuilds/hour, error %.2f us rms, %d us max' % (
+                result['drift_ppm'], result['jitter'], result['servo'], result['rebuilds_per_hour'], result['rms_error'], result['max_error']))
+    for result in report['results']:
+        if result['benchmark'] == 'hardware':
+            if result['error'] is not None:
+                lines.append('hardware outputs: 3 triggers at %d Hz, offload %s, PWM restarts >= %d s -> %s' % (result['frequency'], result['offload'], result['pwm_restart_interval'], result['error']))
+                continue
+            phase_error = '%.1f us' % result['max_phase_error'] if result['max_phase_error'] is not None else '-'
+            lines.append('hardware outputs: 3 triggers at %d Hz, offload %s, PWM restarts >= %d s -> %d pulses, %.2f ms build, %s, max phase error %s, %d restarts (%d PWM), %d rebuilds' % (
+                result['frequency'], result['offload'], result['pwm_restart_interval'], result['wave_pulses'], result['build_time'] * 1000,
+                result['lock'], phase_error, result['realignments'], result['pwm_restarts'], result['rebuilds']))
+    for result in report['results']:
+        if result['benchmark'] == 'cold_start':
+            lock = '%.1f s' % (result['lock_ticks'] / 1e6) if result['lock_ticks'] is not None else '-'
+            lines.append('cold start: %d triggers at %d Hz, precompiled %s -> first edge after %d round trips, %.2f ms simulated, %.2f ms here (%.2f ms building %d segments), lock after %s' % (
+                result['triggers'], result['frequency'], result['precompiled'], result['first_edge_round_trips'],
+                result['first_edge_ticks'] / 1000.0, result['first_edge_time'] * 1000, result['build_time'] * 1000, result['compiled_segments'], lock))
+    for result in report['results']:
+        if result['benchmark'] == 'telemetry':
+            lines.append('telemetry: %.2f us per event recorded, %.2f ms for the statistics of a full buffer' % (
+                result['record_time'] * 1e6, result['statistics_time'] * 1000))
+    for result in report['results']:
+        if result['benchmark'] == 'trigger_log':
+            lines.append('trigger log: %d triggers at %d Hz for %d s, %d records in %.0f MB -> %.2f ms per period written, %.2f ms per 1 s query, %.2f ms per 1 min query' % (
+                result['triggers'], result['frequency'], result['seconds'], result['records'], result['log_bytes'] / 1e6,
+                result['write_time'] * 1000, result['query_time'] * 1000, result['minute_query_time'] * 1000))
+    for result in report['results']:
+        if result['benchmark'] == 'callback':
+            lines.append('callback: main loop %s, %d callbacks -> latency %s us median, %s us p99, %s us max' % (
+                result['main_loop'], result['callbacks'], result['median_latency'], result['p99_latency'], result['max_latency']))
+    return '\n'.join(lines)
@@ -0,0 +1,542 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  cluster.py
+#
+#  Shares the triggers of a rig between several Pis, each locked to its own input PPS.
+#
+#  A coordinator holds the triggers of the whole cluster and publishes a plan over UDP multicast
+#  once a second: the hyperperiod epoch, its PPS cycle time estimate and, for every node, the
+#  triggers it generates and the UTC second to apply them at. Followers, one per Pi (the
+#  coordinator's Pi runs one as well), apply their part of the plan at that second and report
+#  their lock state, PPS phase residual and applied plan revision back once a second.
+#
+#  As every node is locked to a PPS of the same UTC seconds, a phase means the same instant on
+#  every node, so the coordinator only assigns the phases: triggers without one are spread evenly
+#  over their period, across all nodes. Triggers are normally pinned to the node and GPIO their
+#  camera is wired to; triggers without a node are placed once on the node with the most free
+#  GPIOs whose wave still fits (see resource_planner.py) and stay there. A change of the plan is
+#  rolled out one node at a time: the next node is only given its new triggers once the previous
+#  one reported them applied with its output still locked, so a bad change shows on one node.
+#
+#  Messages are JSON objects with a "type" of "plan" or "report", one per datagram.
+#
+
+import json
+import select
+import socket
+import struct
+import threading
+import time
+
+import holdover
+import pps_servo
+import resource_planner
+import sync_generator
+import wave_compiler
+
+GROUP = '239.255.80.1'
+PORT = 9110
+MAX_MESSAGE = 65507
+
+SETTLED_STATES = (pps_servo.LOCKED, holdover.HOLDOVER, sync_generator.FREE_RUNNING)    # States a node may be rolled on from
+
+
+def open_socket(group=GROUP, port=PORT, interface='0.0.0.0'):
+    """
+    Returns a non-blocking UDP socket joined to the multicast group on the interface with the given
+    address, sending to the group on that interface. Sent messages are looped back, so nodes on the
+    same host, such as the coordinator and the follower of its Pi, receive them.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        sock.bind(('', port))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton(interface)))
+        if interface != '0.0.0.0':
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    except socket.error:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return sock
+
+
+def _lock_rank(state):
+    # Orders the lock states of a node, settled ones last
+    if state in SETTLED_STATES:
+        return 2
+    if state in (pps_servo.ACQUIRING, holdover.REACQUIRING):
+        return 1
+    return 0
+
+
+def _receive(sock):
+    # The decoded messages waiting on a socket, skipping those that are not JSON objects
+    messages = []
+    while True:
+        try:
+            data = sock.recv(MAX_MESSAGE)
+        except socket.error:
+            return messages
+        try:
+            message = json.loads(data.decode('utf-8'))
+        except ValueError:
+            continue
+        if isinstance(message, dict):
+            messages.append(message)
+
+
+def _send(sock, group, port, message):
+    try:
+        sock.sendto(json.dumps(message).encode('utf-8'), (group, port))
+        return True
+    except socket.error:
+        return False
+
+
+def trigger_specs(triggers):
+    """
+    Returns the cluster triggers, given as (name, frequency, phase, duty) tuples optionally followed by
+    the node and GPIO they are wired to, as dicts with validated settings.
+    A phase of None is assigned by spread_phases().
+    Raises ValueError on invalid or duplicate settings.
+    """
+    specs = []
+    names = set()
+    wired = set()
+    for trigger in triggers:
+        if not 4 <= len(trigger) <= 6:
+            raise ValueError('cluster triggers are (name, frequency, phase, duty[, node[, gpio]])')
+        name, frequency, phase, duty = trigger[:4]
+        node = trigger[4] if len(trigger) > 4 else None
+        gpio = trigger[5] if len(trigger) > 5 else None
+        if name in names:
+            raise ValueError('trigger %s is listed twice' % name)
+        if phase is not None and not 0 <= phase <= 360:
+            raise ValueError('phase of trigger %s must be from 0 to 360 degrees' % name)
+        if not 0 <= duty <= 1:
+            raise ValueError('duty of trigger %s must be a fraction from 0 to 1' % name)
+        if gpio is not None and (node is None or not 0 <= gpio < 32):
+            raise ValueError('trigger %s needs a node and a GPIO from 0 to 31' % name)
+        if gpio is not None and (node, gpio) in wired:
+            raise ValueError('GPIO%d of %s is used by several triggers' % (gpio, node))
+        names.add(name)
+        wired.add((node, gpio))
+        specs.append({'name': name, 'frequency': wave_compiler.rational_frequency(frequency), 'phase': phase, 'duty': duty, 'node': node, 'gpio': gpio})
+    return specs
+
+
+def spread_phases(specs):
+    """
+    Assigns the triggers without a phase evenly spread phases, by frequency and in name order, so
+    the cameras of one frequency fire one after another across all nodes.
+    """
+    groups = {}
+    for spec in specs:
+        if spec['phase'] is None:
+            groups.setdefault(spec['frequency'], []).append(spec)
+    for group in groups.values():
+        group.sort(key=lambda spec: spec['name'])
+        for i, spec in enumerate(group):
+            spec['phase'] = round(360.0 * i / len(group), 3)
+    return specs
+
+
+def _fits(report, triggers, segments):
+    # Whether the wave of a node with the given triggers fits the resources of pigpiod
+    plan = resource_planner.plan(report.get('pps_gpio', -1), report.get('pps_duty', 0.2), triggers, report.get('chaining', False), report.get('servo', False),
+                                 report.get('hardware_offload', False), report.get('hardware_min_frequency', 1000), report.get('hardware_revision') or 0,
+                                 suggest=False, segments=segments, synchronized=report.get('synchronized', False))
+    return plan.fits()
+
+
+def assign(specs, nodes, placements, place=True):
+    """
+    Places the cluster triggers on the nodes. nodes maps the node names to their last reports, which
+    give the GPIOs the node offers and its PPS output and wave settings. placements maps the names
+    of triggers placed earlier to their (node, GPIO), and is extended with the new placements.
+    Returns the triggers of each node as lists of (gpio, frequency, phase, duty, name), and the names
+    of the triggers that are not placed, or would not fit the wave of their node. Nodes whose
+    triggers would not fit are left out.
+    Triggers wired to a node are placed there even while it is not known, so it gets them when
+    it joins. Others are placed once on the known node with the most free GPIOs that fits them,
+    the fastest first, and stay there. Without place, only the triggers placed before are.
+    """
+    assignment = dict((name, []) for name in nodes)
+    unplaced = []
+    used = dict((name, set()) for name in nodes)
+    wired = dict((spec['name'], (spec['node'], spec['gpio'])) for spec in specs if spec['gpio'] is not None)
+    for name, placement in list(placements.items()):
+        if name not in wired and placement in wired.values():
+            del placements[name]
+    placements.update(wired)
+    for name, (node, gpio) in placements.items():
+        used.setdefault(node, set()).add(gpio)
+
+    segments = dict((name, wave_compiler.segment_store()) for name in nodes)
+    for spec in sorted(specs, key=lambda spec: -spec['frequency']):
+        placement = placements.get(spec['name'])
+        if placement is None and place:
+            candidates = [name for name in nodes if spec['node'] in (None, name)]
+            candidates.sort(key=lambda name: (-len(set(nodes[name].get('gpios', ())) - used[name]), name))
+            for node in candidates:
+                free = [gpio for gpio in nodes[node].get('gpios', ()) if gpio not in used[node]]
+                if not free:
+                    continue
+                trigger = (free[0], spec['frequency'], spec['phase'], spec['duty'])
+                if _fits(nodes[node], [t[:4] for t in assignment[node]] + [trigger], segments[node]):
+                    placement = (node, free[0])
+                    placements[spec['name']] = placement
+                    used[node].add(free[0])
+                    break
+        if placement is None:
+            unplaced.append(spec['name'])
+            continue
+        node, gpio = placement
+        assignment.setdefault(node, []).append((gpio, spec['frequency'], spec['phase'], spec['duty'], spec['name']))
+
+    for node, triggers in list(assignment.items()):
+        if node in nodes and triggers and not _fits(nodes[node], [trigger[:4] for trigger in triggers], segments[node]):
+            unplaced.extend(trigger[4] for trigger in triggers)
+            del assignment[node]
+    for triggers in assignment.values():
+        triggers.sort()
+    return assignment, unplaced
+
+
+def _encode_triggers(triggers):
+    return [[gpio, wave_compiler.format_frequency(frequency), phase, duty, name] for gpio, frequency, phase, duty, name in triggers]
+
+
+def _decode_triggers(triggers):
+    return [(int(gpio), wave_compiler.rational_frequency(frequency), phase, duty, name) for gpio, frequency, phase, duty, name in triggers]
+
+
+class cluster_coordinator(threading.Thread):
+
+    def __init__(self, node, triggers, epoch=0, generator=None, group=GROUP, port=PORT, interface='0.0.0.0', publish_interval=1.0, node_timeout=5.0, lead=2, roll_timeout=10.0):
+        """
+        Thread coordinating the triggers of a cluster, see trigger_specs() for the triggers.
+        node is the name of the coordinator. epoch is the hyperperiod epoch all nodes align their
+        multi-second waves to, and the PPS cycle time estimate of generator, if given, is published.
+        Nodes not reporting for node_timeout seconds are shown as lost, and triggers without a GPIO
+        are only placed node_timeout seconds after the start, once the running nodes reported.
+        A node is given its new triggers to apply lead seconds ahead, and the roll moves on to the
+        next node once it reported them applied with its lock no worse than before, or after
+        roll_timeout seconds.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.node = node
+        self.epoch = epoch
+        self.generator = generator
+        self.group = group
+        self.port = port
+        self.interface = interface
+        self.publish_interval = publish_interval
+        self.node_timeout = node_timeout
+        self.lead = lead
+        self.roll_timeout = roll_timeout
+        self.sock = None
+        self.running = False
+        self.lock = threading.Lock()
+
+        self.specs = []
+        self.nodes = {}                   # Last report of each node, with the time it was received as 'seen'
+        self.placements = {}              # (node, GPIO) of the placed triggers by name
+        self.target = {}                  # Triggers each node should generate
+        self.unplaced = []
+        self.session = int(time.time() * 1000)    # Tells the revisions of a restarted coordinator apart
+        self.revision = 0
+        self.published = {}               # Plan entries of the nodes: revision, UTC second to apply at and triggers
+        self.rolling = []                 # Nodes waiting for their new triggers, in order
+        self.in_flight = None             # (node, time, lock state) of the node applying its new triggers
+        self.started = time.time()
+        self.placing = False              # Whether triggers without a GPIO are placed yet
+        self.set_triggers(triggers)
+
+    def set_triggers(self, triggers):
+        """
+        Sets the triggers of the cluster, rolled out to the nodes one at a time.
+        Raises ValueError if they are invalid.
+        """
+        specs = spread_phases(trigger_specs(triggers))
+        with self.lock:
+            names = set(spec['name'] for spec in specs)
+            for name in list(self.placements):
+                if name not in names:
+                    del self.placements[name]
+            self.specs = specs
+            self.replan()
+
+    def replan(self):
+        """
+        Places the triggers on the known nodes, and queues the nodes whose triggers changed for the roll.
+        """
+        nodes = dict((name, report) for name, report in self.nodes.items() if not self.lost(name))
+        target, self.unplaced = assign(self.specs, nodes, self.placements, self.placing)
+        for name in nodes:
+            if name not in target:
+                target[name] = self.target.get(name, [])
+        changed = sorted(name for name in set(target) | set(self.target) if target.get(name, []) != self.target.get(name, []))
+        if changed:
+            self.revision += 1
+            self.target = target
+            for name in changed:
+                if name not in self.rolling:
+                    self.rolling.append(name)
+            if self.unplaced and self.placing:
+                print ("Cluster triggers not placed: {}".format(", ".join(self.unplaced)))
+
+    def lost(self, node):
+        report = self.nodes.get(node)
+        return report is None or time.time() - report['seen'] > self.node_timeout
+
+    def receive(self, message):
+        """
+        Handles a report of a node.
+        """
+        if message.get('type') != 'report' or not isinstance(message.get('node'), str):
+            return
+        with self.lock:
+            name = message['node']
+            previous = self.nodes.get(name)
+            joined = previous is None or self.lost(name)
+            message['seen'] = time.time()
+            self.nodes[name] = message
+            capacity = ('gpios', 'pps_gpio', 'pps_duty', 'chaining', 'servo', 'hardware_offload', 'hardware_min_frequency', 'hardware_revision', 'synchronized')
+            if joined:
+                print ("Cluster node {} joined".format(name))
+            if joined or any(previous.get(key) != message.get(key) for key in capacity):
+                self.replan()
+
+    def roll(self, now=None):
+        """
+        Gives the next node its new triggers once the node before applied its own, with its output
+        locked as before, or timed out.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            if not self.placing and now - self.started >= self.node_timeout:
+                self.placing = True
+                self.replan()
+            if self.in_flight is not None:
+                node, started, state = self.in_flight
+                report = self.nodes.get(node)
+                applied = (report is not None and report.get('session') == self.session and report.get('revision') == self.published[node]['revision']
+                           and _lock_rank(report.get('state')) >= _lock_rank(state))
+                if not applied and now - started < self.roll_timeout:
+                    return
+                if not applied:
+                    print ("Cluster node {} did not settle on plan revision {}, rolling on".format(node, self.published[node]['revision']))
+                self.in_flight = None
+            while self.rolling:
+                node = self.rolling.pop(0)
+                triggers = self.target.get(node, [])
+                self.published[node] = {'revision': self.revision, 'apply_at': int(now) + self.lead, 'triggers': _encode_triggers(triggers)}
+                if not self.lost(node):
+                    self.in_flight = (node, now, self.nodes[node].get('state'))
+                    break
+
+    def plan_message(self):
+        """
+        Returns the plan as published.
+        """
+        message = {'type': 'plan', 'coordinator': self.node, 'session': self.session, 'revision': self.revision, 'epoch': self.epoch, 'sent': time.time(), 'nodes': self.published}
+        if self.generator is not None:
+            message['cycle_time'] = self.generator.PPS_output_cycle_time
+            if self.generator.timebase.valid():
+                message['second'] = int(round(self.generator.timebase.utc_at(self.generator.PPS_output_tick)))
+        return message
+
+    def status(self):
+        """
+        Returns the state of the cluster: plan revision, triggers not placed, the phase spread of the
+        locked nodes (largest less smallest PPS residual in microseconds), and for every node its lock
+        state, residual, applied plan revision, trigger count and seconds since its last report.
+        """
+        with self.lock:
+            now = time.time()
+            nodes = {}
+            for name, report in self.nodes.items():
+                revision = report.get('revision') if report.get('session') == self.session else None
+                nodes[name] = {'state': 'lost' if self.lost(name) else report.get('state'), 'residual': report.get('residual'), 'revision': revision,
+                               'planned_revision': self.published.get(name, {}).get('revision'), 'triggers': len(self.target.get(name, [])), 'age': now - report['seen']}
+            residuals = [node['residual'] for node in nodes.values() if node['state'] == pps_servo.LOCKED and node['residual'] is not None]
+            return {'revision': self.revision, 'unplaced': list(self.unplaced), 'rolling': [self.in_flight[0]] + self.rolling if self.in_flight else list(self.rolling),
+                    'phase_spread': max(residuals) - min(residuals) if residuals else None, 'nodes': nodes}
+
+    def start(self):
+        """
+        Joins the multicast group and starts coordinating. Raises socket.error if the group cannot be joined.
+        """
+        self.sock = open_socket(self.group, self.port, self.interface)
+        self.running = True
+        threading.Thread.start(self)
+
+    def run(self):
+        next_publish = time.time()
+        lost = set()
+        while self.running:
+            readable, _, _ = select.select([self.sock], [], [], max(0.0, min(0.2, next_publish - time.time())))
+            if readable:
+                for message in _receive(self.sock):
+                    self.receive(message)
+            now = time.time()
+            with self.lock:
+                now_lost = set(name for name in self.nodes if self.lost(name))
+                for name in now_lost - lost:
+                    print ("Cluster node {} lost".format(name))
+                lost = now_lost
+            self.roll(now)
+            if now >= next_publish:
+                next_publish = now + self.publish_interval
+                with self.lock:
+                    message = self.plan_message()
+                _send(self.sock, self.group, self.port, message)
+
+    def stop(self):
+        self.running = False
+        if self.is_alive():
+            self.join(1.0)
+        if self.sock is not None:
+            self.sock.close()
+
+
+class cluster_follower(threading.Thread):
+
+    def __init__(self, generator, node, gpios, group=GROUP, port=PORT, interface='0.0.0.0', report_interval=1.0):
+        """
+        Thread applying the part of the cluster plan for node to a waveform_engine, which then owns
+        all its triggers, and reporting its state. gpios are the GPIOs the coordinator may place triggers on.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.generator = generator
+        self.node = node
+        self.gpios = list(gpios)
+        self.group = group
+        self.port = port
+        self.interface = interface
+        self.report_interval = report_interval
+        self.sock = None
+        self.running = False
+
+        self.pending = None               # Plan entry waiting for its second, its (session, revision) and the epoch
+        self.scheduled = None             # (session, revision) handed to the engine and not applied yet
+        self.applied = (None, None)       # (session, revision) of the applied plan entry
+        self.coordinator = None           # Last plan message
+        self.applied_at = None            # Time the last plan entry was applied
+
+    def receive(self, message):
+        """
+        Handles a plan, keeping the entry of this node until its second comes.
+        """
+        if message.get('type') != 'plan':
+            return
+        self.coordinator = message
+        entry = message.get('nodes', {}).get(self.node)
+        if entry is None:
+            return
+        revision = (message.get('session'), entry.get('revision'))
+        if revision not in (self.applied, self.scheduled):
+            self.pending = (entry, revision, message.get('epoch', 0))
+
+    def apply_pending(self, now=None):
+        """
+        Hands the pending plan entry to the engine half a second before the UTC second it is applied
+        at, so it is applied at the output PPS rising edge starting it.
+        """
+        now = time.time() if now is None else now
+        if self.pending is None or now < self.pending[0].get('apply_at', 0) - 0.5:
+            return
+        entry, revision, epoch = self.pending
+        self.pending = None
+        try:
+            triggers = _decode_triggers(entry['triggers'])
+        except (ValueError, TypeError, KeyError) as e:
+            print ("Cluster plan revision {} not applied: {}".format(revision[1], e))
+            return
+        generator = self.generator
+
+        def change():
+            wanted = dict((gpio, (gpio, frequency, phase, duty)) for gpio, frequency, phase, duty, name in triggers)
+            current = dict((trigger[0], trigger) for trigger in generator.triggers())
+            for gpio in current:
+                if gpio not in wanted:
+                    generator.remove_trigger_gpio(gpio)
+            for gpio, trigger in wanted.items():
+                if current.get(gpio) != trigger:
+                    generator.add_trigger_gpio(*trigger)
+            if generator.hyperperiod_epoch != epoch:
+                generator.set_hyperperiod_epoch(epoch)
+
+        def done(error):
+            if error is None:
+                self.applied = revision
+                self.applied_at = time.time()
+            else:
+                print ("Cluster plan revision {} not applied: {}".format(revision[1], error))
+            self.scheduled = None
+
+        self.scheduled = revision
+        generator.schedule_change(change, done)
+
+    def report(self):
+        """
+        Returns the report of this node.
+        """
+        generator = self.generator
+        residual = generator.PPS_servo.error if generator.PPS_servo is not None else generator.PPS_slack
+        return {'type': 'report', 'node': self.node, 'session': self.applied[0], 'revision': self.applied[1], 'state': generator.lock_state(), 'residual': residual,
+                'offset': generator.PPS_output_offset, 'cycle_time': generator.PPS_output_cycle_time, 'triggers': len(generator.trigger_outputs),
+                'gpios': self.gpios, 'pps_gpio': generator.PPS_output_gpio, 'pps_duty': generator.PPS_duty_cycle_fraction,
+                'chaining': generator.wave_chaining, 'servo': generator.PPS_servo is not None, 'hardware_offload': generator.hardware_offload,
+                'hardware_min_frequency': generator.hardware_min_frequency, 'hardware_revision': generator.hardware_revision,
+                'synchronized': generator.callbacks_set}
+
+    def start(self):
+        """
+        Joins the multicast group and starts following. Raises socket.error if the group cannot be joined.
+        """
+        self.sock = open_socket(self.group, self.port, self.interface)
+        self.running = True
+        threading.Thread.start(self)
+
+    def run(self):
+        next_report = time.time()
+        while self.running:
+            readable, _, _ = select.select([self.sock], [], [], max(0.0, min(0.1, next_report - time.time())))
+            if readable:
+                for message in _receive(self.sock):
+                    self.receive(message)
+            now = time.time()
+            self.apply_pending(now)
+            if now >= next_report:
+                next_report = now + self.report_interval
+                _send(self.sock, self.group, self.port, self.report())
+
+    def stop(self):
+        self.running = False
+        if self.is_alive():
+            self.join(1.0)
+        if self.sock is not None:
+            self.sock.close()
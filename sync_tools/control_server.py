@@ -0,0 +1,354 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  control_server.py
+#
+#  Runtime control of a waveform_engine over a Unix or TCP socket (Python 3).
+#
+#  Requests and replies are JSON objects, one per line:
+#
+#      {"id": 1, "command": "update_trigger", "gpio": 3, "phase": 90}
+#      {"id": 1, "ok": true, "result": {"gpio": 3, "frequency": 10, "phase": 90, "duty": 0.5}}
+#
+#  Changes are not made from the server thread but queued to the engine, which applies all
+#  the changes queued within a PPS period with a single update() at the next output PPS edge.
+#  Replies to changes are sent once they are applied, so requests on one connection are
+#  handled concurrently and a reply can overtake the replies to earlier requests.
+#  Added and changed triggers are first checked with the resource planner, and changes whose
+#  update fails are rolled back together with the others applied with them.
+#  Subscribers are sent lock state changes as {"event": "lock", ...} lines.
+#
+
+import asyncio
+import json
+import os
+import socket
+import threading
+
+import resource_planner
+import telemetry
+import wave_compiler
+
+
+def _gpio(request):
+    gpio = request.get('gpio')
+    if not isinstance(gpio, int) or not 0 <= gpio < 32:
+        raise ValueError('gpio must be an integer from 0 to 31')
+    return gpio
+
+
+def _trigger_settings(request, frequency=None, phase=None, duty=None):
+    # Validated settings of a request, defaulting to the given ones
+    frequency = request.get('frequency', frequency)
+    phase = request.get('phase', phase)
+    duty = request.get('duty', duty)
+    if isinstance(frequency, bool) or not isinstance(frequency, (int, float, str)):
+        raise ValueError('frequency must be a positive number in Hertz, or a fraction such as "30000/1001"')
+    frequency = wave_compiler.rational_frequency(frequency)
+    if not isinstance(phase, (int, float)) or not 0 <= phase <= 360:
+        raise ValueError('phase must be from 0 to 360 degrees')
+    if not isinstance(duty, (int, float)) or not 0 <= duty <= 1:
+        raise ValueError('duty must be a fraction from 0 to 1')
+    return frequency, phase, duty
+
+
+def _trigger_dict(trigger):
+    gpio, frequency, phase, duty = trigger
+    # Whole and decimal frequencies as numbers, others as fraction strings
+    frequency = wave_compiler.format_frequency(frequency)
+    if '/' not in frequency:
+        frequency = json.loads(frequency)
+    return {'gpio': gpio, 'frequency': frequency, 'phase': phase, 'duty': duty}
+
+
+class control_server(threading.Thread):
+
+    def __init__(self, generator, path=None, port=None, host='127.0.0.1', apply_timeout=5.0, poll_interval=0.2):
+        """
+        Thread serving the control protocol for a waveform_engine on a Unix socket at path and/or TCP on host:port.
+        Changes not applied within apply_timeout seconds are reported as pending, and stay queued.
+        The lock state is checked every poll_interval seconds while there are subscribers.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.generator = generator
+        self.path = path
+        self.port = port
+        self.host = host
+        self.apply_timeout = apply_timeout
+        self.poll_interval = poll_interval
+        self.loop = None
+        self.servers = []
+        self.connections = {}       # Connection tasks by stream writer
+        self.subscribers = set()
+        self.lock_state = None
+        self.watcher = None
+        self.started = threading.Event()
+        self.error = None
+
+        self.commands = {
+            'state': self.state,
+            'statistics': self.statistics,
+            'triggers': self.triggers,
+            'add_trigger': self.add_trigger,
+            'remove_trigger': self.remove_trigger,
+            'update_trigger': self.update_trigger,
+            'subscribe': self.subscribe,
+            'unsubscribe': self.unsubscribe,
+        }
+
+    def start(self):
+        """
+        Starts the server thread, and returns once it listens. Raises the error if it could not.
+        """
+        threading.Thread.start(self)
+        self.started.wait()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.listen())
+        except (OSError, socket.error) as e:
+            self.error = e
+        self.started.set()
+        if self.error is None:
+            self.loop.run_forever()
+        self.loop.close()
+
+    def stop(self):
+        if self.loop is not None and self.is_alive():
+            self.loop.call_soon_threadsafe(lambda: self.loop.create_task(self.close()))
+            self.join(2.0)
+
+    async def listen(self):
+        if self.path is not None:
+            if os.path.exists(self.path):
+                os.remove(self.path)    # Left over by an earlier run
+            self.servers.append(await asyncio.start_unix_server(self.connection, path=self.path))
+        if self.port is not None:
+            self.servers.append(await asyncio.start_server(self.connection, self.host, self.port))
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        if self.watcher is not None:
+            self.watcher.cancel()
+        # Closing the connections ends their reads
+        for writer in list(self.connections):
+            writer.close()
+        await asyncio.gather(*self.connections.values(), return_exceptions=True)
+        self.loop.stop()
+
+    async def connection(self, reader, writer):
+        self.connections[writer] = asyncio.current_task()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                task = self.loop.create_task(self.request(writer, line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            del self.connections[writer]
+            self.subscribers.discard(writer)
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def request(self, writer, line):
+        reply = {}
+        try:
+            request = json.loads(line.decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError('requests must be JSON objects')
+            reply['id'] = request.get('id')
+            command = self.commands.get(request.get('command'))
+            if command is None:
+                raise ValueError('unknown command %r' % request.get('command'))
+            result = command(request, writer)
+            if asyncio.iscoroutine(result):
+                result = await result
+            reply.update(ok=True, result=result)
+        except (ValueError, KeyError, TypeError) as e:
+            reply.update(ok=False, error=str(e))
+        self.send(writer, reply)
+
+    def send(self, writer, message):
+        if not writer.is_closing():
+            writer.write((json.dumps(message, default=str) + '\n').encode('utf-8'))
+
+    async def change(self, change):
+        """
+        Queues a change to the engine and waits until it is applied.
+        """
+        future = self.loop.create_future()
+
+        def done(error):
+            def resolve():
+                if not future.done():
+                    future.set_result(error)
+            self.loop.call_soon_threadsafe(resolve)
+
+        self.generator.schedule_change(change, done)
+        try:
+            error = await asyncio.wait_for(asyncio.shield(future), self.apply_timeout)
+        except asyncio.TimeoutError:
+            raise ValueError('change queued but not applied within %.1f s' % self.apply_timeout)
+        if error is not None:
+            raise ValueError(str(error))
+
+    async def check_plan(self, gpio, frequency, phase, duty):
+        """
+        Plans the triggers with the given settings of one, as run_sync.py plans a reloaded configuration,
+        and raises ValueError with the problems if they do not fit.
+        """
+        triggers = [trigger for trigger in self.generator.triggers() if trigger[0] != gpio] + [(gpio, frequency, phase, duty)]
+        plan = await self.loop.run_in_executor(None, resource_planner.engine_plan, self.generator, triggers)
+        if not plan.fits():
+            raise ValueError('configuration does not fit: %s' % '; '.join(plan.problems))
+
+    # -----------------------------------------------------------------
+    # Commands
+    # -----------------------------------------------------------------
+
+    def state(self, request, writer):
+        generator = self.generator
+        state, periods, estimated_error, measured_error = generator.holdover_status()
+        first_edge, lock = generator.startup_times()
+        return {
+            'lock': generator.lock_state(),
+            'synchronized': generator.callbacks_set,
+            'PPS_input_gpio': generator.PPS_input_gpio,
+            'PPS_output_gpio': generator.PPS_output_gpio,
+            'cycle_time': generator.PPS_output_cycle_time,
+            'offset': generator.PPS_output_offset,
+            'slack': generator.PPS_slack,
+            'servo_error': generator.PPS_servo.error if generator.PPS_servo is not None else None,
+            'holdover': {'state': state, 'periods': periods, 'estimated_error': estimated_error, 'measured_error': measured_error},
+            'rebuilds': generator.rebuild_count,
+            'switch_latency': generator.switch_latency,
+            'startup': {'first_edge': first_edge, 'lock': lock},
+            'pending_changes': len(generator.pending_changes),
+            'triggers': self.triggers(request, writer),
+            'paths': dict((str(gpio), path) for gpio, path in generator.output_paths().items()),
+        }
+
+    def statistics(self, request, writer):
+        return telemetry.statistics(self.generator.telemetry, self.generator.PPS_output_cycle_time)
+
+    def triggers(self, request, writer):
+        return [_trigger_dict(trigger) for trigger in self.generator.triggers()]
+
+    async def add_trigger(self, request, writer):
+        gpio = _gpio(request)
+        if gpio in (self.generator.PPS_input_gpio, self.generator.PPS_output_gpio):
+            raise ValueError('GPIO%d is used for the PPS' % gpio)
+        frequency, phase, duty = _trigger_settings(request, phase=0, duty=0.5)
+        await self.check_plan(gpio, frequency, phase, duty)
+        await self.change(lambda: self.generator.add_trigger_gpio(gpio, frequency, phase, duty))
+        return _trigger_dict((gpio, frequency, phase, duty))
+
+    async def remove_trigger(self, request, writer):
+        gpio = _gpio(request)
+        if gpio not in self.generator.trigger_outputs:
+            raise ValueError('no trigger on GPIO%d' % gpio)
+        await self.change(lambda: self.generator.remove_trigger_gpio(gpio))
+        return {'gpio': gpio}
+
+    async def update_trigger(self, request, writer):
+        gpio = _gpio(request)
+        trigger = self.generator.trigger_outputs.get(gpio)
+        if trigger is None:
+            raise ValueError('no trigger on GPIO%d' % gpio)
+        frequency, phase, duty = _trigger_settings(request, trigger.frequency, trigger.phase, trigger.duty)
+        await self.check_plan(gpio, frequency, phase, duty)
+
+        def change():
+            if gpio not in self.generator.trigger_outputs:
+                raise ValueError('no trigger on GPIO%d' % gpio)
+            self.generator.update_trigger_gpio_frequency(gpio, frequency)
+            self.generator.update_trigger_gpio_phase(gpio, phase)
+            self.generator.update_trigger_gpio_duty(gpio, duty)
+        await self.change(change)
+        return _trigger_dict((gpio, frequency, phase, duty))
+
+    def subscribe(self, request, writer):
+        self.subscribers.add(writer)
+        if self.watcher is None or self.watcher.done():
+            self.lock_state = self.generator.lock_state()
+            self.watcher = self.loop.create_task(self.watch())
+        return {'lock': self.lock_state}
+
+    def unsubscribe(self, request, writer):
+        self.subscribers.discard(writer)
+        return None
+
+    async def watch(self):
+        """
+        Sends lock state changes to the subscribers, for as long as there are any.
+        """
+        while self.subscribers:
+            await asyncio.sleep(self.poll_interval)
+            state = self.generator.lock_state()
+            if state != self.lock_state:
+                event = {'event': 'lock', 'state': state, 'previous': self.lock_state, 'tick': self.generator.PPS_output_tick}
+                if self.generator.timebase.valid():
+                    event['time'] = self.generator.timebase.utc_at(self.generator.PPS_output_tick)
+                self.lock_state = state
+                for writer in list(self.subscribers):
+                    self.send(writer, event)
+
+
+def send_command(command, path=None, port=None, host='127.0.0.1', timeout=10.0, **parameters):
+    """
+    Sends one command to a control server and returns its result. Raises ValueError with the error of a failed command.
+    """
+    if path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = path
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        address = (host, port)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+        request = dict(parameters, id=1, command=command)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        stream = sock.makefile('rb')
+        while True:
+            line = stream.readline()
+            if not line:
+                raise ValueError('connection closed')
+            reply = json.loads(line.decode('utf-8'))
+            if reply.get('id') == 1:
+                break
+    finally:
+        sock.close()
+    if not reply.get('ok'):
+        raise ValueError(reply.get('error'))
+    return reply.get('result')
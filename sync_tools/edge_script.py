@@ -0,0 +1,262 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  edge_script.py
+#
+#  Times the input and output PPS rising edges with a script running inside pigpiod, instead of
+#  a pigpio callback per edge, and polls the results from a thread.
+#
+#  Scripts cannot read the tick of a sampled level change, and a script woken by WAIT runs up to
+#  a millisecond after the change, so the script predicts each edge from the last one and the
+#  period, sleeps until a guard time before it and then reads the levels in a tight loop until it
+#  rises. Edges found that way are timed to half a loop iteration, a few microseconds. An edge missed
+#  by its window, as after an offset step of the output or while the input is lost, is searched
+#  for by reading the levels every search interval, and the first edge found is only used to
+#  predict the next one, from the read before it, so the search interval has to be shorter than
+#  the guard.
+#
+#  The script keeps the last edges in its parameters, which script_status() returns together:
+#
+#    p0  period in microseconds         p5  input edges timed
+#    p1  guard in microseconds          p6  tick of the last input edge
+#    p2  search interval                p7  output edges timed
+#    p3  input GPIO bit                 p8  tick of the last output edge
+#    p4  output GPIO bit                p9  slack, last output edge less last input edge
+#
+#  p0 to p2 are updated by update_script() while it runs. The count of each edge is written
+#  after its tick, so a new count always comes with its tick.
+#
+
+import threading
+import time
+
+import pigpio
+
+import timebase
+
+# Variables: v0 mask of both GPIOs, v1 levels of the last read, v2 tick of this read,
+# v3 rising edges, v4 and v5 input edge predicted and its predicted tick, v6 and v7 the same
+# for the output, v8 delay, v9 levels of this read, v10 tick of the last read, v11 spin end,
+# v12 rising edges seen while spinning, v13 and v14 ticks of the read seeing the last input
+# edge and of the read before, v15 and v16 the same for the output.
+# While spinning, edges are only recorded, so one edge does not delay the reads timing the other,
+# and the spin ends 100 microseconds after the last edge. An edge counts as timed if it was
+# predicted, and seen by a read less than 20 microseconds after one inside its window. It is
+# timed halfway between the two reads.
+SCRIPT = '''
+    lda p3 or p4 sta v0
+    br1 and v0 sta v1
+    tick sta v2
+    lda 0 sta v4 sta v6 sta v12
+
+tag 1
+    lda v2 sta v10
+    tick sta v2
+    br1 and v0 sta v9
+    lda v1 xor v0 and v9 sta v3
+    lda v9 sta v1
+    lda v3 and p3 jz 2
+    lda v2 sta v13
+    lda v10 sta v14
+tag 2
+    lda v3 and p4 jz 3
+    lda v2 sta v15
+    lda v10 sta v16
+tag 3
+    lda v3 or v12 sta v3
+    lda 0 sta v12
+
+    lda v3 and p3 jz 10
+    lda v4 jz 11
+    lda v14 sub v5 add p1 jm 11
+    lda v13 sub v14 sub 20 jp 11
+    lda v13 sub v14 div 2 add v14 sta p6
+    lda p5 add 1 sta p5
+tag 11
+    lda v14 add p0 sta v5
+    lda 1 sta v4
+    jmp 12
+tag 10
+    lda v4 jz 12
+    lda v2 sub v5 sub p1 jm 12
+    lda 0 sta v4
+tag 12
+
+    lda v3 and p4 jz 20
+    lda v6 jz 21
+    lda v16 sub v7 add p1 jm 21
+    lda v15 sub v16 sub 20 jp 21
+    lda v15 sub v16 div 2 add v16 sta p8 sub p6 sta p9
+    lda p7 add 1 sta p7
+tag 21
+    lda v16 add p0 sta v7
+    lda 1 sta v6
+    jmp 22
+tag 20
+    lda v6 jz 22
+    lda v2 sub v7 sub p1 jm 22
+    lda 0 sta v6
+tag 22
+
+    lda 1000000 sta v8
+    lda p2 sta v9
+    lda v4 jz 30
+    lda v5 sub p1 sub v2 sta v9
+tag 30
+    lda v9 sub v8 jp 31
+    lda v9 sta v8
+tag 31
+    lda p2 sta v9
+    lda v6 jz 32
+    lda v7 sub p1 sub v2 sta v9
+tag 32
+    lda v9 sub v8 jp 33
+    lda v9 sta v8
+tag 33
+    lda v8 jm 40 jz 40
+    mics v8
+    jmp 1
+
+tag 40
+    lda v2 add p1 add p1 sta v11
+tag 41
+    lda v2 sta v10
+    tick sta v2
+    br1 and v0 sta v9
+    xor v1 jnz 42
+    lda v2 sub v11 jm 41
+    jmp 1
+tag 42
+    lda v1 xor v0 and v9 sta v3
+    lda v9 sta v1
+    lda v3 jz 41
+    or v12 sta v12
+    lda v2 add 100 sta v11
+    lda v3 and p3 jz 43
+    lda v2 sta v13
+    lda v10 sta v14
+tag 43
+    lda v3 and p4 jz 41
+    lda v2 sta v15
+    lda v10 sta v16
+    jmp 41
+'''
+
+
+class edge_script(threading.Thread):
+
+    def __init__(self, pi, input_gpio, output_gpio, callback, period=1000000, guard=1000, search_interval=500, poll_interval=0.2):
+        """
+        Thread polling the PPS rising edges timed by a pigpiod script on input_gpio and output_gpio,
+        and handing them to callback(gpio, level, tick) like pigpio callbacks, oldest first.
+        period is the expected PPS period and guard the time before an expected edge the script
+        starts reading the levels, both in microseconds. Edges further than the guard from where
+        they were expected are found by reading every search_interval microseconds.
+        Edges are polled every poll_interval seconds; edges replaced in the script before a poll
+        are lost and counted. With poll_interval None, no thread is started and poll() is called
+        by the owner, as on the simulated backend.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pi = pi
+        self.input_gpio = input_gpio
+        self.output_gpio = output_gpio
+        self.callback = callback
+        self.period = int(round(period))
+        self.guard = guard
+        self.search_interval = search_interval
+        self.poll_interval = poll_interval
+        self.script_id = None
+        self.wake = threading.Event()
+        self.running = False
+
+        self.input_count = 0
+        self.output_count = 0
+        self.slack = None                 # Slack of the last output edge as computed by the script, in microseconds
+        self.lost_edges = 0
+        self.polls = 0
+
+    def start(self):
+        """
+        Stores and runs the script, and starts polling it.
+        Raises pigpio.error if pigpiod cannot run it.
+        """
+        self.script_id = self.pi.store_script(SCRIPT.encode('ascii'))
+        if self.script_id < 0:
+            error, self.script_id = self.script_id, None
+            raise pigpio.error(pigpio.error_text(error))
+        # The script is checked by pigpiod before it can run
+        while self.pi.script_status(self.script_id)[0] == pigpio.PI_SCRIPT_INITING:
+            time.sleep(0.001)
+        self.pi.run_script(self.script_id, [self.period, self.guard, self.search_interval, 1 << self.input_gpio, 1 << self.output_gpio, 0, 0, 0, 0, 0])
+        self.running = True
+        if self.poll_interval is not None:
+            threading.Thread.start(self)
+
+    def set_period(self, period):
+        """
+        Sets the expected PPS period in microseconds. The script is only updated when the change
+        matters against the guard.
+        """
+        period = int(round(period))
+        if self.script_id is not None and abs(period - self.period) > self.guard / 4:
+            self.period = period
+            self.pi.update_script(self.script_id, [self.period, self.guard, self.search_interval])
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.poll_interval)
+            if self.running:
+                self.poll()
+
+    def poll(self):
+        """
+        Reads the script parameters and hands over the edges timed since the last poll.
+        Returns the number of edges handed over.
+        """
+        status, params = self.pi.script_status(self.script_id)
+        self.polls += 1
+        if status < 0 or len(params) < 10:
+            return 0
+        edges = []
+        input_count, output_count = params[5], params[7]
+        if input_count != self.input_count:
+            self.lost_edges += (input_count - self.input_count - 1) & timebase.TICK_MASK
+            self.input_count = input_count
+            edges.append((params[6] & timebase.TICK_MASK, self.input_gpio))
+        if output_count != self.output_count:
+            self.lost_edges += (output_count - self.output_count - 1) & timebase.TICK_MASK
+            self.output_count = output_count
+            self.slack = params[9]
+            edges.append((params[8] & timebase.TICK_MASK, self.output_gpio))
+        if len(edges) == 2 and timebase.tick_diff(edges[0][0], edges[1][0]) < 0:
+            edges.reverse()
+        for tick, gpio in edges:
+            self.callback(gpio, 1, tick)
+        return len(edges)
+
+    def stop(self):
+        """
+        Stops polling, then stops and deletes the script.
+        """
+        self.running = False
+        self.wake.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(1.0)
+        if self.script_id is not None:
+            self.pi.stop_script(self.script_id)
+            self.pi.delete_script(self.script_id)
+            self.script_id = None
@@ -0,0 +1,156 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  hardware_outputs.py
+#
+#  Placement of triggers on the hardware PWM and general purpose clock (GPCLK) outputs.
+#
+#  A trigger on a pin with PWM or clock hardware can be generated by the peripheral instead
+#  of the DMA wave, which takes its edges out of the wave. The peripherals run from the same
+#  crystal as the pigpio tick, so an output started at the right tick keeps its phase to the
+#  tick, and drifts from the PPS by the frequency offset of the crystal (and the frequency
+#  quantization of the peripheral). The engine checks the phase of every hardware output at
+#  each output PPS edge and restarts it, timed onto the wanted edge, when it drifts too far.
+#
+#  Starting or stopping hardware PWM cancels the DMA wave, losing the edges of every output in
+#  the wave until it is resumed, so PWM is only used where it would need a restart less often
+#  than a set interval: when the output PPS runs from the Pi oscillator and the PWM frequency is
+#  close enough to the trigger frequency. Synchronized to an input PPS, the crystal offset (a few
+#  ppm, against the 0.1 ppm that drifts 50 microseconds in 10 minutes) would restart it every few
+#  seconds, so PWM pins stay in the wave. Clocks do not affect the wave and are always used.
+#
+
+import math
+
+WAVE = 'wave'
+PWM = 'pwm'
+CLOCK = 'clock'
+
+PWM_CHANNELS = {12: 0, 18: 0, 13: 1, 19: 1}      # GPIO: PWM channel
+CLOCK_CHANNELS = {4: 0, 20: 0, 6: 2}              # GPIO: GPCLK, clock 1 (GPIO5 and 21) is reserved for system use
+
+MAX_FREQUENCY_ERROR = 5e-6      # Largest relative frequency quantization error of a PWM output
+MIN_PWM_RESTART_INTERVAL = 600.0    # Shortest expected time between the restarts of a PWM output, which cancel the wave, in seconds
+
+
+def peripheral_limits(revision):
+    """
+    Returns (PWM base frequency, minimum clock frequency) in Hertz for a hardware revision code
+    as returned by pigpio's get_hardware_revision().
+    """
+    # New style revision codes hold the processor in bits 12 to 15, 3 being the BCM2711 of the Pi 4
+    if revision & (1 << 23) and (revision >> 12) & 0xF == 3:
+        return 375000000, 13184
+    return 250000000, 4689
+
+
+def pwm_frequency(frequency, base=250000000):
+    """
+    Returns the frequency hardware PWM actually runs at when asked for frequency, as the number of
+    steps in a cycle is the integral part of the base frequency divided by it.
+    """
+    return float(base) / int(base // frequency)
+
+
+class hardware_output(object):
+    __slots__ = ('gpio', 'kind', 'frequency', 'phase', 'duty', 'actual_frequency', 'reference_tick', 'reference_phase', 'phase_error')
+
+    def __init__(self, gpio, kind, frequency, phase, duty, actual_frequency):
+        """
+        A trigger generated by a peripheral.
+        reference_phase is the time from the last rising edge to reference_tick in microseconds,
+        and phase_error how late its edges were at the last check.
+        """
+        self.gpio = gpio
+        self.kind = kind
+        self.frequency = frequency
+        self.phase = phase
+        self.duty = duty
+        self.actual_frequency = actual_frequency
+        self.reference_tick = None
+        self.reference_phase = 0.0
+        self.phase_error = None
+
+    def settings(self):
+        return (self.gpio, self.frequency, self.phase, self.duty)
+
+
+def restart_interval(frequency, actual_frequency, crystal_ppm=0.0, tolerance=50.0):
+    """
+    Returns the seconds a hardware output running at actual_frequency takes to drift tolerance
+    microseconds (or a quarter period) from the edges wanted at frequency, when the PPS runs
+    crystal_ppm off the Pi oscillator the output runs from.
+    """
+    drift = abs((actual_frequency / frequency - 1.0) * 1e6 - crystal_ppm)
+    tolerance = min(tolerance, 250000.0 / frequency)
+    return tolerance / drift if drift else float('inf')
+
+
+def place(triggers, min_frequency, revision=0, reserved=(), crystal_ppm=0.0, tolerance=50.0, min_pwm_restart_interval=MIN_PWM_RESTART_INTERVAL):
+    """
+    Returns {gpio: (kind, actual frequency)} for the triggers, given as (gpio, frequency, phase, duty),
+    to generate by hardware. Triggers below min_frequency stay in the wave, as do those on a PWM channel
+    or clock already taken by a faster trigger, and those PWM cannot run close enough to their frequency.
+    Clocks only have a 50% duty cycle, and frequencies that are not whole stay in the wave.
+    reserved are GPIOs whose peripheral must not be used.
+    PWM is only used where, with the PPS crystal_ppm off the Pi oscillator, its phase would drift
+    beyond tolerance microseconds less often than every min_pwm_restart_interval seconds, as each
+    restart cancels the wave. crystal_ppm is None when unknown, as when synchronizing to an input PPS,
+    which keeps PWM pins in the wave unless min_pwm_restart_interval is 0.
+    """
+    pwm_base, clock_min = peripheral_limits(revision)
+    placement = {}
+    used = set()
+    for gpio, frequency, phase, duty in sorted(triggers, key=lambda trigger: -trigger[1]):
+        if frequency < min_frequency or frequency != int(frequency) or not 0 < duty < 1 or gpio in reserved:
+            continue
+        if gpio in CLOCK_CHANNELS and duty == 0.5 and frequency >= clock_min and (CLOCK, CLOCK_CHANNELS[gpio]) not in used:
+            placement[gpio] = (CLOCK, float(frequency))
+            used.add((CLOCK, CLOCK_CHANNELS[gpio]))
+        elif gpio in PWM_CHANNELS and (PWM, PWM_CHANNELS[gpio]) not in used:
+            actual = pwm_frequency(frequency, pwm_base)
+            if min_pwm_restart_interval > 0 and (crystal_ppm is None or restart_interval(frequency, actual, crystal_ppm, tolerance) < min_pwm_restart_interval):
+                continue
+            if abs(actual / frequency - 1.0) <= MAX_FREQUENCY_ERROR:
+                placement[gpio] = (PWM, actual)
+                used.add((PWM, PWM_CHANNELS[gpio]))
+    return placement
+
+
+def phase_error(output, tick_delta, cycle_time):
+    """
+    Advances the reference of a hardware output by tick_delta microseconds to a PPS rising edge,
+    and returns how late its edges are from those wanted with the PPS cycle time, in microseconds.
+    """
+    period = 1000000.0 / output.actual_frequency
+    output.reference_phase = (output.reference_phase + tick_delta) % period
+    wanted_period = cycle_time / output.frequency
+    wanted = (-wanted_period * output.phase / 360.0) % wanted_period
+    error = (wanted - output.reference_phase) % wanted_period
+    if error >= wanted_period / 2:
+        error -= wanted_period
+    return error
+
+
+def next_edge(PPS_tick_delta, cycle_time, frequency, phase, lead):
+    """
+    Returns the time of the first wanted rising edge of a trigger at least lead microseconds ahead,
+    relative to now, given the time from the last PPS rising edge to now in PPS_tick_delta.
+    """
+    period = cycle_time / frequency
+    first = period * phase / 360.0
+    count = math.ceil((PPS_tick_delta + lead - first) / period)
+    return first + count * period - PPS_tick_delta
@@ -0,0 +1,216 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  holdover.py
+#
+#  Oscillator model for holding the output PPS over input PPS outages.
+#
+#  The ticks of the input PPS edges are kept in a fixed size ring buffer. When the input
+#  is lost, a line is fitted through them (edge tick against edge count), giving the period
+#  of the Pi oscillator in ticks. Over a history long enough to resolve it, a quadratic also
+#  gives its drift rate, kept only when it stands out of the edge jitter, as a drift fitted to
+#  noise grows quadratically when extrapolated. The model predicts the input edges during the
+#  outage, and the covariance of the fit with the jitter of the edges gives the expected error
+#  of those predictions.
+#
+
+import numpy as np
+
+import timebase
+
+TRACKING = 'tracking'
+HOLDOVER = 'holdover'
+REACQUIRING = 'reacquiring'
+
+
+class holdover_model:
+
+    def __init__(self, capacity=7200, min_edges=30, drift_span=300, nominal_cycle_time=1000000.0, loss_timeout=1.5, tolerance=1000.0):
+        """
+        capacity is the number of input edges kept, two hours at 1 Hz by default.
+        The period is only fitted with min_edges or more, otherwise the last period is held, and
+        the drift rate only over edges spanning drift_span periods or more.
+        The input is considered lost when an output edge comes more than loss_timeout periods after
+        the last input edge. While tracking, input edges further than tolerance microseconds from a
+        whole number of periods after the previous one are ignored.
+        """
+        self.capacity = capacity
+        self.min_edges = min_edges
+        self.drift_span = drift_span
+        self.nominal_cycle_time = nominal_cycle_time
+        self.loss_timeout = loss_timeout
+        self.tolerance = tolerance
+
+        self.indices = np.zeros(capacity, dtype=np.int64)     # Edge counts since the first edge
+        self.ticks = np.zeros(capacity, dtype=np.int64)       # Edge ticks extended to 64 bits
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the edge history.
+        """
+        self.count = 0
+        self.head = 0
+        self.last_tick = None
+        self.last_index = 0
+        self.last_extended = 0
+        self.state = TRACKING
+        self.model = None                  # (coefficients, covariance) of the quadratic fitted at the last loss
+        self.jitter = 0.0                  # RMS residual of the edges around the fit
+        self.reference = None              # (tick, extended tick) followed through an outage, as ticks wrap
+        self.outages = 0
+        self.holdover_periods = 0          # Length of the last outage in periods
+        self.estimated_error = 0.0         # Expected error of the last predicted edge in microseconds
+        self.measured_error = None         # Error of the prediction found when the input came back
+
+    def period(self):
+        """
+        Returns the mean period of the last input edges in ticks.
+        """
+        if self.count < 2:
+            return self.nominal_cycle_time
+        newest = (self.head - 1) % self.capacity
+        oldest = (self.head - min(self.count, 8)) % self.capacity
+        return float(self.ticks[newest] - self.ticks[oldest]) / (self.indices[newest] - self.indices[oldest])
+
+    def add_edge(self, tick):
+        """
+        Adds an input PPS rising edge.
+        Returns False if it does not line up with the previous edges.
+        """
+        if self.last_tick is None:
+            index, extended = 0, tick
+        elif self.state == HOLDOVER:
+            # The edge count over the outage comes from the model, which is more accurate than the period
+            extended = self._extend(tick)
+            index = self.last_index + int(round(self._elapsed(extended)))
+            self.measured_error = float(extended - self._predict(index - self.last_index))
+            self.state = REACQUIRING
+        else:
+            interval = timebase.tick_diff(self.last_tick, tick)
+            periods = int(round(interval / self.period()))
+            if periods < 1 or abs(interval - periods * self.period()) > self.tolerance:
+                return False
+            index, extended = self.last_index + periods, self.last_extended + interval
+
+        self.indices[self.head] = index
+        self.ticks[self.head] = extended
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.last_tick = tick
+        self.last_index = index
+        self.last_extended = extended
+        return True
+
+    def lost(self, tick):
+        """
+        Returns True if no input edge came in time for an output edge at the given tick.
+        """
+        if self.state == HOLDOVER:
+            return True
+        if self.last_tick is None:
+            return False
+        return timebase.tick_diff(self.last_tick, tick) > self.loss_timeout * self.period()
+
+    def fit(self):
+        """
+        Fits the oscillator model to the edge history, relative to the last input edge.
+        """
+        count = self.count
+        order = (np.arange(count) + self.head - count) % self.capacity
+        indices = (self.indices[order] - self.last_index).astype(float)
+        ticks = (self.ticks[order] - self.last_extended).astype(float)
+        coefficients, covariance = np.array([0.0, self.period(), 0.0]), np.zeros((3, 3))
+        self.jitter = 0.0
+        if count >= self.min_edges:
+            linear, linear_covariance = np.polyfit(indices, ticks, 1, cov=True)
+            coefficients[1:] = linear
+            covariance[1:, 1:] = linear_covariance
+            degree = 1
+            if indices[-1] - indices[0] >= self.drift_span:
+                quadratic, quadratic_covariance = np.polyfit(indices, ticks, 2, cov=True)
+                if abs(quadratic[0]) > 3.0 * np.sqrt(quadratic_covariance[0, 0]):
+                    coefficients, covariance = quadratic, quadratic_covariance
+                    degree = 2
+            residuals = ticks - np.polyval(coefficients, indices)
+            self.jitter = float(np.sqrt(np.sum(residuals * residuals) / max(1, count - degree - 1)))
+        self.model = (coefficients, covariance)
+
+    def frequency_offset(self):
+        """
+        Returns the fitted frequency offset of the Pi oscillator against the input in parts per million.
+        """
+        return (self.model[0][1] / self.nominal_cycle_time - 1.0) * 1e6
+
+    def drift_rate(self):
+        """
+        Returns the fitted drift of the frequency offset in parts per million per hour.
+        """
+        return 2 * self.model[0][0] / self.nominal_cycle_time * 1e6 * 3600.0 * 1e6 / self.nominal_cycle_time
+
+    def start(self, tick):
+        """
+        Starts holding over after the input was lost.
+        """
+        self.fit()
+        self.state = HOLDOVER
+        self.reference = (self.last_tick, self.last_extended)
+        self.outages += 1
+        self.holdover_periods = 0
+        self.estimated_error = 0.0
+        self.measured_error = None
+
+    def reacquired(self):
+        """
+        Returns to tracking once the output has been slewed back onto the input.
+        """
+        self.state = TRACKING
+
+    def predict_edge(self, tick):
+        """
+        Returns (predicted input edge tick, modelled period in ticks) for the input edge closest to a
+        tick during holdover, and updates the error estimate.
+        """
+        extended = self._extend(tick)
+        periods = int(round(self._elapsed(extended)))
+        self.holdover_periods = periods
+        self.estimated_error = self._error(periods)
+        coefficients = self.model[0]
+        edge = int(round(self._predict(periods)))
+        return (self.reference[0] + edge - self.reference[1]) & timebase.TICK_MASK, 2 * coefficients[0] * periods + coefficients[1]
+
+    def _extend(self, tick):
+        # Follows the ticks from one call to the next, so outages may be longer than the tick wrap
+        extended = self.reference[1] + timebase.tick_diff(self.reference[0], tick)
+        self.reference = (tick, extended)
+        return extended
+
+    def _elapsed(self, extended):
+        # Periods from the last input edge to an extended tick, by the model
+        coefficients = self.model[0]
+        elapsed = float(extended - self.last_extended) - coefficients[2]
+        return elapsed / (coefficients[1] + coefficients[0] * elapsed / coefficients[1])
+
+    def _predict(self, periods):
+        # Extended tick of the input edge the given number of periods after the last one, by the
+        # fit rather than from the last edge, which is off by its jitter
+        return self.last_extended + float(np.polyval(self.model[0], periods))
+
+    def _error(self, periods):
+        # One sigma error of a measured edge against its prediction, from the uncertainty of the
+        # fitted drift, period and intercept and the jitter of the edge
+        jacobian = np.array([periods * periods, periods, 1.0])
+        return float(np.sqrt(max(0.0, jacobian.dot(self.model[1]).dot(jacobian)) + self.jitter * self.jitter))
@@ -0,0 +1,498 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  lidar_phase.py
+#
+#  Locks the trigger phases of cameras to the rotation of a Velodyne LiDAR, so each camera
+#  exposes while the LiDAR sweeps its field of view, whatever the rotation phase and speed.
+#
+#  Every data packet carries the azimuth of its first firing and the time of that firing in
+#  microseconds past the hour, by the LiDAR clock, which is synchronized to the same PPS as the
+#  outputs (see position packets). Packets are read into a buffer and parsed in batches as a
+#  NumPy structured array. A least squares fit of the unwrapped azimuths against the timestamps
+#  of a batch gives the rotation rate, which is smoothed over batches, and every packet then
+#  gives the time within the second the LiDAR next points at each camera. Those times, taken
+#  modulo the camera period, are averaged as angles into the trigger phase of each camera.
+#  Phases are handed to the engine through waveform_engine.schedule_change() when the azimuth
+#  the LiDAR points at during the exposure is off by more than a tolerance of the field of view,
+#  at most once per interval, so the wave is not rebuilt for noise.
+#
+#  Velodyne packets (VLP-16, VLP-32C, HDL-32E, all little endian):
+#
+#    data      1206 bytes: 12 blocks of 0xFFEE, azimuth in hundredths of degree and 32 returns
+#              (distance, reflectivity), then the timestamp (uint32) and two factory bytes
+#    position  512 bytes: timestamp at byte 198, PPS status at byte 202 (0 absent, 1 synchronizing,
+#              2 locked, 3 error) and the NMEA sentence from byte 206
+#
+#  synthetic_packets(), position_packet() and packet_replayer make a local stand-in for the LiDAR.
+#
+
+import math
+import select
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+import wave_compiler
+
+BLOCK = np.dtype([('flag', '<u2'), ('azimuth', '<u2'), ('returns', [('distance', '<u2'), ('reflectivity', 'u1')], (32,))])
+DATA_PACKET = np.dtype([('blocks', BLOCK, (12,)), ('timestamp', '<u4'), ('return_mode', 'u1'), ('product', 'u1')])
+POSITION_PACKET_SIZE = 512
+
+BLOCK_FLAG = 0xEEFF             # Bytes 0xFF 0xEE read little endian
+HOUR = 3600000000               # Timestamps are in microseconds past the hour
+MAX_GAP = 20000                 # Longest packet gap the azimuth is unwrapped across, in microseconds
+
+PPS_ABSENT = 0
+PPS_SYNCHRONIZING = 1
+PPS_LOCKED = 2
+PPS_ERROR = 3
+
+DATA_PORT = 2368
+POSITION_PORT = 8308
+
+
+class lidar_camera(object):
+    __slots__ = ('gpio', 'azimuth', 'fov', 'delay')
+
+    def __init__(self, gpio, azimuth, fov, delay=0.0):
+        """
+        A camera triggered on gpio, mounted facing azimuth with a horizontal field of view of fov,
+        both in degrees in the LiDAR frame (clockwise from its front seen from above). delay is the
+        time from the trigger edge to the middle of the exposure in microseconds.
+        """
+        self.gpio = gpio
+        self.azimuth = azimuth % 360
+        self.fov = fov
+        self.delay = delay
+
+
+def _settings(camera):
+    return (camera.gpio, camera.azimuth, camera.fov, camera.delay)
+
+
+def parse_data(buffer, count=None):
+    """
+    Returns count Velodyne data packets stored back to back in buffer as a DATA_PACKET array,
+    without copying.
+    """
+    return np.frombuffer(buffer, DATA_PACKET, count=-1 if count is None else count)
+
+
+def parse_position(data):
+    """
+    Returns the (timestamp, PPS status) of a Velodyne position packet, or None if it is not one.
+    """
+    if len(data) != POSITION_PACKET_SIZE:
+        return None
+    timestamp, status = struct.unpack_from('<IB', data, 198)
+    return timestamp, status
+
+
+def fit_rotation(timestamps, azimuths):
+    """
+    Fits the rotation of the LiDAR to packets, given as int64 arrays of timestamps in microseconds
+    past the hour and azimuths in hundredths of degrees. Returns the rotation rate in degrees per
+    microsecond, or None if the packets are too few or too far apart to unwrap.
+    """
+    if len(timestamps) < 8:
+        return None
+    dt = np.diff(timestamps) % HOUR
+    if dt.max() > MAX_GAP:
+        return None
+    t = np.concatenate(([0], np.cumsum(dt))).astype(np.float64)
+    a = np.concatenate(([0], np.cumsum(np.diff(azimuths) % 36000))) / 100.0
+    t -= t.mean()
+    variance = np.dot(t, t)
+    if variance == 0:
+        return None
+    return np.dot(t, a - a.mean()) / variance
+
+
+def pass_phases(timestamps, azimuths, rate, cameras, periods):
+    """
+    Returns, for every packet and camera, the phase in radians of the camera period at which the
+    LiDAR next points at the camera, less its delay. timestamps and azimuths are as for
+    fit_rotation(), rate in degrees per microsecond and periods the camera periods in microseconds.
+    """
+    mount = np.array([camera.azimuth for camera in cameras], dtype=np.float64)
+    delay = np.array([camera.delay for camera in cameras], dtype=np.float64)
+    to_go = ((mount[np.newaxis, :] - azimuths[:, np.newaxis] / 100.0) % 360.0) / rate
+    second = (timestamps[:, np.newaxis] % 1000000 + to_go - delay[np.newaxis, :]) % 1000000
+    return 2 * np.pi * ((second % periods[np.newaxis, :]) / periods[np.newaxis, :])
+
+
+class lidar_phase_tracker(threading.Thread):
+
+    def __init__(self, generator, cameras, port=DATA_PORT, position_port=POSITION_PORT, host='0.0.0.0', batch=64,
+                 tolerance=0.1, min_interval=1.0, smoothing=0.2, require_pps=True):
+        """
+        Thread receiving the packets of a Velodyne LiDAR and locking the trigger phases of cameras,
+        lidar_camera records of triggers of the waveform_engine, to its rotation.
+        Data packets are parsed batch at a time. A phase is updated when the azimuth the LiDAR points
+        at mid-exposure is off the mounting azimuth by more than tolerance times the field of view,
+        at most every min_interval seconds. smoothing is the weight of a new batch in the rate and
+        phase estimates. With require_pps, phases are only updated while position packets report
+        the LiDAR clock locked to its PPS. position_port may be None if those are not forwarded.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.generator = generator
+        self.port = port
+        self.position_port = position_port
+        self.host = host
+        self.batch = batch
+        self.tolerance = tolerance
+        self.min_interval = min_interval
+        self.smoothing = smoothing
+        self.require_pps = require_pps
+        self.buffer = bytearray(batch * DATA_PACKET.itemsize)
+        self.lock = threading.Lock()
+        self.sockets = []
+        self.running = False
+
+        self.rate = None                  # Rotation rate in degrees per microsecond
+        self.second_azimuth = None        # (cos, sin) of the azimuth at the top of the second, smoothed
+        self.pps_status = None            # PPS status of the last position packet
+        self.packets = 0
+        self.rejected = 0                 # Packets that are not Velodyne data packets
+        self.updates = 0
+        self.last_update = None
+        self.cameras = []
+        self.phases = []
+        self.set_cameras(cameras)
+
+    def set_cameras(self, cameras):
+        """
+        Sets the cameras, as lidar_camera records or (gpio, azimuth, fov[, delay]) tuples.
+        Cameras set as before keep their phase estimates.
+        """
+        cameras = [camera if isinstance(camera, lidar_camera) else lidar_camera(*camera) for camera in cameras]
+        with self.lock:
+            previous = dict((_settings(camera), phase) for camera, phase in zip(self.cameras, self.phases))
+            self.cameras = cameras
+            self.phases = [previous.get(_settings(camera)) for camera in cameras]   # (cos, sin) of the wanted phase of each camera, smoothed
+
+    def start(self):
+        """
+        Binds the packet ports and starts tracking. Raises socket.error if a port cannot be bound.
+        """
+        for port in (self.port, self.position_port):
+            if port is None:
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind((self.host, port))
+            except socket.error:
+                sock.close()
+                self.close()
+                raise
+            sock.setblocking(False)
+            self.sockets.append(sock)
+        self.running = True
+        threading.Thread.start(self)
+
+    def run(self):
+        data_socket = self.sockets[0]
+        view = memoryview(self.buffer)
+        size = DATA_PACKET.itemsize
+        count = 0
+        while self.running:
+            readable, _, _ = select.select(self.sockets, [], [], 0.2)
+            if not readable and count:
+                self.add_packets(parse_data(self.buffer, count))
+                count = 0
+            for sock in readable:
+                if sock is not data_socket:
+                    try:
+                        self.add_position(sock.recv(2048))
+                    except socket.error:
+                        pass
+                    continue
+                while count < self.batch:
+                    try:
+                        length = sock.recv_into(view[count * size:], size)
+                    except socket.error:
+                        break
+                    if length == size:
+                        count += 1
+                    else:
+                        self.rejected += 1
+                if count == self.batch:
+                    self.add_packets(parse_data(self.buffer, count))
+                    count = 0
+
+    def add_position(self, data):
+        """
+        Handles a position packet.
+        """
+        position = parse_position(data)
+        if position is not None:
+            self.pps_status = position[1]
+
+    def add_packets(self, packets):
+        """
+        Handles a batch of data packets, a DATA_PACKET array in arrival order.
+        """
+        flags = packets['blocks']['flag'][:, 0]
+        timestamps = packets['timestamp'].astype(np.int64)
+        azimuths = packets['blocks']['azimuth'][:, 0].astype(np.int64)
+        valid = (flags == BLOCK_FLAG) & (azimuths < 36000) & (timestamps < HOUR)
+        self.packets += int(valid.sum())
+        self.rejected += len(packets) - int(valid.sum())
+        timestamps, azimuths = timestamps[valid], azimuths[valid]
+        if not len(timestamps):
+            return
+
+        rate = fit_rotation(timestamps, azimuths)
+        if rate is not None and rate > 0:
+            self.rate = rate if self.rate is None else self.rate + self.smoothing * (rate - self.rate)
+        if self.rate is None:
+            return
+        second = np.radians(azimuths / 100.0 - self.rate * (timestamps % 1000000))
+        self.second_azimuth = self._smooth(self.second_azimuth, np.cos(second).mean(), np.sin(second).mean())
+
+        with self.lock:
+            cameras = self.cameras
+            triggers = self.generator.trigger_outputs
+            periods = np.array([1e6 / float(triggers[camera.gpio].frequency) if self._tracked(camera) else 1e6 for camera in cameras])
+            if cameras:
+                phases = pass_phases(timestamps, azimuths, self.rate, cameras, periods)
+                for i, (cosine, sine) in enumerate(zip(np.cos(phases).mean(axis=0), np.sin(phases).mean(axis=0))):
+                    self.phases[i] = self._smooth(self.phases[i], cosine, sine)
+        self.apply()
+
+    def _tracked(self, camera):
+        # Whether the camera is triggered with a frequency repeating every second, which the phases here assume
+        trigger = self.generator.trigger_outputs.get(camera.gpio)
+        return trigger is not None and wave_compiler.hyperperiod([(camera.gpio, trigger.frequency, 0, 0)]) == 1
+
+    def _smooth(self, previous, cosine, sine):
+        # Smoothed mean of angles, as a unit vector
+        if previous is not None:
+            cosine = previous[0] + self.smoothing * (cosine - previous[0])
+            sine = previous[1] + self.smoothing * (sine - previous[1])
+        norm = math.hypot(cosine, sine) or 1.0
+        return cosine / norm, sine / norm
+
+    def wanted_phases(self):
+        """
+        Returns the trigger phase in degrees each camera should have, by GPIO. Cameras without a trigger,
+        or triggered at a frequency that does not repeat every second, are left out.
+        """
+        with self.lock:
+            return dict((camera.gpio, math.degrees(math.atan2(phase[1], phase[0])) % 360) for camera, phase in zip(self.cameras, self.phases)
+                        if phase is not None and self._tracked(camera))
+
+    def azimuth_errors(self):
+        """
+        Returns the azimuth the LiDAR points at in the middle of the exposure of each camera, less the
+        mounting azimuth, in degrees from -180 to 180, by GPIO, for the phases the triggers have.
+        """
+        errors = {}
+        if self.rate is None:
+            return errors
+        wanted = self.wanted_phases()
+        for camera in self.cameras:
+            trigger = self.generator.trigger_outputs.get(camera.gpio)
+            if trigger is None or camera.gpio not in wanted:
+                continue
+            period = 1e6 / float(trigger.frequency)
+            late = ((trigger.phase - wanted[camera.gpio] + 180) % 360 - 180) / 360.0 * period
+            errors[camera.gpio] = float((late * self.rate + 180) % 360 - 180)
+        return errors
+
+    def apply(self, now=None):
+        """
+        Hands the phases of the cameras the LiDAR misses by more than the tolerance to the engine.
+        """
+        now = time.time() if now is None else now
+        if self.last_update is not None and now - self.last_update < self.min_interval:
+            return
+        if self.require_pps and self.pps_status != PPS_LOCKED:
+            return
+        errors = self.azimuth_errors()
+        wanted = self.wanted_phases()
+        changes = dict((camera.gpio, round(wanted[camera.gpio], 3)) for camera in self.cameras
+                       if camera.gpio in errors and abs(errors[camera.gpio]) > self.tolerance * camera.fov)
+        if not changes:
+            return
+        self.last_update = now
+        generator = self.generator
+
+        def change():
+            for gpio, phase in changes.items():
+                if gpio in generator.trigger_outputs:
+                    generator.update_trigger_gpio_phase(gpio, phase)
+
+        def done(error):
+            if error is None:
+                self.updates += 1
+            else:
+                print ("LiDAR camera phases not updated: {}".format(error))
+
+        generator.schedule_change(change, done)
+
+    def status(self):
+        """
+        Returns the rotation in RPM, the azimuth at the top of the second in degrees, the PPS status
+        of the LiDAR and the azimuth error of each camera by GPIO.
+        """
+        return {'rpm': float(self.rate * 1e6 / 6.0) if self.rate is not None else None,
+                'second_azimuth': math.degrees(math.atan2(self.second_azimuth[1], self.second_azimuth[0])) % 360 if self.second_azimuth is not None else None,
+                'pps_status': self.pps_status, 'packets': self.packets, 'rejected': self.rejected, 'updates': self.updates,
+                'azimuth_errors': self.azimuth_errors()}
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+        self.sockets = []
+
+    def stop(self):
+        self.running = False
+        if self.is_alive():
+            self.join(1.0)
+        self.close()
+
+
+def synthetic_packets(count, rpm=600.0, azimuth=0.0, start=0, packet_rate=754.0, jitter=0.0, seed=None):
+    """
+    Returns count Velodyne data packets of a LiDAR spinning at rpm, pointing at azimuth (degrees)
+    at the top of every hour, the first one sent start microseconds past the hour and the next ones
+    packet_rate per second, with a timestamp jitter of standard deviation jitter microseconds.
+    Returns are empty.
+    """
+    packets = np.zeros(count, DATA_PACKET)
+    times = start + np.arange(count) * (1e6 / packet_rate)
+    if jitter:
+        times = times + np.random.RandomState(seed).normal(0.0, jitter, count)
+    rate = rpm * 6.0 / 1e6
+    firings = np.arange(12) * (1e6 / packet_rate / 12)
+    azimuths = (azimuth + rate * (times[:, np.newaxis] + firings[np.newaxis, :])) % 360.0
+    packets['blocks']['flag'] = BLOCK_FLAG
+    packets['blocks']['azimuth'] = np.round(azimuths * 100).astype(np.int64) % 36000
+    packets['timestamp'] = np.round(times).astype(np.int64) % HOUR
+    packets['return_mode'] = 0x37       # Strongest return
+    packets['product'] = 0x22           # VLP-16
+    return packets
+
+
+def position_packet(timestamp, pps_status=PPS_LOCKED):
+    """
+    Returns a Velodyne position packet with a timestamp in microseconds past the hour and a PPS status.
+    """
+    data = bytearray(POSITION_PACKET_SIZE)
+    struct.pack_into('<IB', data, 198, int(timestamp) % HOUR, pps_status)
+    seconds = time.gmtime()
+    sentence = time.strftime('GPRMC,%H%M%S,A,0000.00,N,00000.00,E,000.0,000.0,%d%m%y,,,A', seconds).encode('ascii')
+    checksum = 0
+    for byte in bytearray(sentence):
+        checksum ^= byte
+    nmea = b'$' + sentence + ('*%02X\r\n' % checksum).encode('ascii')
+    data[206:206 + len(nmea)] = nmea
+    return bytes(data)
+
+
+def read_pcap(filename, port=DATA_PORT):
+    """
+    Returns the Velodyne data packets sent to a UDP port in a pcap capture (Ethernet, IPv4) as a
+    DATA_PACKET array.
+    """
+    payloads = []
+    with open(filename, 'rb') as f:
+        header = f.read(24)
+        if len(header) < 24:
+            raise ValueError('%s is not a pcap file' % filename)
+        magic = struct.unpack('<I', header[:4])[0]
+        if magic in (0xa1b2c3d4, 0xa1b23c4d):
+            order = '<'
+        elif magic in (0xd4c3b2a1, 0x4d3cb2a1):
+            order = '>'
+        else:
+            raise ValueError('%s is not a pcap file' % filename)
+        while True:
+            record = f.read(16)
+            if len(record) < 16:
+                break
+            length = struct.unpack(order + 'IIII', record)[2]
+            frame = f.read(length)
+            if len(frame) < 42 or frame[12:14] != b'\x08\x00':
+                continue
+            ip_length = (bytearray(frame)[14] & 0x0f) * 4
+            udp = 14 + ip_length
+            if bytearray(frame)[23] != 17 or struct.unpack('>H', frame[udp + 2:udp + 4])[0] != port:
+                continue
+            payload = frame[udp + 8:]
+            if len(payload) == DATA_PACKET.itemsize:
+                payloads.append(payload)
+    return parse_data(b''.join(payloads))
+
+
+class packet_replayer(threading.Thread):
+
+    def __init__(self, packets, host='127.0.0.1', port=DATA_PORT, position_port=POSITION_PORT, speed=1.0, loop=False, pps_status=PPS_LOCKED):
+        """
+        Thread sending data packets, a DATA_PACKET array, to host:port paced by their timestamps,
+        and a position packet with pps_status to position_port every second, as a LiDAR would.
+        With loop, the packets are sent again from the start once sent.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.packets = packets
+        self.host = host
+        self.port = port
+        self.position_port = position_port
+        self.speed = speed
+        self.loop = loop
+        self.pps_status = pps_status
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.running = False
+        self.sent = 0
+
+    def run(self):
+        data = self.packets.tobytes()
+        size = DATA_PACKET.itemsize
+        elapsed = np.concatenate(([0], np.cumsum(np.diff(self.packets['timestamp'].astype(np.int64)) % HOUR))) / 1e6 / self.speed
+        while self.running:
+            start = time.time()
+            next_position = start
+            for i in range(len(self.packets)):
+                if not self.running:
+                    return
+                delay = start + elapsed[i] - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                if self.position_port is not None and time.time() >= next_position:
+                    next_position += 1.0
+                    self.sock.sendto(position_packet(self.packets['timestamp'][i], self.pps_status), (self.host, self.position_port))
+                self.sock.sendto(data[i * size:(i + 1) * size], (self.host, self.port))
+                self.sent += 1
+            if not self.loop:
+                self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread.start(self)
+
+    def stop(self):
+        self.running = False
+        if self.is_alive():
+            self.join(1.0)
+        self.sock.close()
@@ -0,0 +1,321 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  nmea_sender.py
+#
+#  Sends spoofed NMEA sentences to sensors from a dedicated thread.
+#
+#  The pigpio callback thread only appends the edge tick to a deque and writes one byte
+#  to a wake up pipe, so callback latency does not depend on the number of sensors or
+#  on how they behave. The sentences for the next second are formatted from templates
+#  right after the previous ones are sent, so only the sends happen at the edge.
+#  Sockets are non-blocking; TCP destinations connect concurrently and reconnect automatically,
+#  and a connection attempt is given up after a short timeout, so a sensor that is not powered
+#  up yet only delays its own sentences.
+#  Sentences are timestamped in UTC from the timebase mapping of the edge tick when one is
+#  given, so they do not depend on when the sender thread gets to run.
+#
+
+import collections
+import errno
+import fcntl
+import os
+import select
+import socket
+import threading
+import time
+
+import utils
+
+VELODYNE_PORT = 10110
+
+GPGGA_TEMPLATE = '$GPGGA,%(time)s,4321.428,S,17242.305,E,1,12,1.0,0.0,M,0.0,M,,'
+GPRMC_TEMPLATE = '$GPRMC,%(time)s,A,4321.428,S,17242.305,E,0.0,0.0,%(date)s,,,A'
+
+TCP = 'tcp'
+UDP = 'udp'
+
+_CONNECTING = (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK)
+
+
+def format_sentence(template, seconds):
+    """
+    Formats a sentence template for the start of the given UTC second since the epoch and appends
+    the checksum. Templates use %(time)s for hhmmss.ss and %(date)s for ddmmyy.
+    """
+    fields = time.gmtime(seconds)
+    body = template % {
+        'time': '%02d%02d%02d.00' % (fields.tm_hour, fields.tm_min, fields.tm_sec),
+        'date': '%02d%02d%02d' % (fields.tm_mday, fields.tm_mon, fields.tm_year % 100),
+    }
+    return (body + '*' + utils.get_nmea_checksum(body) + '\r\n').encode('ascii')
+
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+class nmea_destination:
+
+    def __init__(self, host, port=VELODYNE_PORT, protocol=TCP, reconnect_interval=1.0, connect_timeout=0.25):
+        """
+        A sensor receiving NMEA sentences over TCP or UDP.
+        A TCP connection attempt is given up after connect_timeout seconds and retried every reconnect_interval seconds.
+        """
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.reconnect_interval = reconnect_interval
+        self.connect_timeout = connect_timeout
+
+        self.sock = None
+        self.connected = False
+        self.next_attempt = 0.0
+        self.connect_deadline = None
+        self.failures = 0
+        self.pending = b''
+        self.sent = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+    def connect(self, now):
+        """
+        Starts a non-blocking connection attempt.
+        """
+        self.close()
+        self.next_attempt = now + self.reconnect_interval
+        self.connect_deadline = now + self.connect_timeout
+        if self.protocol == UDP:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+            self.connected = True
+            return
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        result = self.sock.connect_ex((self.host, self.port))
+        if result == 0:
+            self.connected = True
+        elif result not in _CONNECTING:
+            self.fail()
+
+    def connecting(self):
+        return self.sock is not None and not self.connected
+
+    def finish_connect(self):
+        """
+        Completes a connection attempt once its socket is writable.
+        """
+        if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+            self.connected = True
+            self.reconnects += 1
+            if self.failures:
+                print ("Connected to device with IP: {} on port: {}".format(self.host, self.port))
+            self.failures = 0
+        else:
+            self.fail()
+
+    def check_timeout(self, now):
+        """
+        Gives up a connection attempt that has not completed within the connect timeout.
+        """
+        if self.connecting() and now >= self.connect_deadline:
+            self.fail()
+
+    def fail(self):
+        # Reported on the first failure only, the attempts go on in the background
+        if not self.failures:
+            print ("Device with IP: {} on port: {} is not responding. Will keep trying to connect.".format(self.host, self.port))
+        self.failures += 1
+        self.close()
+
+    def send(self, sentence):
+        """
+        Sends a sentence without blocking. A sentence that cannot be sent is dropped, as it would
+        be stale by the time it could be; a partly sent one is completed first.
+        """
+        if not self.connected:
+            self.dropped += 1
+            return
+        try:
+            if self.protocol == UDP:
+                self.sock.sendto(sentence, (self.host, self.port))
+                self.sent += 1
+                return
+            if self.pending:
+                self.flush()
+                if self.pending:
+                    self.dropped += 1
+                    return
+            count = self.sock.send(sentence)
+            self.pending = sentence[count:]
+            self.sent += 1
+        except socket.error as e:
+            self.dropped += 1
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK) and self.protocol == TCP:
+                self.close()
+
+    def flush(self):
+        try:
+            count = self.sock.send(self.pending)
+            self.pending = self.pending[count:]
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.connected = False
+        self.pending = b''
+
+
+class nmea_sender(threading.Thread):
+
+    def __init__(self, timebase=None, templates=None, max_edges=16):
+        """
+        Thread sending NMEA sentences to all destinations after every output PPS edge.
+        timebase maps the edge ticks to UTC; without one (or before it has anchors) the system clock is used.
+        templates are the sentences sent every second, see format_sentence().
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.timebase = timebase
+        self.templates = templates if templates is not None else [GPRMC_TEMPLATE, GPGGA_TEMPLATE]
+        self.destinations = []
+        self.edges = collections.deque(maxlen=max_edges)
+        self.running = False
+        self.prepared_second = None
+        self.prepared = []
+
+        self._wake_read, self._wake_write = os.pipe()
+        _set_nonblocking(self._wake_read)
+        _set_nonblocking(self._wake_write)
+
+    def add_destination(self, host, port=VELODYNE_PORT, protocol=TCP):
+        """
+        Adds a sensor to send the sentences to. Can be called while running.
+        """
+        destination = nmea_destination(host, port, protocol)
+        self.destinations = self.destinations + [destination]
+        self._wake()
+        return destination
+
+    def edge(self, tick):
+        """
+        Hands an output PPS edge over to the sender. Safe to call from the pigpio callback thread.
+        """
+        self.edges.append(tick)
+        self._wake()
+
+    def stop(self):
+        """
+        Stops the sender. A thread still blocked after a second (i.e. in a serial write) closes the
+        destinations and the wake up pipe itself when it exits, so it never uses a closed descriptor.
+        """
+        self.running = False
+        self._wake()
+        if self.is_alive():
+            self.join(1.0)
+        if not self.is_alive():
+            self._close()
+
+    def _close(self):
+        if self._wake_read is None:
+            return
+        for destination in self.destinations:
+            destination.close()
+        wake_read, wake_write = self._wake_read, self._wake_write
+        self._wake_read = self._wake_write = None
+        os.close(wake_read)
+        os.close(wake_write)
+
+    def start(self):
+        self.running = True
+        threading.Thread.start(self)
+
+    def _wake(self):
+        wake_write = self._wake_write
+        if wake_write is None:
+            return
+        try:
+            os.write(wake_write, b'\0')
+        except OSError:
+            pass    # The pipe is full, so the sender is being woken up anyway
+
+    def _prepare(self, second):
+        self.prepared_second = second
+        self.prepared = [format_sentence(template, second) for template in self.templates]
+
+    def run(self):
+        try:
+            self._send_loop()
+        finally:
+            if not self.running:
+                self._close()
+
+    def _send_loop(self):
+        self._prepare(int(time.time()) + 1)
+        while self.running:
+            destinations = self.destinations
+            writers = [destination.sock for destination in destinations if destination.connecting() or destination.pending]
+            timeout = 0.5
+            deadlines = [destination.connect_deadline for destination in destinations if destination.connecting()]
+            if deadlines:
+                timeout = max(0.0, min(timeout, min(deadlines) - time.time()))
+            try:
+                readable, writable, failed = select.select([self._wake_read], writers, [], timeout)
+            except (select.error, OSError):
+                continue
+
+            if readable:
+                try:
+                    while os.read(self._wake_read, 64):
+                        pass
+                except OSError:
+                    pass
+
+            for destination in destinations:
+                if destination.sock in writable:
+                    if destination.connecting():
+                        destination.finish_connect()
+                    elif destination.pending:
+                        destination.flush()
+
+            # Only the latest edge is answered, the sentences for older ones would be stale
+            edge = None
+            while self.edges:
+                edge = self.edges.popleft()
+            if edge is not None:
+                if self.timebase is not None and self.timebase.valid():
+                    second = int(round(self.timebase.utc_at(edge)))
+                else:
+                    # The edge starts the current second; tolerate the system clock being slightly behind
+                    second = int(time.time() + 0.1)
+                if second != self.prepared_second:
+                    self._prepare(second)
+                for sentence in self.prepared:
+                    for destination in destinations:
+                        destination.send(sentence)
+                self._prepare(second + 1)
+
+            # Destinations added meanwhile start connecting at once
+            now = time.time()
+            for destination in self.destinations:
+                destination.check_timeout(now)
+                if destination.sock is None and now >= destination.next_attempt:
+                    destination.connect(now)
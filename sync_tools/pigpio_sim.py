@@ -0,0 +1,953 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  pigpio_sim.py
+#
+#  Simulated pigpio backend running on a virtual microsecond clock.
+#  A simulated_pi can be handed to waveform_engine in place of pigpio.pi()
+#  so that waveform generation and PPS synchronization can be exercised
+#  on machines without a Raspberry Pi or a running pigpiod.
+#
+
+import collections
+import random
+
+import pigpio
+
+TICK_MASK = 0xFFFFFFFF                      # pigpio ticks are unsigned 32 bit microseconds
+
+
+class simulated_callback:
+
+    def __init__(self, pi, gpio, edge, func):
+        """
+        Mirrors the callback object returned by pigpio.pi.callback().
+        Without a function the callback only counts edges (see tally).
+        """
+        self.pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+        self.count = 0
+
+    def matches(self, gpio, level):
+        if gpio != self.gpio:
+            return False
+        if self.edge == pigpio.EITHER_EDGE:
+            return True
+        if self.edge == pigpio.RISING_EDGE:
+            return level == 1
+        return level == 0
+
+    def cancel(self):
+        """
+        Cancels the callback.
+        """
+        if self in self.pi.callbacks:
+            self.pi.callbacks.remove(self)
+
+    def tally(self):
+        """
+        Returns the number of edges seen since the callback was created or reset.
+        """
+        return self.count
+
+    def reset_tally(self):
+        """
+        Resets the edge count to zero.
+        """
+        self.count = 0
+
+
+class simulated_PPS_source:
+
+    def __init__(self, gpio, first_edge, cycle_time=1000000.0, drift_ppm=0.0, jitter=0.0, pulse_width=100000, seed=None):
+        """
+        An external PPS signal (i.e. from a GNSS receiver) driving an input GPIO.
+        Times are in simulated Pi ticks (microseconds).
+        drift_ppm is the offset of the Pi oscillator relative to the PPS source, so a positive
+        value means the PPS period measures longer than cycle_time in Pi ticks.
+        jitter is the standard deviation of the edge time in microseconds.
+        """
+        self.gpio = gpio
+        self.first_edge = first_edge
+        self.cycle_time = cycle_time
+        self.drift_ppm = drift_ppm
+        self.jitter = jitter
+        self.pulse_width = pulse_width
+        self.outages = []
+        self.random = random.Random(seed)
+        self.edge_count = 0
+        self.next_rising = None
+        self.next_falling = None
+        self._schedule()
+
+    def add_outage(self, start_tick, end_tick):
+        """
+        Suppresses all pulses with rising edges between start_tick and end_tick (signal loss).
+        """
+        self.outages.append((start_tick, end_tick))
+
+    def nominal_edge(self, count):
+        """
+        Returns the jitter free tick of the rising edge with the given index.
+        """
+        return self.first_edge + count * self.cycle_time * (1.0 + self.drift_ppm * 1e-6)
+
+    def _in_outage(self, tick):
+        for start_tick, end_tick in self.outages:
+            if start_tick <= tick < end_tick:
+                return True
+        return False
+
+    def _schedule(self):
+        edge = self.nominal_edge(self.edge_count)
+        if self.jitter > 0:
+            edge += self.random.gauss(0.0, self.jitter)
+        self.next_rising = int(round(edge))
+        self.next_falling = None
+
+    def next_event(self):
+        if self.next_falling is not None:
+            return self.next_falling
+        return self.next_rising
+
+    def fire(self):
+        """
+        Returns the (tick, level) of the next edge and advances the source.
+        Edges falling in an outage are returned with a level of None.
+        """
+        if self.next_falling is not None:
+            tick = self.next_falling
+            self.edge_count += 1
+            self._schedule()
+            return tick, 0
+        tick = self.next_rising
+        self.next_falling = tick + int(self.pulse_width)
+        if self._in_outage(tick):
+            return tick, None
+        return tick, 1
+
+
+class recorded_PPS_source:
+
+    def __init__(self, gpio, ticks, pulse_width=100000):
+        """
+        A PPS signal replaying recorded rising edge ticks on an input GPIO, such as those recorded
+        from a GNSS receiver in the field (see replay.py). ticks are unwrapped simulated Pi ticks.
+        """
+        self.gpio = gpio
+        self.ticks = [int(tick) for tick in ticks]
+        self.pulse_width = pulse_width
+        self.edge_count = 0
+        self.next_falling = None
+
+    def next_event(self):
+        if self.next_falling is not None:
+            return self.next_falling
+        if self.edge_count < len(self.ticks):
+            return self.ticks[self.edge_count]
+        return float('inf')
+
+    def fire(self):
+        """
+        Returns the (tick, level) of the next edge and advances the source.
+        """
+        if self.next_falling is not None:
+            tick = self.next_falling
+            self.next_falling = None
+            return tick, 0
+        tick = self.ticks[self.edge_count]
+        self.edge_count += 1
+        # Falls before the next rising edge, however close the recording has them
+        following = self.ticks[self.edge_count] if self.edge_count < len(self.ticks) else tick + 2 * self.pulse_width
+        self.next_falling = tick + min(int(self.pulse_width), max(1, (following - tick) // 2))
+        return tick, 1
+
+
+class simulated_wave:
+
+    def __init__(self, events, length, pulses):
+        """
+        A created waveform: sorted (offset, on_mask, off_mask) events and total length in microseconds.
+        """
+        self.events = events
+        self.length = length
+        self.pulses = pulses
+
+
+class simulated_script:
+
+    COMMANDS = {'tag': 1, 'lda': 1, 'sta': 1, 'add': 1, 'sub': 1, 'and': 1, 'or': 1, 'xor': 1, 'div': 1, 'jmp': 1, 'jz': 1,
+                'jnz': 1, 'jm': 1, 'jp': 1, 'mics': 1, 'mils': 1, 'tick': 0, 'br1': 0, 'halt': 0, 'nop': 0}
+
+    def __init__(self, text):
+        """
+        A stored pigpiod script, parsed into (command, argument) instructions.
+        Only the commands the services use are supported: accumulator loads, stores, arithmetic and
+        logic, jumps, tags, TICK, BR1, MICS, MILS and HALT.
+        Arguments are constants, variables v0 to v149 or parameters p0 to p9.
+        """
+        words = text.split()
+        self.instructions = []
+        self.tags = {}
+        i = 0
+        while i < len(words):
+            command = words[i].lower()
+            if command not in self.COMMANDS:
+                raise pigpio.error("'illegal script command'")
+            argument = None
+            if self.COMMANDS[command]:
+                if i + 1 >= len(words):
+                    raise pigpio.error("'illegal script command'")
+                argument = words[i + 1].lower()
+                i += 1
+            i += 1
+            if command == 'tag':
+                self.tags[int(argument)] = len(self.instructions)
+            else:
+                self.instructions.append((command, argument))
+        for command, argument in self.instructions:
+            if command in ('jmp', 'jz', 'jnz', 'jm', 'jp') and int(argument) not in self.tags:
+                raise pigpio.error("'script has unresolved tag'")
+        self.params = [0] * 10
+        self.variables = [0] * 150
+        self.status = pigpio.PI_SCRIPT_HALTED
+        self.time = 0.0
+        self.pc = 0
+        self.a = 0
+
+    def value(self, argument):
+        if argument[0] == 'v':
+            return self.variables[int(argument[1:])]
+        if argument[0] == 'p':
+            return self.params[int(argument[1:])]
+        return _int32(int(argument))
+
+    def store(self, argument, value):
+        if argument[0] == 'v':
+            self.variables[int(argument[1:])] = _int32(value)
+        else:
+            self.params[int(argument[1:])] = _int32(value)
+
+
+class simulated_glitches:
+
+    def __init__(self, gpio, ticks, width, levels):
+        """
+        Glitches on an input GPIO (i.e. pickup on a long PPS cable): at each of ticks the level
+        flips for width microseconds. levels are the GPIO levels of the simulated_pi.
+        """
+        self.gpio = gpio
+        self.ticks = sorted(int(tick) for tick in ticks)
+        self.width = int(width)
+        self.levels = levels
+        self.edge_count = 0
+        self.restore = None               # (tick, level) ending the glitch under way
+
+    def next_event(self):
+        if self.restore is not None:
+            return self.restore[0]
+        if self.edge_count < len(self.ticks):
+            return self.ticks[self.edge_count]
+        return float('inf')
+
+    def fire(self):
+        """
+        Returns the (tick, level) of the next edge and advances the source.
+        """
+        if self.restore is not None:
+            tick, level = self.restore
+            self.restore = None
+            return tick, level
+        tick = self.ticks[self.edge_count]
+        self.edge_count += 1
+        level = self.levels.get(self.gpio, 0)
+        self.restore = (tick + self.width, level)
+        return tick, 1 - level
+
+
+class simulated_pi:
+
+    def __init__(self, start_tick=0, command_latency=50, callback_latency=50, max_pulses=12000, max_cbs=25016, max_waves=250, max_chain_bytes=600, max_chain_loops=20, record_edges=False, script_step=0.25, script_sleep_latency=60):
+        """
+        Fake pigpio.pi handle with a virtual microsecond clock.
+        Every command advances the clock by command_latency to model the socket round trip to pigpiod.
+        Callbacks are dispatched callback_latency after the edge that caused them, and edges
+        occurring while a callback runs are queued as the pigpio callback thread would.
+        Script instructions take script_step microseconds each, and script delays over 100 microseconds,
+        which pigpiod sleeps instead of busy waiting, end script_sleep_latency late.
+        The clock only advances through commands or by calling advance() and run_until().
+        """
+        self.connected = True
+        self.now = start_tick
+        self.command_latency = command_latency
+        self.callback_latency = callback_latency
+        self.max_pulses = max_pulses
+        self.max_cbs = max_cbs
+        self.max_waves = max_waves
+        self.max_chain_bytes = max_chain_bytes
+        self.max_chain_loops = max_chain_loops
+
+        self.modes = {}
+        self.levels = {}
+        self.glitch_filters = {}              # GPIO: steady time in microseconds
+        self._filtered = {}                   # GPIO: (level, tick) of a change the glitch filter has not reported yet
+        self.callbacks = []
+        self.sources = []
+
+        self.waves = {}
+        self._pending_events = {}
+        self._pending_length = 0
+
+        self.tx_wave = None
+        self.tx_current = None
+        self.tx_mode = None
+        self.tx_cycle_start = 0
+        self.tx_index = 0
+        self.tx_next = None
+        self.tx_chain = None                  # [(wave id, simulated_wave)] of a running wave chain
+        self.tx_chain_position = 0
+        self.tx_chain_loop = None             # chain position to return to for loop forever
+        self.tx_switches = []                 # (tick of request, tick of switch, wave id)
+
+        self.hardware = {}                    # GPIO: (frequency, duty fraction, start tick) of running PWM and clock outputs
+        self.hardware_revision = 0xa02082     # Pi 3 Model B
+
+        self.scripts = {}
+        self.script_step = script_step
+        self.script_sleep_latency = script_sleep_latency
+
+        self.command_counts = collections.defaultdict(int)
+        self.record_edges = record_edges
+        self.edges = []                       # (tick, gpio, level) when record_edges is set
+
+        self._queue = collections.deque()
+        self._dispatching = False
+
+    # -----------------------------------------------------------------
+    # Virtual clock
+    # -----------------------------------------------------------------
+
+    def get_current_tick(self):
+        self._command('get_current_tick')
+        return self.now & TICK_MASK
+
+    def advance(self, micros):
+        """
+        Runs the simulation forward by the given number of microseconds, firing callbacks.
+        """
+        self.run_until(self.now + micros)
+
+    def run_until(self, tick):
+        """
+        Runs the simulation until the (unwrapped) tick, firing callbacks as edges occur.
+        """
+        while True:
+            self._advance_to(tick, stop_on_callback=True)
+            if not self._queue:
+                break
+            self._dispatch()
+        self._dispatch()
+
+    def add_PPS_source(self, gpio, first_edge=None, **kwargs):
+        """
+        Attaches a simulated PPS source to an input GPIO and returns it.
+        See simulated_PPS_source for the keyword arguments.
+        """
+        if first_edge is None:
+            first_edge = self.now + 1000000
+        source = simulated_PPS_source(gpio, first_edge, **kwargs)
+        self.sources.append(source)
+        return source
+
+    def add_PPS_recording(self, gpio, ticks, pulse_width=100000):
+        """
+        Attaches a recorded_PPS_source replaying rising edge ticks to an input GPIO and returns it.
+        """
+        source = recorded_PPS_source(gpio, ticks, pulse_width)
+        self.sources.append(source)
+        return source
+
+    def add_glitches(self, gpio, ticks, width=10):
+        """
+        Attaches a simulated_glitches source flipping the level of a GPIO for width microseconds
+        at each of the (unwrapped) ticks and returns it.
+        """
+        source = simulated_glitches(gpio, ticks, width, self.levels)
+        self.sources.append(source)
+        return source
+
+    def command_count(self):
+        """
+        Returns the total number of commands (pigpiod round trips) issued.
+        """
+        return sum(self.command_counts.values())
+
+    def reset_command_counts(self):
+        self.command_counts.clear()
+
+    def _command(self, name):
+        self.command_counts[name] += 1
+        self._advance_to(self.now + self.command_latency)
+
+    def _next_event_time(self):
+        next_time = None
+        if self.tx_current is not None:
+            wave = self.tx_current
+            if self.tx_index < len(wave.events):
+                next_time = self.tx_cycle_start + wave.events[self.tx_index][0]
+            else:
+                next_time = self.tx_cycle_start + wave.length
+        for source in self.sources:
+            source_time = source.next_event()
+            if next_time is None or source_time < next_time:
+                next_time = source_time
+        for gpio, (level, tick) in self._filtered.items():
+            report_time = tick + self.glitch_filters[gpio]
+            if next_time is None or report_time < next_time:
+                next_time = report_time
+        return next_time
+
+    def _advance_to(self, tick, stop_on_callback=False):
+        while True:
+            next_time = self._next_event_time()
+            script_time = self._next_script_time()
+            if script_time is not None and script_time <= tick and (next_time is None or script_time < next_time):
+                # Scripts run up to the next edge, so they read the levels it leaves
+                self._run_scripts(min(next_time, tick + 1) if next_time is not None else tick + 1)
+                continue
+            if next_time is None or next_time > tick:
+                break
+            self.now = max(self.now, next_time)
+            queued = len(self._queue)
+            self._process_event(next_time)
+            if stop_on_callback and len(self._queue) > queued:
+                return
+        self.now = max(self.now, tick)
+
+    def _process_event(self, event_time):
+        if self.tx_current is not None:
+            wave = self.tx_current
+            if self.tx_index < len(wave.events):
+                offset, on_mask, off_mask = wave.events[self.tx_index]
+                if self.tx_cycle_start + offset == event_time:
+                    self._apply_masks(on_mask, off_mask, event_time)
+                    self.tx_index += 1
+                    return
+            elif self.tx_cycle_start + wave.length == event_time:
+                self._end_wave_cycle(event_time)
+                return
+        for gpio, (level, tick) in list(self._filtered.items()):
+            if tick + self.glitch_filters[gpio] == event_time:
+                # Stable for the steady time: reported then, as pigpiod does
+                del self._filtered[gpio]
+                self._report(gpio, level, event_time)
+                return
+        for source in self.sources:
+            if source.next_event() == event_time:
+                tick, level = source.fire()
+                if level is not None:
+                    self._set_level(source.gpio, level, tick)
+                return
+
+    def _end_wave_cycle(self, event_time):
+        if self.tx_chain is not None:
+            self._next_chain_item(event_time)
+        elif self.tx_next is not None:
+            wave_id, mode, requested = self.tx_next
+            self.tx_next = None
+            self.tx_switches.append((requested, event_time, wave_id))
+            self._start_wave(wave_id, mode, event_time)
+        elif self.tx_mode in (pigpio.WAVE_MODE_REPEAT, pigpio.WAVE_MODE_REPEAT_SYNC):
+            self.tx_cycle_start = event_time
+            self.tx_index = 0
+        else:
+            self._stop_tx()
+
+    def _start_wave(self, wave_id, mode, tick):
+        self._stop_tx()
+        self.tx_wave = wave_id
+        self.tx_current = self.waves[wave_id]
+        self.tx_mode = mode
+        self.tx_cycle_start = tick
+        self.tx_index = 0
+        if self.tx_current.length == 0:
+            self._stop_tx()
+
+    def _next_chain_item(self, tick):
+        if self.tx_chain_position == len(self.tx_chain):
+            if self.tx_chain_loop is None or self.tx_chain_loop == len(self.tx_chain):
+                self._stop_tx()
+                return
+            self.tx_chain_position = self.tx_chain_loop
+        self.tx_wave, self.tx_current = self.tx_chain[self.tx_chain_position]
+        self.tx_chain_position += 1
+        self.tx_cycle_start = tick
+        self.tx_index = 0
+
+    def _stop_tx(self):
+        self.tx_wave = None
+        self.tx_current = None
+        self.tx_mode = None
+        self.tx_next = None
+        self.tx_chain = None
+        self.tx_chain_loop = None
+
+    def _parse_chain(self, data):
+        """
+        Expands wave_chain() data into a list of (wave id, wave) with delays as empty waves.
+        Returns the list, the position the loop forever command returns to and the loop counters used.
+        """
+        stack = [[]]
+        forever = None
+        loops = 0
+        i = 0
+        while i < len(data):
+            if data[i] != 255:
+                if data[i] not in self.waves:
+                    raise pigpio.error("'bad wave id'")
+                stack[-1].append((data[i], self.waves[data[i]]))
+                i += 1
+                continue
+            command = data[i + 1]
+            if command == 0:
+                stack.append([])
+                i += 2
+            elif command == 1:
+                if len(stack) < 2:
+                    raise pigpio.error("'bad chain loop'")
+                body = stack.pop()
+                stack[-1].extend(body * (data[i + 2] + 256 * data[i + 3]))
+                loops += 1
+                i += 4
+            elif command == 2:
+                delay = data[i + 2] + 256 * data[i + 3]
+                stack[-1].append((None, simulated_wave([], delay, 0)))
+                i += 4
+            elif command == 3:
+                if len(stack) < 2 or i + 2 != len(data):
+                    raise pigpio.error("'bad chain loop'")
+                body = stack.pop()
+                forever = len(stack[-1])
+                stack[-1].extend(body)
+                i += 2
+            else:
+                raise pigpio.error("'bad chain cmd'")
+        if len(stack) != 1:
+            raise pigpio.error("'bad chain loop'")
+        return stack[0], forever, loops
+
+    def _apply_masks(self, on_mask, off_mask, tick):
+        for gpio in _bits(on_mask):
+            if self.modes.get(gpio) == pigpio.OUTPUT:
+                self._set_level(gpio, 1, tick)
+        for gpio in _bits(off_mask):
+            if self.modes.get(gpio) == pigpio.OUTPUT:
+                self._set_level(gpio, 0, tick)
+
+    def _set_level(self, gpio, level, tick):
+        if self.levels.get(gpio, 0) == level:
+            return
+        self.levels[gpio] = level
+        if self.record_edges:
+            self.edges.append((tick, gpio, level))
+        if self.glitch_filters.get(gpio, 0) > 0:
+            if gpio in self._filtered:
+                # Back to the reported level before the steady time: a glitch
+                del self._filtered[gpio]
+            else:
+                self._filtered[gpio] = (level, tick)
+            return
+        self._report(gpio, level, tick)
+
+    def _report(self, gpio, level, tick):
+        for callback in self.callbacks:
+            if callback.matches(gpio, level):
+                callback.count += 1
+                if callback.func is not None:
+                    self._queue.append((callback, gpio, level, tick))
+
+    def _dispatch(self):
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            while self._queue:
+                callback, gpio, level, tick = self._queue.popleft()
+                self._advance_to(tick + self.callback_latency)
+                if callback in self.callbacks:
+                    callback.func(gpio, level, tick & TICK_MASK)
+        finally:
+            self._dispatching = False
+
+    # -----------------------------------------------------------------
+    # GPIO
+    # -----------------------------------------------------------------
+
+    def set_mode(self, gpio, mode):
+        self._command('set_mode')
+        self.modes[gpio] = mode
+        return 0
+
+    def get_mode(self, gpio):
+        self._command('get_mode')
+        return self.modes.get(gpio, pigpio.INPUT)
+
+    def read(self, gpio):
+        self._command('read')
+        return self.levels.get(gpio, 0)
+
+    def write(self, gpio, level):
+        self._command('write')
+        self.modes[gpio] = pigpio.OUTPUT
+        self._set_level(gpio, 1 if level else 0, self.now)
+        return 0
+
+    def callback(self, user_gpio, edge=pigpio.RISING_EDGE, func=None):
+        self._command('callback')
+        callback = simulated_callback(self, user_gpio, edge, func)
+        self.callbacks.append(callback)
+        return callback
+
+    def set_glitch_filter(self, user_gpio, steady):
+        """
+        Reports level changes of the GPIO only once stable for steady microseconds, steady
+        microseconds late. Zero turns the filter off.
+        """
+        self._command('set_glitch_filter')
+        if steady <= 0:
+            self.glitch_filters.pop(user_gpio, None)
+            self._filtered.pop(user_gpio, None)
+        else:
+            self.glitch_filters[user_gpio] = int(steady)
+        return 0
+
+    def stop(self):
+        self.connected = False
+
+    # -----------------------------------------------------------------
+    # Hardware PWM and clocks
+    # -----------------------------------------------------------------
+
+    def get_hardware_revision(self):
+        self._command('get_hardware_revision')
+        return self.hardware_revision
+
+    def hardware_PWM(self, gpio, PWMfreq, PWMduty):
+        """
+        Starts hardware PWM from the current tick, or stops it at frequency 0.
+        As with pigpiod, any wave or wave chain being transmitted is cancelled.
+        """
+        self._command('hardware_PWM')
+        self._stop_tx()
+        if PWMfreq == 0:
+            self.hardware.pop(gpio, None)
+        else:
+            self.hardware[gpio] = (250000000.0 / (250000000 // PWMfreq), PWMduty / 1000000.0, self.now)
+            self.modes[gpio] = pigpio.ALT0 if gpio in (12, 13) else pigpio.ALT5
+        return 0
+
+    def hardware_clock(self, gpio, clkfreq):
+        """
+        Starts a general purpose clock from the current tick, or stops it at frequency 0.
+        """
+        self._command('hardware_clock')
+        if clkfreq == 0:
+            self.hardware.pop(gpio, None)
+        else:
+            self.hardware[gpio] = (float(clkfreq), 0.5, self.now)
+            self.modes[gpio] = pigpio.ALT0
+        return 0
+
+    def hardware_edges(self, gpio, start, end):
+        """
+        Returns the (unwrapped) ticks of the rising edges of a hardware output from start up to end.
+        """
+        if gpio not in self.hardware:
+            return []
+        frequency, duty, started = self.hardware[gpio]
+        period = 1000000.0 / frequency
+        first = max(0, int((start - started) // period))
+        edges = []
+        count = first
+        while started + count * period < end:
+            if started + count * period >= start:
+                edges.append(started + count * period)
+            count += 1
+        return edges
+
+    # -----------------------------------------------------------------
+    # Scripts
+    # -----------------------------------------------------------------
+
+    def store_script(self, script):
+        self._command('store_script')
+        script_id = 0
+        while script_id in self.scripts:
+            script_id += 1
+        self.scripts[script_id] = simulated_script(script.decode('ascii') if isinstance(script, bytes) else script)
+        return script_id
+
+    def run_script(self, script_id, params=None):
+        self._command('run_script')
+        script = self._script(script_id)
+        for i, param in enumerate(params or []):
+            script.params[i] = _int32(param)
+        script.status = pigpio.PI_SCRIPT_RUNNING
+        script.time = float(self.now)
+        script.pc = 0
+        return 0
+
+    def update_script(self, script_id, params=None):
+        self._command('update_script')
+        script = self._script(script_id)
+        for i, param in enumerate(params or []):
+            script.params[i] = _int32(param)
+        return 0
+
+    def script_status(self, script_id):
+        self._command('script_status')
+        script = self._script(script_id)
+        return script.status, tuple(script.params)
+
+    def stop_script(self, script_id):
+        self._command('stop_script')
+        self._script(script_id).status = pigpio.PI_SCRIPT_HALTED
+        return 0
+
+    def delete_script(self, script_id):
+        self._command('delete_script')
+        self._script(script_id)
+        del self.scripts[script_id]
+        return 0
+
+    def _script(self, script_id):
+        if script_id not in self.scripts:
+            raise pigpio.error("'unknown script id'")
+        return self.scripts[script_id]
+
+    def _next_script_time(self):
+        times = [int(script.time) for script in self.scripts.values() if script.status == pigpio.PI_SCRIPT_RUNNING]
+        return min(times) if times else None
+
+    def _run_scripts(self, until):
+        """
+        Runs the running scripts until the given tick, an instruction at a time.
+        """
+        for script in self.scripts.values():
+            while script.status == pigpio.PI_SCRIPT_RUNNING and script.time < until:
+                self._step_script(script)
+
+    def _step_script(self, script):
+        if script.pc >= len(script.instructions):
+            script.status = pigpio.PI_SCRIPT_HALTED
+            return
+        command, argument = script.instructions[script.pc]
+        script.pc += 1
+        script.time += self.script_step
+        if command == 'lda':
+            script.a = script.value(argument)
+        elif command == 'sta':
+            script.store(argument, script.a)
+        elif command == 'add':
+            script.a = _int32(script.a + script.value(argument))
+        elif command == 'sub':
+            script.a = _int32(script.a - script.value(argument))
+        elif command == 'and':
+            script.a = _int32(script.a & script.value(argument))
+        elif command == 'or':
+            script.a = _int32(script.a | script.value(argument))
+        elif command == 'xor':
+            script.a = _int32(script.a ^ script.value(argument))
+        elif command == 'div':
+            divisor = script.value(argument)
+            script.a = _int32(int(float(script.a) / divisor)) if divisor else 0
+        elif command == 'tick':
+            script.a = _int32(int(script.time))
+        elif command == 'br1':
+            script.a = _int32(sum(1 << gpio for gpio, level in self.levels.items() if level and gpio < 32))
+        elif command in ('mics', 'mils'):
+            delay = script.value(argument) * (1000 if command == 'mils' else 1)
+            script.time += max(0, delay) + (self.script_sleep_latency if delay > 100 else 0)
+        elif command == 'halt':
+            script.status = pigpio.PI_SCRIPT_HALTED
+        elif command != 'nop':
+            jump = {'jmp': True, 'jz': script.a == 0, 'jnz': script.a != 0, 'jm': script.a < 0, 'jp': script.a >= 0}[command]
+            if jump:
+                script.pc = script.tags[int(argument)]
+
+    # -----------------------------------------------------------------
+    # Waves
+    # -----------------------------------------------------------------
+
+    def wave_clear(self):
+        self._command('wave_clear')
+        self.waves = {}
+        self._pending_events = {}
+        self._pending_length = 0
+        self._stop_tx()
+        return 0
+
+    def wave_add_new(self):
+        self._command('wave_add_new')
+        self._pending_events = {}
+        self._pending_length = 0
+        return 0
+
+    def wave_add_generic(self, pulses):
+        """
+        Merges the pulses into the wave being built, in time order, as pigpiod does.
+        Delays are truncated to whole microseconds.
+        """
+        self._command('wave_add_generic')
+        events = dict(self._pending_events)
+        offset = 0
+        for pulse in pulses:
+            on_mask, off_mask = events.get(offset, (0, 0))
+            events[offset] = (on_mask | pulse.gpio_on, off_mask | pulse.gpio_off)
+            offset += int(pulse.delay)
+        if len(events) > self.max_pulses:
+            raise pigpio.error("'too many pulses'")
+        self._pending_events = events
+        self._pending_length = max(self._pending_length, offset)
+        return len(events)
+
+    def wave_create(self):
+        self._command('wave_create')
+        wave_id = 0
+        while wave_id in self.waves:
+            wave_id += 1
+        if wave_id >= self.max_waves:
+            raise pigpio.error("'No more waves'")
+        if 2 * len(self._pending_events) + self._cbs_in_use() > self.max_cbs:
+            raise pigpio.error("'No more CBs for waveform'")
+        events = [(offset, masks[0], masks[1]) for offset, masks in sorted(self._pending_events.items())]
+        self.waves[wave_id] = simulated_wave(events, self._pending_length, len(events))
+        self._pending_events = {}
+        self._pending_length = 0
+        return wave_id
+
+    def wave_delete(self, wave_id):
+        self._command('wave_delete')
+        if wave_id not in self.waves:
+            raise pigpio.error("'bad wave id'")
+        in_chain = self.tx_chain is not None and wave_id in [item[0] for item in self.tx_chain]
+        if wave_id == self.tx_wave or in_chain:
+            raise pigpio.error("'attempt to delete wave in use'")
+        del self.waves[wave_id]
+        return 0
+
+    def wave_send_once(self, wave_id):
+        return self.wave_send_using_mode(wave_id, pigpio.WAVE_MODE_ONE_SHOT)
+
+    def wave_send_repeat(self, wave_id):
+        return self.wave_send_using_mode(wave_id, pigpio.WAVE_MODE_REPEAT)
+
+    def wave_send_using_mode(self, wave_id, mode):
+        """
+        Starts a wave. The sync modes wait for the current wave to finish its cycle before switching.
+        """
+        self._command('wave_send_using_mode')
+        if wave_id not in self.waves:
+            raise pigpio.error("'bad wave id'")
+        sync = mode in (pigpio.WAVE_MODE_ONE_SHOT_SYNC, pigpio.WAVE_MODE_REPEAT_SYNC)
+        if sync and self.tx_current is not None and self.tx_chain is None:
+            self.tx_next = (wave_id, mode, self.now)
+        else:
+            self.tx_next = None
+            self.tx_switches.append((self.now, self.now, wave_id))
+            self._start_wave(wave_id, mode, self.now)
+        return self.waves[wave_id].pulses
+
+    def wave_chain(self, data):
+        """
+        Starts a wave chain immediately, stopping any wave being transmitted.
+        """
+        self._command('wave_chain')
+        if len(data) > self.max_chain_bytes:
+            raise pigpio.error("'chain is too long'")
+        items, forever, loops = self._parse_chain(list(data))
+        if loops > self.max_chain_loops:
+            raise pigpio.error("'too many chain counters'")
+        self._stop_tx()
+        if items:
+            self.tx_switches.append((self.now, self.now, None))
+            self.tx_chain = items
+            self.tx_chain_loop = forever
+            self.tx_chain_position = 0
+            self._next_chain_item(self.now)
+        return 0
+
+    def wave_tx_at(self):
+        """
+        As with pigpiod, chained waves are not reported.
+        """
+        self._command('wave_tx_at')
+        if self.tx_chain is not None:
+            return pigpio.WAVE_NOT_FOUND
+        if self.tx_wave is None:
+            return pigpio.NO_TX_WAVE
+        return self.tx_wave
+
+    def wave_tx_busy(self):
+        self._command('wave_tx_busy')
+        return 1 if self.tx_current is not None else 0
+
+    def wave_tx_stop(self):
+        self._command('wave_tx_stop')
+        self._stop_tx()
+        return 0
+
+    def wave_get_pulses(self):
+        self._command('wave_get_pulses')
+        return len(self._pending_events)
+
+    def wave_get_max_pulses(self):
+        self._command('wave_get_max_pulses')
+        return self.max_pulses
+
+    def wave_get_cbs(self):
+        self._command('wave_get_cbs')
+        return self._cbs_in_use()
+
+    def wave_get_max_cbs(self):
+        self._command('wave_get_max_cbs')
+        return self.max_cbs
+
+    def wave_get_micros(self):
+        self._command('wave_get_micros')
+        return self._pending_length
+
+    def _cbs_in_use(self):
+        return sum(2 * wave.pulses for wave in self.waves.values())
+
+
+def _bits(mask):
+    gpio = 0
+    while mask:
+        if mask & 1:
+            yield gpio
+        mask >>= 1
+        gpio += 1
+
+
+def _int32(value):
+    """
+    Wraps a value to a signed 32 bit integer, as pigpiod scripts compute.
+    """
+    value &= TICK_MASK
+    return value - (1 << 32) if value >= 1 << 31 else value
@@ -0,0 +1,231 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  pps_servo.py
+#
+#  PI servo disciplining the output PPS to an input PPS.
+#
+#  The input PPS period (in Pi ticks) is estimated by a least squares fit over a window
+#  of input edges, which also predicts the jitter free time of every input edge. At each
+#  output edge the phase error against the predicted input edge drives a PI loop, whose
+#  output is a cycle time slightly shorter or longer than the estimated period, so the
+#  output phase is slewed instead of stepped. Large errors outside lock are still stepped,
+#  except when reacquiring the input after a holdover, where the output is slewed back at
+#  a limited rate so it has no phase jump.
+#
+
+import collections
+
+import numpy as np
+
+import timebase
+
+UNLOCKED = 'unlocked'
+ACQUIRING = 'acquiring'
+LOCKED = 'locked'
+
+HOLD = 'hold'                       # no correction this period
+STEP = 'step'                       # step the output phase by the value in microseconds
+SLEW = 'slew'                       # run the output at the value as cycle time in microseconds
+
+
+class pps_servo:
+
+    def __init__(self, kp=0.3, ki=0.05, nominal_cycle_time=1000000.0, window=64, input_tolerance=50.0, acquire_tolerance=500.0,
+                 step_threshold=50.0, lock_threshold=3.0, lock_count=10, unlock_threshold=20.0, unlock_count=3, max_slew=100.0,
+                 reacquire_slew=10.0):
+        """
+        kp and ki are the proportional and integral gains, per PPS period, on the phase error.
+        window is the number of input edges used for the period estimate.
+        Input edges more than input_tolerance microseconds off their predicted time (acquire_tolerance
+        until the estimate has settled) are rejected as outliers.
+        Errors beyond step_threshold are stepped while not locked.
+        The servo locks after lock_count consecutive errors within lock_threshold, and unlocks after
+        unlock_count consecutive errors beyond unlock_threshold, which are otherwise ignored as outliers.
+        max_slew limits the cycle time correction in microseconds per period, and reacquire_slew while
+        reacquiring after a holdover.
+        All times are in microseconds.
+        """
+        self.kp = kp
+        self.ki = ki
+        self.nominal_cycle_time = nominal_cycle_time
+        self.window = window
+        self.input_tolerance = input_tolerance
+        self.acquire_tolerance = acquire_tolerance
+        self.step_threshold = step_threshold
+        self.lock_threshold = lock_threshold
+        self.lock_count = lock_count
+        self.unlock_threshold = unlock_threshold
+        self.unlock_count = unlock_count
+        self.max_slew = max_slew
+        self.reacquire_slew = reacquire_slew
+
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets all input edges and returns to the unlocked state.
+        """
+        self.state = UNLOCKED
+        self.edges = collections.deque(maxlen=self.window)    # (edge index, time) of accepted input edges
+        self.input_tick = None
+        self.input_index = 0
+        self.input_time = 0.0
+        self.cycle_time = None             # Estimated input period in ticks
+        self.intercept = None              # Estimated time of input edge zero
+        self.integral = 0.0
+        self.error = None                  # Last phase error, output late is positive
+        self.in_lock = 0
+        self.outliers = 0
+        self.input_outliers = 0
+        self.rejected_inputs = 0
+        self.reacquire_tolerance = None     # Input tolerance while reacquiring, None otherwise
+
+    def set_gains(self, kp, ki):
+        self.kp = kp
+        self.ki = ki
+
+    def locked(self):
+        return self.state == LOCKED
+
+    def reacquiring(self):
+        return self.reacquire_tolerance is not None
+
+    def reacquire(self, error):
+        """
+        Prepares for input edges coming back after a holdover in which the servo was fed predicted
+        input edges, with the given error in microseconds found on the first edge back.
+        The estimate is kept, so the returning edges move it onto the input over the window, and
+        the output is slewed at no more than reacquire_slew until locked again, instead of stepped.
+        """
+        self.reacquire_tolerance = abs(error) + self.input_tolerance
+        self.input_outliers = 0
+        self.in_lock = 0
+
+    def input_edge(self, tick):
+        """
+        Adds an input PPS rising edge.
+        Returns False if the edge was rejected as an outlier.
+        """
+        if self.input_tick is None:
+            self._accept(tick, 0, 0.0)
+            return True
+
+        interval = timebase.tick_diff(self.input_tick, tick)
+        time = self.input_time + interval
+        if self.cycle_time is not None:
+            count = int(round((time - self.intercept) / self.cycle_time)) - self.input_index
+            residual = time - (self.intercept + (self.input_index + count) * self.cycle_time)
+        else:
+            count = int(round(interval / self.nominal_cycle_time))
+            residual = interval - count * self.nominal_cycle_time
+        tolerance = self.input_tolerance if len(self.edges) >= self.window // 4 else self.acquire_tolerance
+        if self.reacquire_tolerance is not None:
+            tolerance = max(tolerance, self.reacquire_tolerance)
+        if count < 1 or abs(residual) > tolerance:
+            self.rejected_inputs += 1
+            self.input_outliers += 1
+            if self.input_outliers > self.unlock_count:
+                # The estimate no longer matches the input, start over from this edge
+                self.reset()
+                self._accept(tick, 0, 0.0)
+            return False
+
+        self.input_outliers = 0
+        self._accept(tick, self.input_index + count, time)
+        return True
+
+    def _accept(self, tick, index, time):
+        self.input_tick = tick
+        self.input_index = index
+        self.input_time = time
+        self.edges.append((index, time))
+        if len(self.edges) >= 2:
+            indices = np.array([edge[0] for edge in self.edges], dtype=float)
+            times = np.array([edge[1] for edge in self.edges])
+            self.cycle_time, self.intercept = np.polyfit(indices - indices[-1], times - times[-1], 1)
+            self.intercept += times[-1] - self.cycle_time * indices[-1]
+
+    def phase_error(self, tick):
+        """
+        Returns the time of an output edge relative to the closest predicted input edge, or None
+        while the input period has not been estimated.
+        """
+        if self.cycle_time is None:
+            return None
+        time = self.input_time + timebase.tick_diff(self.input_tick, tick)
+        index = round((time - self.intercept) / self.cycle_time)
+        return time - (self.intercept + index * self.cycle_time)
+
+    def output_edge(self, tick):
+        """
+        Runs the servo for an output PPS rising edge.
+        Returns (action, value): (HOLD, None), (STEP, phase step in microseconds) or (SLEW, cycle time).
+        A phase step of x means the output should happen x microseconds earlier.
+        """
+        error = self.phase_error(tick)
+        if error is None:
+            return HOLD, None
+        self.error = error
+
+        if self.reacquire_tolerance is not None:
+            return self._reacquire(error)
+
+        if self.state != LOCKED and abs(error) > self.step_threshold:
+            self.integral = 0.0
+            self.in_lock = 0
+            self.state = ACQUIRING
+            return STEP, error
+
+        if abs(error) > self.unlock_threshold:
+            self.outliers += 1
+            self.in_lock = 0
+            if self.state == LOCKED:
+                if self.outliers < self.unlock_count:
+                    return SLEW, self.cycle_time - self.integral
+                self.state = UNLOCKED
+                self.integral = 0.0
+        else:
+            self.outliers = 0
+
+        if abs(error) <= self.lock_threshold:
+            self.in_lock += 1
+            if self.in_lock >= self.lock_count:
+                self.state = LOCKED
+        else:
+            self.in_lock = 0
+
+        self.integral = _clamp(self.integral + self.ki * error, self.max_slew)
+        correction = _clamp(self.kp * error + self.integral, self.max_slew)
+        return SLEW, self.cycle_time - correction
+
+    def _reacquire(self, error):
+        # Slews at a limited rate until the error has been within the lock threshold for lock_count periods
+        if abs(error) <= self.lock_threshold:
+            self.in_lock += 1
+            if self.in_lock >= self.lock_count:
+                self.reacquire_tolerance = None
+                self.state = LOCKED
+                self.outliers = 0
+        else:
+            self.in_lock = 0
+        self.integral = _clamp(self.integral + self.ki * error, self.reacquire_slew)
+        correction = _clamp(self.kp * error + self.integral, self.reacquire_slew)
+        return SLEW, self.cycle_time - correction
+
+
+def _clamp(value, limit):
+    return max(-limit, min(limit, value))
@@ -0,0 +1,330 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  pps_sources.py
+#
+#  Validates the input PPS edges and chooses between several input PPS sources, such as two GNSS
+#  receivers or a pulse derived from PTP, handing the engine one stream of edges.
+#
+#  pigpiod drops level changes shorter than the glitch filter of a GPIO and reports the others
+#  the filter time late, which is taken off their ticks. Every source then keeps a score in
+#  constant memory, as moving averages over its edges: the jitter of its intervals around its
+#  period, the rate of faults (edges off the period, pulses of the wrong width) and the offset and
+#  wander of its edges against those of the active source. An edge off its source's period by more
+#  than a few times its jitter is not used, unless the edge after it confirms a step of the source,
+#  so a noisy edge does not step the output or rebuild the wave.
+#
+#  The edges of the active source are handed over with the smoothed period as cycle time. The
+#  active source is replaced when it stops, misbehaves or scores clearly worse than a qualified
+#  backup. With three or more sources, one disagreeing with the others scores by how far it is off.
+#  A switch is hitless: the offset of the new source against the old one is carried into its
+#  edges, so the output keeps its phase, and then slewed out slowly. When the active source misses
+#  an edge, the backup edge of that second is handed over late, at the next edge of any source.
+#
+
+import math
+
+import timebase
+
+FAULT_PENALTY = 100.0       # Score of a source faulting at every edge, in microseconds
+
+
+class pps_source(object):
+
+    def __init__(self, gpio, cycle_time=1000000.0, smoothing=1.0 / 16, tolerance=500.0, outlier_sigma=5.0, outlier_floor=20.0, qualify=3):
+        """
+        Score of an input PPS source on gpio. Until qualify consistent intervals are seen, edges
+        within tolerance microseconds of the period are consistent, afterwards those within
+        outlier_sigma times the jitter, but no less than outlier_floor microseconds.
+        smoothing is the weight of an edge in the moving averages.
+        """
+        self.gpio = gpio
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.outlier_sigma = outlier_sigma
+        self.outlier_floor = outlier_floor
+        self.qualify = qualify
+
+        self.period = cycle_time          # Smoothed interval in microseconds
+        self.intervals = 0                # Consistent intervals measured
+        self.jitter = 0.0                 # Smoothed squared interval error
+        self.faults = 0.0                 # Smoothed fault rate per edge
+        self.offset = None                # Smoothed time of the edges after those of the active source
+        self.wander = 0.0                 # Smoothed squared offset error
+        self.disagreement = 0.0           # Distance from the median offset of the sources
+        self.valid_run = 0                # Consistent intervals in a row
+        self.last = None                  # Tick of the last consistent edge
+        self.candidate = None             # Tick of an inconsistent edge, which the next edge may confirm as a step
+        self.rise = None                  # Tick of the last rising edge, and whether it was consistent
+        self.rise_consistent = False
+        self.offset_tick = None           # Tick of the edge the offset was last measured at
+
+        self.edges = 0
+        self.rejected = 0                 # Inconsistent edges
+        self.bad_widths = 0               # Pulses shorter or longer than the valid widths
+
+    def limit(self):
+        """
+        Returns the largest consistent interval error in microseconds.
+        """
+        if self.valid_run < self.qualify:
+            return self.tolerance
+        return max(self.outlier_sigma * math.sqrt(self.jitter), self.outlier_floor)
+
+    def qualified(self):
+        return self.valid_run >= self.qualify
+
+    def score(self):
+        """
+        Returns the score of the source in microseconds, lower is better.
+        """
+        return math.sqrt(self.jitter) + math.sqrt(self.wander) + self.disagreement + FAULT_PENALTY * self.faults
+
+    def _fault(self, fault):
+        self.faults += self.smoothing * ((1.0 if fault else 0.0) - self.faults)
+
+    def _consistent(self, interval, limit):
+        periods = int(round(interval / self.period))
+        return periods >= 1 and abs(interval - periods * self.period) <= limit * periods, periods
+
+    def rising(self, tick):
+        """
+        Scores a rising edge. Returns whether it is consistent with the edges before it, or
+        confirms a step of the source.
+        """
+        self.edges += 1
+        self.rise = tick
+        self.rise_consistent = False
+        if self.last is None:
+            self.last = tick
+            return False
+        limit = self.limit()
+        consistent, periods = self._consistent(timebase.tick_diff(self.last, tick), limit)
+        if consistent:
+            interval = timebase.tick_diff(self.last, tick) / float(periods)
+            if self.intervals:
+                error = interval - self.period
+                self.period += self.smoothing * error
+                self.jitter += self.smoothing * (error * error - self.jitter)
+            else:
+                self.period = interval
+            self.intervals += 1
+            self.valid_run += 1
+            self._fault(periods > 1)
+        elif self.candidate is not None and self._consistent(timebase.tick_diff(self.candidate, tick), limit)[0]:
+            # Two edges agree on a new phase: the source stepped
+            self.valid_run = 1
+            self._fault(True)
+        else:
+            if self.candidate is not None:
+                self.valid_run = 0
+            self.candidate = tick
+            self.rejected += 1
+            self._fault(True)
+            return False
+        self.last = tick
+        self.candidate = None
+        self.rise_consistent = True
+        return True
+
+    def falling(self, tick, min_width, max_width):
+        """
+        Checks the width of the pulse ending at tick. A consistent edge starting a pulse of the
+        wrong width disqualifies the source until it is consistent again.
+        """
+        if self.rise is None:
+            return
+        width = timebase.tick_diff(self.rise, tick)
+        if not min_width <= width <= max_width:
+            self.bad_widths += 1
+            self._fault(True)
+            if self.rise_consistent:
+                self.valid_run = 0
+        self.rise = None
+
+    def measure_offset(self, offset, tick):
+        """
+        Adds a measured offset of the edge at tick against the edge of the active source.
+        """
+        if self.offset_tick == tick:
+            return
+        self.offset_tick = tick
+        if self.offset is None:
+            self.offset = float(offset)
+            return
+        error = offset - self.offset
+        self.offset += self.smoothing * error
+        self.wander += self.smoothing * (error * error - self.wander)
+
+    def status(self):
+        return {'gpio': self.gpio, 'score': self.score(), 'jitter_rms': math.sqrt(self.jitter), 'offset': self.offset, 'wander_rms': math.sqrt(self.wander),
+                'faults': self.faults, 'period': self.period, 'qualified': self.qualified(), 'edges': self.edges, 'rejected': self.rejected, 'bad_widths': self.bad_widths}
+
+
+class source_selector(object):
+
+    def __init__(self, gpios, glitch_filter=100, min_width=1000, max_width=900000, cycle_time=1000000.0, switch_margin=5.0, slew=1.0, loss_timeout=1.5, **source_settings):
+        """
+        Chooses between the input PPS sources on gpios, the first one being preferred when they
+        score the same. glitch_filter is the pigpiod glitch filter of the GPIOs in microseconds, and
+        pulses from min_width to max_width microseconds long are valid. A qualified source replaces
+        the active one when it scores switch_margin microseconds better, or the active one is lost for
+        loss_timeout periods. The offset carried over by a switch is slewed out by slew microseconds
+        per edge. See pps_source for the other settings.
+        """
+        self.gpios = list(gpios)
+        self.sources = dict((gpio, pps_source(gpio, cycle_time, **source_settings)) for gpio in self.gpios)
+        self.glitch_filter = glitch_filter
+        self.tick_delay = glitch_filter   # Delay of the reported ticks, none for edges not timed by callbacks
+        self.min_width = min_width
+        self.max_width = max_width
+        self.switch_margin = switch_margin
+        self.slew = slew
+        self.loss_timeout = loss_timeout
+
+        self.active = None                # Source handed over
+        self.carry = 0.0                  # Offset taken off the edges of the active source, in microseconds
+        self.pending = None               # (source, tick) of a backup edge waiting for the active one
+        self.last_forwarded = None
+        self.switches = 0
+
+    def settings(self):
+        return (tuple(self.gpios), self.glitch_filter, self.min_width, self.max_width)
+
+    def edge(self, gpio, level, tick):
+        """
+        Handles a level change of a source GPIO. Returns the (tick, cycle time) of the input PPS edges
+        to hand to the engine, the cycle time being None until measured.
+        """
+        source = self.sources[gpio]
+        tick = (tick - self.tick_delay) & timebase.TICK_MASK
+        edges = self.resolve(tick)
+        if level == 0:
+            source.falling(tick, self.min_width, self.max_width)
+            return edges
+        if level != 1:
+            return edges
+        consistent = source.rising(tick)
+        if self.active is None:
+            self.active = source
+            return edges + self.forward(tick, False)
+        if source is self.active:
+            self.pending = None
+            self.measure_offsets(source, tick)
+            return edges + self.forward(tick) if consistent else edges
+        if not consistent:
+            return edges
+        self.measure_offsets(source, tick)
+        if not source.qualified():
+            return edges
+        if self.lost(self.active, tick) or self.overdue(self.active, tick - int(round(source.offset or 0.0))):
+            if source is self.best(tick):
+                return edges + self.switch(source, tick)
+            return edges
+        if source is self.best() and source.score() + self.switch_margin < self.active.score():
+            return edges + self.switch(source, tick)
+        if self.active.last is None or abs(timebase.tick_diff(self.active.last, tick)) >= self.active.period / 2:
+            # Waits for the active edge of this second, handed over instead if that one is missed
+            if self.pending is None or source.score() < self.pending[0].score():
+                self.pending = (source, tick)
+        return edges
+
+    def resolve(self, tick):
+        """
+        Hands over the pending backup edge if the edge of the active source it waits for is overdue at tick.
+        """
+        if self.pending is None:
+            return []
+        source, edge = self.pending
+        if not self.overdue(self.active, tick):
+            return []
+        self.pending = None
+        return self.switch(source, edge)
+
+    def overdue(self, source, tick):
+        # Whether the edge of the source after its last one should have come by tick
+        return source.last is not None and timebase.tick_diff(source.last, tick) > source.period + source.limit()
+
+    def lost(self, source, tick):
+        return source.last is None or source.valid_run == 0 or timebase.tick_diff(source.last, tick) > self.loss_timeout * source.period
+
+    def best(self, tick=None):
+        """
+        Returns the qualified source with the best score, the earliest listed among equals, leaving
+        out those lost at tick.
+        """
+        qualified = [self.sources[gpio] for gpio in self.gpios if self.sources[gpio].qualified() and (tick is None or not self.lost(self.sources[gpio], tick))]
+        return min(qualified, key=lambda source: source.score()) if qualified else None
+
+    def measure_offsets(self, source, tick):
+        """
+        Measures the offsets of the sources against the active one at a consistent edge, and the
+        disagreement of each source with the median of them all.
+        """
+        active = self.active
+        period = active.period
+        if source is active:
+            active.offset = 0.0
+            for other in self.sources.values():
+                if other is not active and other.last is not None and abs(timebase.tick_diff(tick, other.last)) < period / 2:
+                    other.measure_offset(timebase.tick_diff(tick, other.last), other.last)
+        elif active.last is not None and abs(timebase.tick_diff(active.last, tick)) < period / 2:
+            source.measure_offset(timebase.tick_diff(active.last, tick), tick)
+        offsets = sorted(other.offset for other in self.sources.values() if other.offset is not None and (other is active or other.qualified()))
+        if len(offsets) >= 3:
+            median = offsets[len(offsets) // 2]
+            for other in self.sources.values():
+                other.disagreement = abs(other.offset - median) if other.offset is not None else 0.0
+        else:
+            for other in self.sources.values():
+                other.disagreement = 0.0
+
+    def switch(self, source, tick):
+        """
+        Makes source the active one from its edge at tick, carrying its offset over, and hands the edge over.
+        """
+        previous = self.active
+        if source.offset is not None:
+            self.carry += source.offset
+        for other in self.sources.values():
+            if other.offset is not None and source.offset is not None:
+                other.offset -= source.offset
+        self.active = source
+        self.pending = None
+        self.switches += 1
+        print ("PPS input switched from GPIO%d to GPIO%d, carrying %.1f us" % (previous.gpio, source.gpio, self.carry))
+        return self.forward(tick)
+
+    def forward(self, tick, measured=True):
+        """
+        Returns the edge of the active source at tick to hand over, less the carried offset, unless
+        an edge of the same second was handed over.
+        """
+        edge = (tick - int(round(self.carry))) & timebase.TICK_MASK
+        period = self.active.period
+        if self.last_forwarded is not None and abs(timebase.tick_diff(self.last_forwarded, edge)) < period / 2:
+            return []
+        self.last_forwarded = edge
+        self.carry -= max(-self.slew, min(self.slew, self.carry))
+        return [(edge, float(int(round(period))) if measured and self.active.intervals else None)]
+
+    def status(self):
+        """
+        Returns the GPIO of the active source, the carried offset, the switch count and the status
+        of every source.
+        """
+        return {'active': self.active.gpio if self.active is not None else None, 'carry': self.carry, 'switches': self.switches,
+                'sources': [self.sources[gpio].status() for gpio in self.gpios]}
@@ -0,0 +1,293 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  refclock.py
+#
+#  Feeds the input PPS edges, labelled with their UTC second by the timebase, to chrony or
+#  ntpd as reference clock samples, so the system clock is disciplined by the same edges
+#  the outputs are locked to.
+#
+#  Samples are written to the NTP shared memory segment of a unit (refclock SHM in chrony,
+#  the 127.127.28.x driver in ntpd) and/or sent to a chrony SOCK refclock socket. A sample
+#  pairs the UTC time of an edge with the system clock at that edge. The edge is a pigpio
+#  tick, so the system clock is read around pigpio tick reads, and the read with the shortest
+#  round trip places the tick against the system clock. This happens on a dedicated thread,
+#  the pigpio callback thread only queues the edge.
+#
+
+import collections
+import ctypes
+import ctypes.util
+import math
+import os
+import socket
+import threading
+import time
+
+import timebase
+
+SHM_KEY = 0x4e545030            # 'NTP0', the key of unit 0
+IPC_CREAT = 0o1000
+SOCK_MAGIC = 0x534f434b         # 'SOCK'
+
+LEAP_NONE = 0
+
+
+class shm_time(ctypes.Structure):
+    # struct shmTime of ntpd, chrony and gpsd, with the sizes and alignment of the local C ABI
+    _fields_ = [
+        ('mode', ctypes.c_int),
+        ('count', ctypes.c_int),
+        ('clockTimeStampSec', ctypes.c_long),
+        ('clockTimeStampUSec', ctypes.c_int),
+        ('receiveTimeStampSec', ctypes.c_long),
+        ('receiveTimeStampUSec', ctypes.c_int),
+        ('leap', ctypes.c_int),
+        ('precision', ctypes.c_int),
+        ('nsamples', ctypes.c_int),
+        ('valid', ctypes.c_int),
+        ('clockTimeStampNSec', ctypes.c_uint),
+        ('receiveTimeStampNSec', ctypes.c_uint),
+        ('dummy', ctypes.c_int * 8),
+    ]
+
+
+class sock_sample(ctypes.Structure):
+    # struct sock_sample of the chrony SOCK refclock
+    _fields_ = [
+        ('tv_sec', ctypes.c_long),
+        ('tv_usec', ctypes.c_long),
+        ('offset', ctypes.c_double),
+        ('pulse', ctypes.c_int),
+        ('leap', ctypes.c_int),
+        ('_pad', ctypes.c_int),
+        ('magic', ctypes.c_int),
+    ]
+
+
+_libc = None
+
+
+def _shm_functions():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmget.restype = ctypes.c_int
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmdt.restype = ctypes.c_int
+        _libc = libc
+    return _libc
+
+
+class shm_segment:
+
+    def __init__(self, unit=0, create=True):
+        """
+        Attaches the NTP shared memory segment of a unit, creating it unless create is False.
+        Units 0 and 1 are only accessible to root, as chrony and ntpd expect.
+        Raises OSError if the segment cannot be attached.
+        """
+        libc = _shm_functions()
+        self.unit = unit
+        permissions = 0o600 if unit < 2 else 0o666
+        self.id = libc.shmget(SHM_KEY + unit, ctypes.sizeof(shm_time), (IPC_CREAT if create else 0) | permissions)
+        if self.id == -1:
+            error = ctypes.get_errno()
+            raise OSError(error, 'shmget of NTP unit %d: %s' % (unit, os.strerror(error)))
+        address = libc.shmat(self.id, None, 0)
+        if address is None or address == ctypes.c_void_p(-1).value:
+            error = ctypes.get_errno()
+            raise OSError(error, 'shmat of NTP unit %d: %s' % (unit, os.strerror(error)))
+        self.address = address
+        self.shm = shm_time.from_address(address)
+
+    def write(self, clock_time, receive_time, precision=-20, leap=LEAP_NONE):
+        """
+        Publishes a sample: the true time clock_time and the system clock receive_time at the same
+        instant, both as (seconds since the epoch, nanoseconds).
+        The count is moved around the update so readers using mode 1 detect a torn sample.
+        """
+        shm = self.shm
+        shm.valid = 0
+        shm.mode = 1
+        shm.count += 1
+        shm.clockTimeStampSec = clock_time[0]
+        shm.clockTimeStampUSec = clock_time[1] // 1000
+        shm.clockTimeStampNSec = clock_time[1]
+        shm.receiveTimeStampSec = receive_time[0]
+        shm.receiveTimeStampUSec = receive_time[1] // 1000
+        shm.receiveTimeStampNSec = receive_time[1]
+        shm.leap = leap
+        shm.precision = precision
+        shm.nsamples = 3
+        shm.count += 1
+        shm.valid = 1
+
+    def read(self):
+        """
+        Reads and consumes a sample as chrony does, returning ((clock seconds, nanoseconds),
+        (receive seconds, nanoseconds), precision, leap), or None without a new consistent sample.
+        """
+        shm = self.shm
+        if not shm.valid:
+            return None
+        count = shm.count
+        sample = ((shm.clockTimeStampSec, shm.clockTimeStampNSec), (shm.receiveTimeStampSec, shm.receiveTimeStampNSec), shm.precision, shm.leap)
+        if shm.count != count or not shm.valid:
+            return None
+        shm.valid = 0
+        return sample
+
+    def close(self):
+        if self.address is not None:
+            _shm_functions().shmdt(self.address)
+            self.address = None
+            self.shm = None
+
+
+class sock_client:
+
+    def __init__(self, path):
+        """
+        Sends samples to the socket of a chrony SOCK refclock (refclock SOCK path).
+        """
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def write(self, clock_time, receive_time, pulse=False, leap=LEAP_NONE):
+        """
+        Sends a sample, see shm_segment.write(). Returns False if chrony is not listening.
+        """
+        sample = sock_sample()
+        sample.tv_sec = receive_time[0]
+        sample.tv_usec = receive_time[1] // 1000
+        sample.offset = (clock_time[0] - receive_time[0]) + (clock_time[1] - (receive_time[1] // 1000) * 1000) * 1e-9
+        sample.pulse = 1 if pulse else 0
+        sample.leap = leap
+        sample.magic = SOCK_MAGIC
+        try:
+            self.sock.sendto(bytes(bytearray(sample)), self.path)
+            return True
+        except socket.error:
+            return False
+
+    def close(self):
+        self.sock.close()
+
+
+def split_time(seconds):
+    """
+    Returns a time in seconds since the epoch as (whole seconds, nanoseconds).
+    """
+    whole = int(math.floor(seconds))
+    nanoseconds = int(round((seconds - whole) * 1e9))
+    if nanoseconds >= 1000000000:
+        whole, nanoseconds = whole + 1, nanoseconds - 1000000000
+    return whole, nanoseconds
+
+
+class refclock_publisher(threading.Thread):
+
+    def __init__(self, pi, shm_unit=None, sock_path=None, pulse=False, clock_reads=5, max_edges=4):
+        """
+        Thread publishing input PPS edges as reference clock samples to the NTP shared memory segment
+        shm_unit and/or the chrony SOCK refclock socket at sock_path.
+        With pulse, SOCK samples only carry the phase and chrony takes the seconds from another source.
+        clock_reads is the number of pigpio tick reads the system clock is placed against per sample.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pi = pi
+        self.pulse = pulse
+        self.clock_reads = clock_reads
+        self.shm = shm_segment(shm_unit) if shm_unit is not None else None
+        self.sock = sock_client(sock_path) if sock_path is not None else None
+        self.edges = collections.deque(maxlen=max_edges)
+        self.wake = threading.Event()
+        self.running = False
+
+        self.samples = 0
+        self.round_trip = None          # Shortest tick read round trip of the last sample in microseconds
+        self.offset = None              # True time less system clock at the last sample in seconds
+
+    def settings(self):
+        """
+        Returns the (shm_unit, sock_path, pulse) the publisher was started with.
+        """
+        return (self.shm.unit if self.shm is not None else None, self.sock.path if self.sock is not None else None, self.pulse)
+
+    def edge(self, tick, second):
+        """
+        Hands over an input PPS edge starting the given UTC second. Safe to call from the pigpio callback thread.
+        """
+        self.edges.append((tick, second))
+        self.wake.set()
+
+    def run(self):
+        while self.running:
+            self.wake.wait(1.0)
+            self.wake.clear()
+            while self.edges and self.running:
+                tick, second = self.edges.popleft()
+                self.publish(tick, second)
+
+    def clock_at(self, tick):
+        """
+        Returns the system clock at a recent pigpio tick, and the round trip of the tick read it is
+        placed against in microseconds.
+        """
+        best = None
+        for i in range(self.clock_reads):
+            before = time.time()
+            now = self.pi.get_current_tick()
+            after = time.time()
+            if best is None or after - before < best[0]:
+                best = (after - before, now, (before + after) / 2.0)
+        round_trip, now, system_time = best
+        return system_time - timebase.tick_diff(tick, now) / 1e6, round_trip * 1e6
+
+    def publish(self, tick, second):
+        """
+        Publishes the sample of an input PPS edge starting the given UTC second.
+        """
+        system_time, self.round_trip = self.clock_at(tick)
+        receive_time = split_time(system_time)
+        # Half the round trip bounds the error of placing the tick against the system clock
+        precision = int(math.floor(math.log(max(self.round_trip, 1.0) / 2e6, 2)))
+        if self.shm is not None:
+            self.shm.write((second, 0), receive_time, precision)
+        if self.sock is not None:
+            self.sock.write((second, 0), receive_time, self.pulse)
+        self.offset = second - system_time
+        self.samples += 1
+
+    def start(self):
+        self.running = True
+        threading.Thread.start(self)
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.is_alive():
+            self.join(1.0)
+        if self.shm is not None:
+            self.shm.close()
+        if self.sock is not None:
+            self.sock.close()
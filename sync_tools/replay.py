@@ -0,0 +1,346 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  replay.py
+#
+#  Offline replay of recorded input PPS edges through the PPS lock loop, for tuning its
+#  settings against the jitter and outages of a real GNSS receiver.
+#
+#  replay_step() follows the decisions waveform_engine.wave_callback() makes without servo:
+#  the output cycle time taken from the input intervals shorter than PPS_overtime_reject, the
+#  offset stepped by the slack beyond PPS_slack_threshold, and the rebuilt wave taking over at
+#  the end of the cycle of the wave it replaces. Every set of settings is one lane of NumPy
+#  arrays, and the lanes run through the output edges together, so a grid of settings costs
+#  little more than one of them. sweep() splits the lanes across processes.
+#  replay_engine() runs the waveform_engine itself on the simulated backend instead, which is
+#  much slower but covers the servo and the holdover as well, and checks replay_step().
+#
+
+import multiprocessing
+
+import numpy as np
+
+import pigpio
+import pigpio_sim
+import pps_servo
+import sync_generator
+import timebase
+
+PPS_INPUT_GPIO = 27
+PPS_OUTPUT_GPIO = 2
+
+SLACK_THRESHOLD = 5                 # waveform_engine defaults
+OVERTIME_REJECT = 1100000.0
+LOCK_THRESHOLD = 100.0
+LOSS_TIMEOUT = 1.5
+UPDATE_LATENCY = 250                # Output edge to wave sent, in microseconds: the callback and the update round trips
+FIRST_OUTPUT = 500000               # First output edge after the first input edge, in microseconds
+
+
+def load_ticks(filename):
+    """
+    Loads recorded input PPS rising edge ticks, one per line as written by tick_recorder (or a
+    NumPy .npy file), and returns them unwrapped as int64 microseconds from the first one.
+    """
+    if filename.endswith('.npy'):
+        ticks = np.load(filename)
+    else:
+        ticks = np.loadtxt(filename, dtype=np.int64, ndmin=1)
+    return unwrap(ticks)
+
+
+def unwrap(ticks):
+    """
+    Returns 32 bit pigpio ticks as int64 microseconds from the first one, across the wraps.
+    """
+    ticks = np.asarray(ticks, dtype=np.int64)
+    if not len(ticks):
+        return ticks
+    return np.concatenate(([0], np.cumsum(np.diff(ticks) & timebase.TICK_MASK)))
+
+
+class tick_recorder:
+
+    def __init__(self, pi, gpio, filename):
+        """
+        Records the rising edge ticks of an input GPIO to a file, one per line, for replay.
+        Can run alongside run_sync.py, as pigpiod serves callbacks to several clients.
+        """
+        self.pi = pi
+        self.gpio = gpio
+        self.file = open(filename, 'a')
+        self.count = 0
+        self.callback = None
+
+    def start(self):
+        self.pi.set_mode(self.gpio, pigpio.INPUT)
+        self.callback = self.pi.callback(self.gpio, pigpio.RISING_EDGE, self.edge)
+
+    def edge(self, gpio, level, tick):
+        self.file.write('%d\n' % tick)
+        self.file.flush()
+        self.count += 1
+
+    def stop(self):
+        if self.callback is not None:
+            self.callback.cancel()
+            self.callback = None
+        self.file.close()
+
+
+def grid(**settings):
+    """
+    Returns the lanes of a parameter grid, as a dictionary of equally long arrays holding every
+    combination of the values listed for each setting (i.e. slack_threshold=[2, 5, 10]).
+    """
+    names = sorted(settings)
+    values = np.meshgrid(*[np.asarray(settings[name], dtype=float) for name in names], indexing='ij')
+    return dict((name, value.ravel()) for name, value in zip(names, values))
+
+
+def replay_step(ticks, slack_threshold=SLACK_THRESHOLD, overtime_reject=OVERTIME_REJECT, lock_threshold=LOCK_THRESHOLD,
+                update_latency=UPDATE_LATENCY, first_output=FIRST_OUTPUT):
+    """
+    Replays unwrapped input PPS ticks through the lock loop without servo for every lane of settings,
+    each given as a scalar or an array with one value per lane.
+    Returns a dictionary of arrays with one value per lane:
+    rebuilds, the wave rebuilds; lock_time, the seconds from the first input edge to the first output
+    edge the waveform_engine reports as locked (NaN if never); rms_error, mean_abs_error and max_error,
+    of the output PPS slack after that; unlocked_edges, output edges not locked after that; and edges.
+    """
+    ticks = np.asarray(ticks, dtype=np.int64)
+    settings = np.broadcast_arrays(np.asarray(slack_threshold, dtype=float), np.asarray(overtime_reject, dtype=float),
+                                   np.asarray(lock_threshold, dtype=float), np.asarray(update_latency, dtype=np.int64),
+                                   np.asarray(first_output, dtype=np.int64))
+    slack_threshold, overtime_reject, lock_threshold, update_latency, first_output = [np.atleast_1d(setting).ravel() for setting in settings]
+    lanes = len(slack_threshold)
+    result = dict((name, np.zeros(lanes)) for name in ('rebuilds', 'lock_time', 'rms_error', 'mean_abs_error', 'max_error', 'unlocked_edges', 'edges'))
+    if len(ticks) < 2:
+        result['lock_time'][:] = np.nan
+        return result
+
+    # The output cycle time after each input edge, which follows the last interval shorter than the
+    # overtime reject, per distinct overtime reject. Column 0 is before the first input edge.
+    rejects, group = np.unique(overtime_reject, return_inverse=True)
+    intervals = np.concatenate(([1000000.0], np.diff(ticks)))
+    cycle_times = np.empty((len(rejects), len(ticks) + 1))
+    positions = np.arange(len(ticks))
+    for row, reject in enumerate(rejects):
+        accepted = np.concatenate(([True], intervals[1:] < reject))
+        cycle_times[row, 0] = 1000000.0
+        cycle_times[row, 1:] = intervals[np.maximum.accumulate(np.where(accepted, positions, 0))]
+
+    # The wave transmitted, with cycles of length starting at start and the output PPS edge at
+    # position in them, and the wave waiting to take over at switch (-1 for none)
+    length = np.full(lanes, 1000000, dtype=np.int64)
+    start = ticks[0] + first_output
+    position = np.zeros(lanes, dtype=np.int64)
+    switch = np.full(lanes, -1, dtype=np.int64)
+    next_length = length.copy()
+    next_position = position.copy()
+    offset = np.zeros(lanes)
+
+    last_edge = start - 1
+    last_input = np.full(lanes, -1, dtype=np.int64)
+    slack = np.full(lanes, np.nan)
+    locked_at = np.full(lanes, -1, dtype=np.int64)
+    error_sum = np.zeros(lanes)
+    error_squares = np.zeros(lanes)
+    error_max = np.zeros(lanes)
+    errors = np.zeros(lanes)
+    unlocked = np.zeros(lanes)
+    edges = np.zeros(lanes)
+    rebuilds = np.zeros(lanes)
+    end = ticks[-1] + 1000000
+
+    while True:
+        # The next output edge of each lane, in the wave taking over if its cycle has started
+        edge = start + position + length * ((last_edge - start - position) // length + 1)
+        switching = (switch >= 0) & (edge >= switch)
+        if switching.any():
+            start = np.where(switching, switch, start)
+            length = np.where(switching, next_length, length)
+            position = np.where(switching, next_position, position)
+            edge = np.where(switching, start + position, edge)
+            switch[switching] = -1
+        running = edge <= end
+        if not running.any():
+            break
+        last_edge = edge
+
+        # The input edges before the output edge, of which the last one is compared to it.
+        # An input edge at the same tick comes after it, as in the simulated backend.
+        index = np.searchsorted(ticks, edge, side='left') - 1
+        ticked = running & (index > last_input) & (index >= 0)
+        last_input = index
+        cycle_time = cycle_times[group, index + 1]
+        since = edge - ticks[np.maximum(index, 0)]
+        slack = np.where(ticked, np.where(since > cycle_time / 2, since - cycle_time, since), slack)
+
+        locked = running & (index >= 0) & (since <= LOSS_TIMEOUT * cycle_time) & (np.abs(slack) <= lock_threshold)
+        locked_at = np.where((locked_at < 0) & locked, edge, locked_at)
+        after_lock = running & (locked_at >= 0)
+        unlocked += after_lock & ~locked
+        edges += running
+        measured = ticked & after_lock
+        magnitude = np.where(measured, np.abs(slack), 0.0)
+        error_sum += magnitude
+        error_squares += magnitude * magnitude
+        error_max = np.maximum(error_max, magnitude)
+        errors += measured
+
+        # Offset steps, each rebuilding the wave, which takes over at the end of the current wave cycle
+        step = ticked & (since > slack_threshold) & (since < cycle_time - slack_threshold)
+        if step.any():
+            offset = np.where(step, offset + since, offset)
+            offset = np.where(step & (offset >= cycle_time), offset - cycle_time, offset)
+            sent = edge + update_latency
+            switched = step & (switch >= 0) & (switch <= sent)
+            start = np.where(switched, switch, start)
+            length = np.where(switched, next_length, length)
+            position = np.where(switched, next_position, position)
+            new_length = cycle_time.astype(np.int64)
+            next_length = np.where(step, new_length, next_length)
+            next_position = np.where(step, (new_length - np.round(offset).astype(np.int64)) % new_length, next_position)
+            switch = np.where(step, start + length * ((sent - start) // length + 1), np.where(switched, -1, switch))
+            rebuilds += step
+
+    result['rebuilds'] = rebuilds
+    result['lock_time'] = np.where(locked_at >= 0, (locked_at - ticks[0]) / 1e6, np.nan)
+    result['rms_error'] = np.where(errors > 0, np.sqrt(error_squares / np.maximum(errors, 1)), np.nan)
+    result['mean_abs_error'] = np.where(errors > 0, error_sum / np.maximum(errors, 1), np.nan)
+    result['max_error'] = np.where(errors > 0, error_max, np.nan)
+    result['unlocked_edges'] = unlocked
+    result['edges'] = edges
+    return result
+
+
+def replay_engine(ticks, slack_threshold=SLACK_THRESHOLD, overtime_reject=OVERTIME_REJECT, lock_threshold=LOCK_THRESHOLD,
+                  kp=None, ki=None, holdover=False, first_output=FIRST_OUTPUT):
+    """
+    Replays unwrapped input PPS ticks through a waveform_engine on the simulated backend, with the
+    servo when kp and ki are given, and returns a dictionary of the values replay_step() returns for a lane.
+    The error is the output PPS slack, or the phase error of the servo.
+    """
+    # The recording is moved to start a second into the simulation, as a tick of 0 counts as no input edge
+    ticks = np.asarray(ticks, dtype=np.int64) - ticks[0] + 1000000
+    pi = pigpio_sim.simulated_pi()
+    pi.add_PPS_recording(PPS_INPUT_GPIO, ticks)
+    generator = sync_generator.waveform_engine(pi)
+    generator.set_PPS_input_gpio(PPS_INPUT_GPIO)
+    generator.set_PPS_output_gpio(PPS_OUTPUT_GPIO)
+    generator.set_PPS_slack_threshold(slack_threshold)
+    generator.set_PPS_overtime_reject_threshold(overtime_reject)
+    generator.PPS_lock_threshold = lock_threshold
+    generator.holdover_enabled = holdover
+    if kp is not None:
+        generator.set_PPS_servo(pps_servo.pps_servo(kp=kp, ki=ki))
+    generator.start_PPS_input_sychronization()
+    # The output PPS edges are at the start of the wave, which starts first_output after the first input edge
+    pi.run_until(int(ticks[0]) + first_output)
+    generator.update()
+    rebuilds = generator.rebuild_count
+
+    state = {'locked_at': None, 'input': None, 'errors': [], 'unlocked': 0, 'edges': 0}
+
+    def output_edge(gpio, level, tick):
+        # Runs after the callback of the generator, which was set up first
+        locked = generator.lock_state() == pps_servo.LOCKED
+        if locked and state['locked_at'] is None:
+            state['locked_at'] = pi.now - int(ticks[0])
+        state['edges'] += 1
+        if state['locked_at'] is None:
+            return
+        state['unlocked'] += not locked
+        if generator.PPS_servo is not None:
+            if generator.PPS_servo.error is not None:
+                state['errors'].append(generator.PPS_servo.error)
+        elif generator.PPS_input_tick != state['input'] and generator.PPS_slack is not None:
+            state['errors'].append(generator.PPS_slack)
+        state['input'] = generator.PPS_input_tick
+
+    callback = pi.callback(PPS_OUTPUT_GPIO, pigpio.RISING_EDGE, output_edge)
+    pi.run_until(int(ticks[-1]) + 1000000)
+    callback.cancel()
+    generator.cancel()
+
+    errors = np.abs(np.array(state['errors'], dtype=float))
+    return {
+        'rebuilds': generator.rebuild_count - rebuilds,
+        'lock_time': state['locked_at'] / 1e6 if state['locked_at'] is not None else np.nan,
+        'rms_error': float(np.sqrt(np.mean(errors * errors))) if len(errors) else np.nan,
+        'mean_abs_error': float(np.mean(errors)) if len(errors) else np.nan,
+        'max_error': float(np.max(errors)) if len(errors) else np.nan,
+        'unlocked_edges': state['unlocked'],
+        'edges': state['edges'],
+    }
+
+
+def _replay_chunk(arguments):
+    ticks, lanes, fixed = arguments
+    settings = dict(fixed)
+    settings.update(lanes)
+    return replay_step(ticks, **settings)
+
+
+def sweep(ticks, lanes, processes=None, **fixed):
+    """
+    Replays the ticks with replay_step() for every lane of settings (see grid()), split across
+    processes (all cores by default). Further settings are passed to replay_step() for all lanes.
+    Returns a list of dictionaries, one per lane, holding its settings and results.
+    """
+    count = len(next(iter(lanes.values())))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, count))
+    bounds = np.linspace(0, count, processes + 1).astype(int)
+    chunks = [(ticks, dict((name, values[first:last]) for name, values in lanes.items()), fixed) for first, last in zip(bounds[:-1], bounds[1:])]
+    if processes == 1:
+        results = [_replay_chunk(chunk) for chunk in chunks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_replay_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    rows = []
+    for chunk, result in zip(chunks, results):
+        chunk_lanes = chunk[1]
+        for i in range(len(result['edges'])):
+            row = dict((name, float(values[i])) for name, values in chunk_lanes.items())
+            row.update((name, float(values[i])) for name, values in result.items())
+            rows.append(row)
+    return rows
+
+
+def best(rows, key='rms_error', max_lock_time=None):
+    """
+    Returns the rows sorted by a result, lowest first, leaving out those which never locked or,
+    with max_lock_time, locked later than that many seconds.
+    """
+    kept = [row for row in rows if not np.isnan(row['lock_time']) and (max_lock_time is None or row['lock_time'] <= max_lock_time)]
+    return sorted(kept, key=lambda row: (row[key], row['rebuilds']))
+
+
+def format_rows(rows, names):
+    lines = []
+    lines.append(' '.join('%15s' % name for name in names) + ' %9s %9s %9s %9s %9s' % ('rebuilds', 'lock s', 'rms us', 'max us', 'unlocked'))
+    for row in rows:
+        lines.append(' '.join('%15g' % row[name] for name in names) + ' %9d %9.1f %9.2f %9.1f %9d' % (
+            row['rebuilds'], row['lock_time'], row['rms_error'], row['max_error'], row['unlocked_edges']))
+    return '\n'.join(lines)
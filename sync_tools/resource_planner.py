@@ -0,0 +1,359 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  resource_planner.py
+#
+#  Dry-run compilation of an output configuration against the wave resources of pigpiod.
+#
+#  The waves of a configuration are compiled as the waveform_engine would, without hardware,
+#  and checked against pigpiod's limits on pulses per wave, DMA control blocks and waves,
+#  counting the waves that exist together while one replaces another. The plan also reports
+#  the minimum edge spacing, the shortest pulse of every output, the timing quantization of
+#  the whole microsecond edges and an estimate of the rebuild time. For configurations that
+#  do not fit, placements that would are suggested: wave chaining, hardware PWM and clocks,
+#  and phases merging the edges of harmonic triggers.
+#
+
+import fractions
+import time
+
+import numpy as np
+
+import hardware_outputs
+import wave_compiler
+
+MAX_PULSES = wave_compiler.MAX_WAVE_PULSES     # pigpiod pulses per wave
+MAX_CBS = 25016             # pigpiod DMA control blocks of all waves, see pi.wave_get_max_cbs()
+MAX_WAVES = 250             # pigpiod waves
+CBS_PER_PULSE = 2           # control blocks of a pulse: the GPIO writes and the delay
+MIN_PULSE_WIDTH = 1.0       # shortest high or low time in microseconds, shorter pulses vanish
+ROUND_TRIP = 150e-6         # estimated pigpiod command round trip in seconds
+PULSE_TIME = 1e-6           # estimated pigpiod time to receive and create a pulse in seconds
+MAX_FREQUENCY_CHANGE = 0.01 # largest relative change of a suggested trigger frequency
+
+
+class resource_plan(object):
+
+    def __init__(self):
+        """
+        Resource usage of an output configuration, see plan().
+        Times are in microseconds, except compile_time and rebuild_time in seconds.
+        """
+        self.seconds = 1                # PPS periods spanned by the wave
+        self.chain = False              # Compressed into a wave chain
+        self.pulses = 0                 # Pulses of the wave, or of all waves of the chain
+        self.largest_wave = 0           # Pulses of the largest single wave
+        self.waves = 0                  # Waves existing together while one replaces another
+        self.cbs = 0                    # Control blocks of those waves
+        self.chain_bytes = 0
+        self.min_spacing = None         # Shortest time between two distinct edge times
+        self.pulse_widths = {}          # Shortest high or low time by GPIO
+        self.quantization = 0.0         # Largest truncation of an edge to whole microseconds
+        self.frequency_errors = {}      # Frequency error of hardware PWM outputs in ppm by GPIO
+        self.paths = {}                 # hardware_outputs.WAVE, PWM or CLOCK by GPIO
+        self.compile_time = 0.0
+        self.rebuild_time = 0.0
+        self.problems = []
+        self.suggestions = []
+
+    def fits(self):
+        return not self.problems
+
+
+def plan(PPS_gpio=-1, PPS_duty=0.2, triggers=(), chaining=False, servo=False, hardware_offload=False,
+         min_frequency=1000, revision=0, cycle_time=1000000.0, suggest=True, segments=None, synchronized=False,
+         phase_tolerance=50.0, pwm_restart_interval=hardware_outputs.MIN_PWM_RESTART_INTERVAL):
+    """
+    Compiles an output configuration as a waveform_engine would and returns its resource_plan.
+    triggers is a list of (gpio, frequency, phase, duty). revision is the hardware revision code
+    setting the hardware output limits, see hardware_outputs.peripheral_limits(). With synchronized,
+    the output PPS follows an input PPS, which keeps the triggers on PWM pins in the wave unless
+    pwm_restart_interval is 0 or the wave could not hold them, see hardware_outputs.place().
+    Unless suggest is False, placements that fit are suggested for a configuration that does not.
+    The wave is compiled into segments when given, a wave_compiler.segment_store a waveform_engine
+    can take over so its first update finds the wave compiled.
+    """
+    result = resource_plan()
+    try:
+        triggers = [(gpio, wave_compiler.rational_frequency(frequency), phase, duty) for gpio, frequency, phase, duty in triggers]
+    except ValueError as e:
+        result.problems.append(str(e))
+        return result
+    gpios = [gpio for gpio, frequency, phase, duty in triggers] + ([PPS_gpio] if PPS_gpio != -1 else [])
+    for gpio in sorted(set(gpios)):
+        if not 0 <= gpio < 32:
+            result.problems.append('GPIO%d does not exist' % gpio)
+        elif gpios.count(gpio) > 1:
+            result.problems.append('GPIO%d is used by several outputs' % gpio)
+    seconds = wave_compiler.hyperperiod(triggers)
+    if seconds > wave_compiler.MAX_HYPERPERIOD:
+        result.problems.append('triggers only repeat after %d seconds' % seconds)
+    if result.problems:
+        return result
+
+    placement = {}
+    if hardware_offload and PPS_gpio != -1:
+        placement = hardware_outputs.place(triggers, min_frequency, revision, crystal_ppm=None if synchronized else 0.0,
+                                           tolerance=phase_tolerance, min_pwm_restart_interval=pwm_restart_interval)
+        if synchronized and pwm_restart_interval > 0:
+            # As the engine does, PWM pins stay on PWM where the wave could not hold them
+            restarted = hardware_outputs.place(triggers, min_frequency, revision, crystal_ppm=None,
+                                               tolerance=phase_tolerance, min_pwm_restart_interval=0)
+            if restarted != placement:
+                trial = resource_plan()
+                _compile(trial, cycle_time, PPS_gpio, PPS_duty, [trigger for trigger in triggers if trigger[0] not in placement], chaining, servo)
+                if trial.largest_wave > MAX_PULSES:
+                    placement = restarted
+    for gpio in gpios:
+        result.paths[gpio] = placement[gpio][0] if gpio in placement else hardware_outputs.WAVE
+    for gpio, (kind, actual) in placement.items():
+        if kind == hardware_outputs.PWM:
+            frequency = [trigger[1] for trigger in triggers if trigger[0] == gpio][0]
+            result.frequency_errors[gpio] = (actual / float(frequency) - 1.0) * 1e6
+    wave_triggers = [trigger for trigger in triggers if trigger[0] not in placement]
+    _compile(result, cycle_time, PPS_gpio, PPS_duty, wave_triggers, chaining, servo, segments)
+
+    if suggest and result.problems:
+        _suggest(result, cycle_time, PPS_gpio, PPS_duty, triggers, wave_triggers, chaining, servo, min_frequency, revision,
+                 not synchronized or pwm_restart_interval == 0)
+    return result
+
+
+def _compile(result, cycle_time, PPS_gpio, PPS_duty, triggers, chaining, servo, segments=None):
+    # Fills in the wave resources, timing and problems of a resource_plan for the triggers in the wave
+    seconds = wave_compiler.hyperperiod(triggers)
+    result.seconds = seconds
+    start = time.time()
+    chain = None
+    chain_error = None
+    if chaining:
+        try:
+            chain = wave_compiler.compile_chain(cycle_time, 0.0, PPS_gpio, PPS_duty, triggers, seconds)
+        except ValueError as e:
+            chain_error = str(e)
+    if chain is not None:
+        timeline = chain.timeline()
+        result.chain = True
+        result.pulses = chain.pulse_count()
+        result.largest_wave = max(len(pulses) for pulses in chain.waves)
+        # The new chain is created before the old one is deleted
+        result.waves = 2 * len(chain.waves)
+        result.cbs = 2 * CBS_PER_PULSE * result.pulses
+        result.chain_bytes = len(chain.chain_data(list(range(len(chain.waves)))))
+        round_trips = len(chain.waves) * 2 + 3
+        created = result.pulses
+    else:
+        if segments is None:
+            segments = wave_compiler.segment_store()
+        timeline = segments.timeline(cycle_time, 0.0, PPS_gpio, PPS_duty, triggers, seconds)
+        result.pulses = result.largest_wave = len(timeline)
+        timeline.pulses()
+        # The new wave (and its servo variant) is created while the old ones still transmit
+        copies = 2 if servo and seconds == 1 else 1
+        result.waves = 2 * copies
+        result.cbs = result.waves * CBS_PER_PULSE * result.pulses
+        round_trips = 2 * copies + 2
+        created = copies * result.pulses
+    result.compile_time = time.time() - start
+    result.rebuild_time = result.compile_time + round_trips * ROUND_TRIP + created * PULSE_TIME
+
+    if len(timeline) > 1:
+        result.min_spacing = int(np.diff(timeline.times).min())
+    quantization = 0.0
+    for output in wave_compiler.output_phases(cycle_time, 0.0, PPS_gpio, PPS_duty, triggers):
+        gpio, period, rising, on_time = output
+        if 0 < on_time < period:
+            result.pulse_widths[gpio] = min(on_time, period - on_time)
+            times = wave_compiler.output_edges(output, 0.0, cycle_time * seconds)[1][1:]
+            if len(times):
+                quantization = max(quantization, float(np.max(times - np.floor(times + 1e-6))))
+    result.quantization = quantization
+
+    if result.largest_wave > MAX_PULSES:
+        result.problems.append('%d pulses in one wave, pigpiod takes %d' % (result.largest_wave, MAX_PULSES))
+    if result.cbs > MAX_CBS:
+        result.problems.append('%d control blocks for %d waves of %d pulses, pigpiod has %d' % (result.cbs, result.waves, result.pulses, MAX_CBS))
+    if result.waves > MAX_WAVES:
+        result.problems.append('%d waves, pigpiod has %d' % (result.waves, MAX_WAVES))
+    for gpio, width in sorted(result.pulse_widths.items()):
+        if width < MIN_PULSE_WIDTH:
+            result.problems.append('GPIO%d pulses of %.2f us vanish at whole microsecond resolution' % (gpio, width))
+    if chain_error is not None and result.problems:
+        result.problems.append('no wave chain: %s' % chain_error)
+
+
+def _suggest(result, cycle_time, PPS_gpio, PPS_duty, triggers, wave_triggers, chaining, servo, min_frequency, revision, pwm):
+    # Adds the placements that fit to the suggestions of a resource_plan that does not
+    def fits(wave_triggers, chaining=chaining):
+        trial = resource_plan()
+        _compile(trial, cycle_time, PPS_gpio, PPS_duty, wave_triggers, chaining, servo)
+        return trial
+
+    if not chaining:
+        trial = fits(wave_triggers, True)
+        if trial.chain and trial.fits():
+            result.suggestions.append('Set USE_WAVE_CHAINS = True: %d pulses in %d block waves' % (trial.pulses, trial.waves // 2))
+
+    moves = hardware_moves(triggers, PPS_gpio, revision, pwm)
+    if moves:
+        moved = set(gpio for gpio, target, kind in moves)
+        trial = fits([trigger for trigger in wave_triggers if trigger[0] not in moved])
+        if trial.fits():
+            text = ', '.join('GPIO%d on %s GPIO%d' % (gpio, kind, target) if target != gpio else 'GPIO%d by %s' % (gpio, kind) for gpio, target, kind in moves)
+            lowest = min(trigger[1] for trigger in triggers if trigger[0] in moved)
+            if lowest < min_frequency:
+                text += ' with HARDWARE_MIN_FREQUENCY = %d' % lowest
+            result.suggestions.append('Set USE_HARDWARE_OUTPUTS = True and generate %s: %d pulses left in the wave' % (text, trial.pulses))
+
+    aligned = [(gpio, frequency, 0, duty) for gpio, frequency, phase, duty in wave_triggers]
+    if any(trigger[2] for trigger in wave_triggers):
+        trial = fits(aligned)
+        if trial.fits() or trial.pulses < 0.8 * result.pulses:
+            result.suggestions.append('Set the phases of GPIO%s to 0 to merge their edges: %d pulses%s' % (
+                ', '.join(str(trigger[0]) for trigger in wave_triggers if trigger[2]), trial.pulses, '' if trial.fits() else ', still too many'))
+
+    if result.seconds > 1:
+        for i, (gpio, frequency, phase, duty) in enumerate(wave_triggers):
+            for nearby in nearby_frequencies(frequency):
+                changed = wave_triggers[:i] + [(gpio, nearby, phase, duty)] + wave_triggers[i + 1:]
+                if wave_compiler.hyperperiod(changed) >= result.seconds:
+                    continue
+                trial = fits(changed)
+                if trial.fits():
+                    result.suggestions.append('A frequency of %s instead of %s Hz on GPIO%d repeats after %d seconds: %d pulses' % (
+                        wave_compiler.format_frequency(nearby), wave_compiler.format_frequency(frequency), gpio, trial.seconds, trial.pulses))
+                    break
+
+    for gpio, width in sorted(result.pulse_widths.items()):
+        if width < MIN_PULSE_WIDTH:
+            result.suggestions.append('Lower the frequency of GPIO%d, or bring its duty closer to 0.5' % gpio)
+    if not result.suggestions:
+        result.suggestions.append('Lower the trigger frequencies or remove triggers')
+
+
+def nearby_frequencies(frequency, max_denominator=10):
+    """
+    Returns the frequencies of up to max_denominator PPS periods within MAX_FREQUENCY_CHANGE of a frequency,
+    other than the frequency itself, the closest first.
+    """
+    frequency = fractions.Fraction(frequency)
+    nearby = set()
+    for denominator in range(1, max_denominator + 1):
+        candidate = fractions.Fraction(int(round(frequency * denominator)), denominator)
+        if candidate > 0 and candidate != frequency and abs(candidate / frequency - 1) <= MAX_FREQUENCY_CHANGE:
+            nearby.add(candidate)
+    return sorted(nearby, key=lambda candidate: (abs(candidate - frequency), candidate.denominator))
+
+
+def hardware_moves(triggers, PPS_gpio=-1, revision=0, pwm=True):
+    """
+    Returns (gpio, target gpio, kind) for the fastest whole frequency triggers that hardware PWM or clocks
+    could generate, on their own pin if it has the hardware or on a free pin that does.
+    Without pwm, as while synchronizing to an input PPS, only clocks are considered.
+    """
+    pwm_base, clock_min = hardware_outputs.peripheral_limits(revision)
+    used = set(trigger[0] for trigger in triggers) | set([PPS_gpio])
+    taken = set()
+    moves = []
+    for gpio, frequency, phase, duty in sorted(triggers, key=lambda trigger: -trigger[1]):
+        if frequency != int(frequency) or not 0 < duty < 1:
+            continue
+        candidates = []
+        if duty == 0.5 and frequency >= clock_min:
+            candidates += [(pin, hardware_outputs.CLOCK, (hardware_outputs.CLOCK, channel)) for pin, channel in sorted(hardware_outputs.CLOCK_CHANNELS.items())]
+        if pwm and abs(hardware_outputs.pwm_frequency(frequency, pwm_base) / frequency - 1.0) <= hardware_outputs.MAX_FREQUENCY_ERROR:
+            candidates += [(pin, hardware_outputs.PWM, (hardware_outputs.PWM, channel)) for pin, channel in sorted(hardware_outputs.PWM_CHANNELS.items())]
+        # The trigger's own pin first, then the free ones
+        candidates.sort(key=lambda candidate: candidate[0] != gpio)
+        for pin, kind, channel in candidates:
+            if channel not in taken and (pin == gpio or pin not in used):
+                moves.append((gpio, pin, kind))
+                taken.add(channel)
+                used.add(pin)
+                break
+    return moves
+
+
+def config_plan(cfg, revision=None, suggest=True, segments=None):
+    """
+    Returns the resource_plan of a sync_config module. The hardware revision defaults to the local one.
+    The triggers of a cluster node are placed by its coordinator, so only its PPS output is planned.
+    See plan() for segments.
+    """
+    if revision is None:
+        revision = local_revision()
+    triggers = []
+    if cfg.CLUSTER_ROLE is None:
+        triggers = [(gpio, frequency, phase, duty) for gpio, frequency, phase, duty in zip(cfg.TRIGGER_GPIOS, cfg.TRIGGER_FREQUENCIES, cfg.TRIGGER_PHASES, cfg.TRIGGER_DUTYS) if gpio != -1]
+    return plan(cfg.PPS_OUTPUT_GPIO, cfg.PPS_OUTPUT_DUTY, triggers, cfg.USE_WAVE_CHAINS, cfg.USE_PPS_SERVO,
+                cfg.USE_HARDWARE_OUTPUTS, cfg.HARDWARE_MIN_FREQUENCY, revision, suggest=suggest, segments=segments,
+                synchronized=cfg.USE_SYNC and cfg.PPS_INPUT_GPIO != -1, phase_tolerance=cfg.HARDWARE_PHASE_TOLERANCE,
+                pwm_restart_interval=cfg.HARDWARE_PWM_RESTART_INTERVAL)
+
+
+def engine_plan(generator, triggers, suggest=False):
+    """
+    Returns the resource_plan of a waveform_engine with the given triggers, a list of
+    (gpio, frequency, phase, duty), and its other settings, for checking a change before it is made.
+    """
+    revision = generator.hardware_revision
+    if revision is None:
+        revision = local_revision()
+    return plan(generator.PPS_output_gpio, generator.PPS_duty_cycle_fraction, triggers, generator.wave_chaining,
+                generator.PPS_servo is not None, generator.hardware_offload, generator.hardware_min_frequency, revision,
+                generator.PPS_output_cycle_time, suggest=suggest, synchronized=generator.callbacks_set,
+                phase_tolerance=generator.hardware_phase_tolerance, pwm_restart_interval=generator.hardware_pwm_restart_interval)
+
+
+def local_revision():
+    """
+    Returns the hardware revision code of this Raspberry Pi from /proc/cpuinfo, or 0 elsewhere.
+    """
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('Revision'):
+                    return int(line.split(':')[1].strip(), 16)
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+
+def format_report(result):
+    """
+    Returns a resource_plan as text.
+    """
+    lines = []
+    if result.pulses or result.paths:
+        lines.append('wave: %s over %d s, %d pulses (largest wave %d of %d), %d waves and %d of %d control blocks during a switchover' % (
+            'wave chain' if result.chain else 'flat wave', result.seconds, result.pulses, result.largest_wave, MAX_PULSES,
+            result.waves, result.cbs, MAX_CBS))
+        if result.chain:
+            lines.append('chain: %d bytes of %d' % (result.chain_bytes, wave_compiler.MAX_CHAIN_BYTES))
+        lines.append('timing: %s us minimum edge spacing, edges up to %.2f us early from whole microsecond truncation' % (
+            result.min_spacing if result.min_spacing is not None else '-', result.quantization))
+        for gpio in sorted(result.paths):
+            width = result.pulse_widths.get(gpio)
+            error = result.frequency_errors.get(gpio)
+            lines.append('  GPIO%-2d %-5s %s%s' % (gpio, result.paths[gpio], 'shortest pulse %.1f us' % width if width is not None else '',
+                                                  ', frequency %+.2f ppm' % error if error is not None else ''))
+        lines.append('rebuild: %.1f ms (%.1f ms compiling here)' % (result.rebuild_time * 1000, result.compile_time * 1000))
+    for problem in result.problems:
+        lines.append('PROBLEM: %s' % problem)
+    for suggestion in result.suggestions:
+        lines.append('suggestion: %s' % suggestion)
+    lines.append('configuration fits' if result.fits() else 'configuration does not fit')
+    return '\n'.join(lines)
@@ -0,0 +1,109 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  service.py
+#
+#  Runtime of the synchronization service.
+#
+#  The main thread has nothing to do between signals, as the outputs are driven by pigpiod
+#  and the PPS edges are handled in the pigpio callback thread, so it blocks on the signal
+#  event and only wakes up for engine housekeeping and systemd watchdog pings.
+#  Readiness, reloads, status and watchdog pings are reported with the systemd notify
+#  protocol when started as a Type=notify service, and ignored otherwise.
+#
+
+import os
+import socket
+import time
+
+
+def notify(state):
+    """
+    Sends a state string (i.e. 'READY=1') to systemd. Returns False when not run by systemd.
+    """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        address = '\0' + address[1:]    # Abstract namespace socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(address)
+        sock.sendall(state.encode('ascii'))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def watchdog_interval():
+    """
+    Returns the systemd watchdog timeout in seconds, or None when the watchdog is not enabled for this process.
+    """
+    usec = os.environ.get('WATCHDOG_USEC')
+    pid = os.environ.get('WATCHDOG_PID')
+    if not usec or (pid and int(pid) != os.getpid()):
+        return None
+    return int(usec) / 1000000.0
+
+
+class service_runtime:
+
+    def __init__(self, signals, housekeeping=None, reload=None, housekeeping_interval=1.0, healthy=None):
+        """
+        Runs the service until SIGINT or SIGTERM, on a SignalProcessor.
+        housekeeping is called every housekeeping_interval seconds and reload on SIGHUP.
+        healthy returns whether the watchdog may be pinged, so systemd restarts a service that lost pigpiod.
+        """
+        self.signals = signals
+        self.housekeeping = housekeeping
+        self.reload = reload
+        self.housekeeping_interval = housekeeping_interval
+        self.healthy = healthy
+        self.watchdog = watchdog_interval()
+        self.wakeups = 0
+
+    def ready(self, status=None):
+        notify('READY=1' + ('\nSTATUS=' + status if status else ''))
+
+    def run(self):
+        """
+        Blocks until the service is asked to stop.
+        """
+        interval = self.housekeeping_interval
+        if self.watchdog is not None:
+            interval = min(interval, self.watchdog / 2.0)
+        next_housekeeping = time.time() + self.housekeeping_interval
+        while not self.signals.exit_now:
+            self.signals.wait(max(0.0, min(interval, next_housekeeping - time.time())))
+            self.wakeups += 1
+            if self.signals.exit_now:
+                break
+            if self.signals.reload_now:
+                self.signals.reload_now = False
+                notify('RELOADING=1')
+                if self.reload is not None:
+                    self.reload()
+                self.ready()
+            now = time.time()
+            if now >= next_housekeeping:
+                next_housekeeping = now + self.housekeeping_interval
+                if self.housekeeping is not None:
+                    self.housekeeping()
+            if self.watchdog is not None and (self.healthy is None or self.healthy()):
+                notify('WATCHDOG=1')
+        notify('STOPPING=1')
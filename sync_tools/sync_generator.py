@@ -20,10 +20,36 @@
 #  Created on: April 19th 2020
 #
 
+import collections
+import edge_script
+import hardware_outputs
+import holdover
+import nmea_sender
 import pigpio
-import utils
-import socket
+import pps_servo
+import pps_sources
+import refclock
+import telemetry
+import threading
 import time
+import timebase
+import trigger_log
+import wave_compiler
+
+FREE_RUNNING = 'free running'             # Lock states, see waveform_engine.lock_state()
+
+class trigger_output(object):
+    __slots__ = ('gpio', 'frequency', 'phase', 'duty')
+
+    def __init__(self, gpio, frequency, phase, duty):
+        """
+        Settings of one output trigger waveform.
+        Phase is in degrees and duty a decimal fraction.
+        """
+        self.gpio = gpio
+        self.frequency = frequency
+        self.phase = phase
+        self.duty = duty
 
 class waveform_engine:
 
@@ -45,25 +71,82 @@ class waveform_engine:
         self.PPS_output_tick = 0
         self.PPS_output_offset = 0.0              # PPS offset in microseconds
         self.PPS_slack_threshold = 5              # PPS slack limit requiring correction in microseconds
+        self.PPS_lock_threshold = 100.0           # PPS slack limit within which the output counts as locked without servo
+        self.PPS_slack = None                     # Signed slack of the last output PPS edge without servo in microseconds
         self.PPS_overtime_reject = 1100000.0      # Reject PPS frequency measurement if it has been too long (GPS lost)
+        self.PPS_servo = None                     # pps_servo disciplining the output, or None to step the offset
+        self.slew_remainder = 0.0                 # Servo cycle time correction not yet applied, in microseconds
+        self.slew_rebuild_threshold = 3.0         # Servo cycle time change requiring a wave rebuild in microseconds
+        self.holdover = holdover.holdover_model() # Oscillator model predicting the input PPS while it is lost
+        self.holdover_enabled = True
+        self.PPS_reacquire_step = 10              # Largest offset step per period after a holdover without servo, in microseconds
 
 
-        self.trigger_output_gpio = []
-        self.trigger_output_frequency = []
-        self.trigger_output_phase = []            # Phase difference from base (PPS) output
-        self.trigger_duty_cycle_fraction = []
+        self.trigger_outputs = collections.OrderedDict()    # trigger_output records by GPIO
 
         self.wave = None
+        self.wave_variants = []                   # Waves one microsecond apart in length the servo selects from
+        self.rebuild_count = 0
+        self.timeline = None                      # Edge timeline of the wave last sent, see compile()
+        self.retired_waves = []                   # Waves replaced by a pending switchover, deleted once it is confirmed
+        self.handover_tick = None                 # Tick a pending synchronized switchover was requested at
+        self.handover_switch_tick = None          # Tick the current wave cycle ends at, when a pending switchover happens
+        self.wave_PPS_position = None             # (cycle time, time of the PPS rising edge) in the wave being sent
+        self.handover_timeout = 2.5               # Cycles after which a pending switchover is forced
+        self.handover_callback = None             # Output PPS callback confirming switchovers without synchronization
+        self.switch_latency = None                # Measured delay of the last synchronized switchover in microseconds
+        self.handover_timeouts = 0
+        self.segments = wave_compiler.segment_store()
+        self.dirty_gpios = set()                  # Outputs changed since the last update
+        self.dirty_all = True                     # Every output changed since the last update
+        self.pending_changes = collections.deque()    # (change, done) queued from other threads, see schedule_change()
         self.stopped = False
 
+        self.wave_chaining = False                # Compress the PPS period into a wave chain where possible
+        self.chain_waves = []
+        self.chain_plan = None                    # wave_chain_plan of the running wave chain
+        self.chain_start_latency = 0.0            # Estimated delay between sending a wave chain and its start
+
+        self.hyperperiod = 1                      # PPS periods spanned by the wave being sent, see wave_compiler.hyperperiod()
+        self.hyperperiod_epoch = 0                # UTC second the hyperperiods are counted from
+        self.frame_origin_tick = None             # Tick at which the PPS period or hyperperiod of the offset last started
+        self.frame_offset = 0.0                   # Offset of the last output PPS rising edge
+        self.wave_start_tick = None               # Tick a cycle of the wave spanning several PPS periods started at
+
+        self.hardware_offload = False             # Generate eligible triggers with hardware PWM and clocks, see hardware_outputs.py
+        self.hardware_min_frequency = 1000        # Lowest trigger frequency moved out of the wave in Hertz
+        self.hardware_phase_tolerance = 50.0      # Phase error of a hardware output requiring a restart in microseconds
+        self.hardware_pwm_restart_interval = hardware_outputs.MIN_PWM_RESTART_INTERVAL   # Restart interval below which PWM pins stay in the wave
+        self.hardware_lock = threading.Lock()     # Held while placing or restarting the hardware outputs
+        self.hardware_restarts = collections.deque()  # Drifted clocks waiting for housekeeping() to restart them
+        self.hardware_outputs = {}                # hardware_output records by GPIO
+        self.hardware_revision = None
+        self.hardware_start_latency = 0.0         # Estimated delay between sending a command and its effect
+        self.wave_start_latency = 0.0             # Estimated delay between sending a wave started at once and its start
+        self.hardware_realignments = 0
+
         self.callbacks_set = False
         self.PPS_input_callback = None
+        self.PPS_sources = None                   # source_selector validating and choosing the input PPS edges, see set_PPS_sources()
+        self.PPS_source_callbacks = []
         self.PPS_output_callback = None
+        self.edge_script_enabled = False          # Time the PPS edges with a script in pigpiod, see set_edge_script()
+        self.edge_script = None                   # Thread polling the edges timed by the script
+        self.edge_script_poll_interval = 0.2      # Seconds between polls of the script, None to poll from the caller
 
-        self.sensor_port = 10110                    # Default for Velodyne
-        self.sensor_IP = None
-        self.socket = None
+        self.timebase = timebase.timebase()       # pigpio tick to UTC mapping, anchored on PPS edges
+        self.telemetry = telemetry.telemetry_buffer()    # Recent synchronization events, see telemetry.statistics()
+        self.trigger_log = None                   # Thread logging the trigger edge times
+        self.active_timeline = None               # Edge timeline of the wave being transmitted
+        self.NMEA_sender = None                   # Thread sending the spoof NMEA sentences
         self.spoof_NMEA = False
+        self.refclock = None                      # Thread feeding the input PPS edges to chrony or ntpd
+
+        self.gpio_modes = {}                      # Modes set on the GPIOs by GPIO
+        self.pending_modes = collections.OrderedDict()    # Modes to set with the next update by GPIO, see set_gpio_mode()
+        self.start_time = time.time()             # Time the service started, see startup_times()
+        self.first_edge_time = None               # Time the first wave or wave chain was started
+        self.lock_time = None                     # Time the output PPS first locked to the input PPS
 
     def set_PPS_input_gpio(self, gpio):
         """
@@ -71,7 +154,23 @@ class waveform_engine:
         If not set, no input PPS will be used.
         """
         self.PPS_input_gpio = gpio
-        self.pi.set_mode(gpio, pigpio.INPUT)
+        self.set_gpio_mode(gpio, pigpio.INPUT)
+
+    def set_PPS_sources(self, gpios, glitch_filter=100, min_width=1000, max_width=900000):
+        """
+        Validates the input PPS edges of the sources on gpios and hands over those of the best one,
+        see pps_sources.py. The first GPIO becomes the input PPS GPIO and is preferred. glitch_filter
+        is the pigpiod glitch filter set on the GPIOs and pulses from min_width to max_width are
+        valid, in microseconds. With no GPIOs, the edges of the input PPS GPIO are used as they come.
+        The change takes effect when synchronization is started.
+        """
+        if not gpios:
+            self.PPS_sources = None
+            return
+        self.PPS_sources = pps_sources.source_selector(gpios, glitch_filter, min_width, max_width)
+        self.PPS_input_gpio = gpios[0]
+        for gpio in gpios:
+            self.set_gpio_mode(gpio, pigpio.INPUT)
 
     def set_PPS_output_gpio(self, gpio):
         """
@@ -80,37 +179,83 @@ class waveform_engine:
         The change takes affect when the update function is called.
         """
         self.PPS_output_gpio = gpio
-        self.pi.set_mode(gpio, pigpio.OUTPUT)
+        self.set_gpio_mode(gpio, pigpio.OUTPUT)
+        self.mark_dirty()
 
-    def start_NMEA_spoof(self, port, host):
+    def start_NMEA_spoof(self, port, host, protocol=nmea_sender.TCP):
         """
         Starts the sending of spoof NMEA messages to be sent to a sensor over ethernet.
         Spoof messages will be sent directly after the output PPS rising edges.
+        Can be called again to send the same messages to further sensors.
+        Messages are sent from a separate thread over non-blocking sockets (TCP or UDP),
+        and TCP connections are retried until the sensor can be reached.
         The output PPS signal must be configured for this to operate.
         """
-        if self.PPS_output_gpio != -1 and utils.check_ip_port_open(host, port):
-            self.sensor_port = port
-            self.sensor_IP = host
-            try:
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.socket.settimeout(1)
-                self.socket.connect((host, port))
-                self.spoof_NMEA = True
-            except:
-                self.spoof_NMEA = False
-                print("Could not reach the device on {}:{}. Not spoofing.". format(host, port))
-        else:
+        if self.PPS_output_gpio == -1:
             print("Output PPS must be configured for NMEA spoofing")
+            return
+        if self.NMEA_sender is None:
+            self.NMEA_sender = nmea_sender.nmea_sender(self.timebase)
+            self.NMEA_sender.start()
+        self.NMEA_sender.add_destination(host, port, protocol)
+        self.spoof_NMEA = True
+        self.start_output_callback()
+
+    def start_trigger_log(self, directory, file_records=1 << 22, max_files=64):
+        """
+        Starts logging the UTC time of every rising edge of the outputs to memory mapped files in a
+        directory, rotated every file_records edges keeping max_files files. See trigger_log.py.
+        The edge times are derived from the wave at every output PPS rising edge, so the output PPS
+        signal must be configured for this to operate.
+        """
+        if self.PPS_output_gpio == -1:
+            print ("Output PPS must be configured for trigger logging")
+            return
+        if self.trigger_log is None:
+            self.trigger_log = trigger_log.trigger_log_writer(directory, self.timebase, file_records, max_files)
+            self.trigger_log.start()
+            if self.chain_waves:
+                # The timeline of a running wave chain is only built for the log, on its next update
+                self.mark_dirty()
+        self.start_output_callback()
+
+    def stop_trigger_log(self):
+        """
+        Stops logging the trigger edge times.
+        """
+        if self.trigger_log is not None:
+            self.trigger_log.stop()
+            self.trigger_log = None
+            self.stop_output_callback()
+
+    def start_refclock(self, shm_unit=None, sock_path=None, pulse=False):
+        """
+        Starts feeding the input PPS edges, labelled with their UTC second by the timebase, to chrony
+        or ntpd through the NTP shared memory segment of shm_unit and/or the chrony SOCK refclock socket
+        at sock_path, see refclock.py. Only edges measured while synchronizing are fed.
+        Raises OSError if the shared memory segment cannot be attached.
+        """
+        self.stop_refclock()
+        self.refclock = refclock.refclock_publisher(self.pi, shm_unit, sock_path, pulse)
+        self.refclock.start()
+
+    def stop_refclock(self):
+        """
+        Stops feeding the input PPS edges to chrony or ntpd.
+        """
+        if self.refclock is not None:
+            self.refclock.stop()
+            self.refclock = None
 
     def stop_NMEA_spoof(self):
         """
         Stops the sending of spoof NMEA messages.
         """
-        if self.spoof_NMEA and self.socket is not None:
-            self.socket.close()
-            if not self.callbacks_set:
-                self.PPS_output_callback.cancel()
+        if self.spoof_NMEA and self.NMEA_sender is not None:
             self.spoof_NMEA = False
+            self.NMEA_sender.stop()
+            self.NMEA_sender = None
+            self.stop_output_callback()
 
     def set_PPS_output_duty(self, duty):
         """
@@ -123,6 +268,7 @@ class waveform_engine:
             self.PPS_duty_cycle_fraction = 0
         else:
             self.PPS_duty_cycle_fraction = duty
+        self.mark_dirty(self.PPS_output_gpio)
 
     def set_PPS_output_cycle_time(self, cycle_time):
         """
@@ -130,6 +276,15 @@ class waveform_engine:
         The change takes affect when the update function is called.
         """
         self.PPS_output_cycle_time = cycle_time
+        self.mark_dirty()
+
+    def set_PPS_output_offset(self, offset):
+        """
+        Sets the delay of the output PPS (and all triggers) in microseconds.
+        The change takes affect when the update function is called.
+        """
+        self.PPS_output_offset = offset
+        self.mark_dirty()
 
     def set_PPS_slack_threshold(self, slack_threshold):
         """
@@ -147,34 +302,133 @@ class waveform_engine:
         """
         self.PPS_overtime_reject = overtime_reject
 
+    def set_PPS_servo(self, servo):
+        """
+        Disciplines the output PPS with a pps_servo instead of stepping the offset by the full slack
+        whenever it exceeds the slack threshold. None selects the step mode.
+        The servo slews the phase by running the output wave one microsecond longer or shorter,
+        which is done by switching between two prepared waves rather than rebuilding the wave.
+        The change takes affect when the update function is called.
+        """
+        self.PPS_servo = servo
+        self.slew_remainder = 0.0
+        if servo is not None:
+            servo.reset()
+        self.mark_dirty()
+
+    def set_PPS_holdover(self, enable, reacquire_step=10):
+        """
+        Enables holding the output PPS over input PPS outages.
+        The input edges are predicted from a model of the Pi oscillator learned from the input edges
+        before the outage, and the output keeps being disciplined to them. When the input comes back,
+        the servo slews the output back onto it; without servo the offset is stepped by at most
+        reacquire_step microseconds per period.
+        Without holdover, the output runs at the last measured input cycle time during outages.
+        The change takes affect when the update function is called.
+        """
+        self.holdover_enabled = enable
+        self.PPS_reacquire_step = reacquire_step
+        self.holdover.reset()
+
+    def holdover_status(self):
+        """
+        Returns the holdover state, the periods since the input was lost and the estimated accumulated
+        error in microseconds, or with the input back, the error measured on its first edge.
+        """
+        return self.holdover.state, self.holdover.holdover_periods, self.holdover.estimated_error, self.holdover.measured_error
+
+    def set_edge_script(self, enable):
+        """
+        Times the input and output PPS edges with a script running in pigpiod, polled from a thread,
+        instead of with a pigpio callback per edge (see edge_script.py).
+        Takes effect at once if synchronization is running.
+        """
+        if enable == self.edge_script_enabled:
+            return
+        self.edge_script_enabled = enable
+        if self.callbacks_set:
+            self.stop_PPS_input_sychronization()
+            self.start_PPS_input_sychronization()
+
+    def set_wave_chaining(self, enable):
+        """
+        Enables compression of the output waveform into a pigpio wave chain.
+        One PPS period is split into blocks of the common sub-period of the triggers, and only the
+        distinct blocks are created as waves, so memory and creation time scale with the number of
+        distinct edges instead of the trigger frequencies.
+        Wave chains start immediately rather than at the end of the current wave cycle, so an update
+        re-enters the PPS period at the current position which can drop the edges of one block.
+        The change takes affect when the update function is called.
+        """
+        self.wave_chaining = enable
+        self.mark_dirty()
+
+    def set_hyperperiod_epoch(self, epoch):
+        """
+        Sets the UTC second (in seconds since the Unix epoch) the hyperperiods of triggers whose frequency
+        is not whole are counted from, so outputs on several machines with the same epoch are in phase.
+        Defaults to 0.
+        The change takes affect when the update function is called.
+        """
+        self.hyperperiod_epoch = int(epoch)
+        self.mark_dirty()
+
+    def set_hardware_offload(self, enable, min_frequency=1000, phase_tolerance=50.0, pwm_restart_interval=hardware_outputs.MIN_PWM_RESTART_INTERVAL):
+        """
+        Enables generating triggers with the hardware PWM (GPIO12, 13, 18 and 19) and clock (GPIO4, 6 and 20)
+        outputs instead of the wave, for triggers of at least min_frequency Hertz on those pins.
+        Clocks are only used for a duty of 0.5, and one trigger is placed per PWM channel or clock.
+        Hardware outputs are started on a wanted edge relative to the output PPS, and restarted when
+        their phase error goes beyond phase_tolerance microseconds, which is checked on every output
+        PPS rising edge, so the output PPS signal must be configured for this to operate.
+        Starting or stopping hardware PWM cancels the wave, which is then resumed where it was, losing
+        the edges due meanwhile, so PWM is only used where it would drift out of tolerance less often
+        than every pwm_restart_interval seconds: not while synchronizing to an input PPS, unless it is 0.
+        Drifted clocks are restarted by housekeeping(), off the pigpio callback thread.
+        The change takes affect when the update function is called.
+        """
+        self.hardware_offload = enable
+        self.hardware_min_frequency = min_frequency
+        self.hardware_phase_tolerance = phase_tolerance
+        self.hardware_pwm_restart_interval = pwm_restart_interval
+        self.mark_dirty()
+
+    def output_paths(self):
+        """
+        Returns the path generating each output, by GPIO: hardware_outputs.PWM, hardware_outputs.CLOCK,
+        or hardware_outputs.WAVE. Reflects the last update.
+        """
+        paths = collections.OrderedDict()
+        if self.PPS_output_gpio != -1:
+            paths[self.PPS_output_gpio] = hardware_outputs.WAVE
+        for gpio in self.trigger_outputs:
+            output = self.hardware_outputs.get(gpio)
+            paths[gpio] = output.kind if output is not None else hardware_outputs.WAVE
+        return paths
+
     def add_trigger_gpio(self, gpio, frequency = 1, phase = 0, duty = 0.5):
         """
         Adds an output trigger waveform.
-        Frequency must be an integer number.
+        Frequency must be in Hertz, whole or rational (such as 7.5 or '30000/1001'), see trigger_frequency().
         Phase must be in degrees.
         Duty must be in a decimal fraction.
         The change takes affect when the update function is called.
         """
+        frequency = self.trigger_frequency(gpio, frequency)
         if duty > 1.0:
             duty = 1.0
         elif duty < 0:
             duty = 0
 
-        gpio_used = False
-        for i in range(len(self.trigger_output_gpio)):
-            if self.trigger_output_gpio[i] == gpio:
-                self.trigger_output_frequency[i] = frequency
-                self.trigger_output_phase[i] = phase
-                self.trigger_duty_cycle_fraction[i] = duty
-                self.pi.set_mode(gpio, pigpio.OUTPUT)
-                gpio_used = True
-
-        if not gpio_used:
-            self.trigger_output_gpio.append(gpio)
-            self.trigger_output_frequency.append(frequency)
-            self.trigger_output_phase.append(phase)
-            self.trigger_duty_cycle_fraction.append(duty)
-            self.pi.set_mode(gpio, pigpio.OUTPUT)
+        trigger = self.trigger_outputs.get(gpio)
+        if trigger is not None:
+            trigger.frequency = frequency
+            trigger.phase = phase
+            trigger.duty = duty
+        else:
+            self.trigger_outputs[gpio] = trigger_output(gpio, frequency, phase, duty)
+        self.set_gpio_mode(gpio, pigpio.OUTPUT)
+        self.mark_dirty(gpio)
 
         # Enable usage even without a 1PPS output
         if self.PPS_output_gpio == -1:
@@ -186,12 +440,8 @@ class waveform_engine:
         Removes an output trigger waveform.
         The change takes affect when the update function is called.
         """
-        for i in range(len(self.trigger_output_gpio)):
-            if self.trigger_output_gpio[i] == gpio:
-                del self.trigger_output_frequency[i]
-                del self.trigger_output_phase[i]
-                del self.trigger_duty_cycle_fraction[i]
-                del self.trigger_output_gpio[i]
+        if self.trigger_outputs.pop(gpio, None) is not None:
+            self.mark_dirty(gpio)
 
     def update_trigger_gpio_frequency(self, gpio, frequency):
         """
@@ -199,9 +449,25 @@ class waveform_engine:
         The output must already exist.
         The change takes affect when the update function is called.
         """
-        for i in range(len(self.trigger_output_gpio)):
-            if self.trigger_output_gpio[i] == gpio:
-                self.trigger_output_frequency[i] = frequency
+        trigger = self.trigger_outputs.get(gpio)
+        if trigger is not None:
+            trigger.frequency = self.trigger_frequency(gpio, frequency)
+            self.mark_dirty(gpio)
+
+    def trigger_frequency(self, gpio, frequency):
+        """
+        Returns the frequency of a trigger as wave_compiler.rational_frequency() does.
+        A trigger whose frequency is not whole makes the wave span the hyperperiod of all triggers,
+        which starts on the UTC seconds a whole number of hyperperiods from the hyperperiod epoch.
+        Raises ValueError if the frequency is not positive, or the triggers would only repeat after
+        more than wave_compiler.MAX_HYPERPERIOD seconds with it.
+        """
+        frequency = wave_compiler.rational_frequency(frequency)
+        triggers = [trigger for trigger in self.triggers() if trigger[0] != gpio] + [(gpio, frequency, 0, 0)]
+        seconds = wave_compiler.hyperperiod(triggers)
+        if seconds > wave_compiler.MAX_HYPERPERIOD:
+            raise ValueError('triggers would only repeat after %d seconds' % seconds)
+        return frequency
 
     def update_trigger_gpio_phase(self, gpio, phase):
         """
@@ -209,9 +475,10 @@ class waveform_engine:
         The output must already exist.
         The change takes affect when the update function is called.
         """
-        for i in range(len(self.trigger_output_gpio)):
-            if self.trigger_output_gpio[i] == gpio:
-                self.trigger_output_phase[i] = phase
+        trigger = self.trigger_outputs.get(gpio)
+        if trigger is not None:
+            trigger.phase = phase
+            self.mark_dirty(gpio)
 
     def update_trigger_gpio_duty(self, gpio, duty):
         """
@@ -219,18 +486,33 @@ class waveform_engine:
         The output must already exist.
         The change takes affect when the update function is called.
         """
-        for i in range(len(self.trigger_output_gpio)):
-            if self.trigger_output_gpio[i] == gpio:
-                self.trigger_duty_cycle_fraction[i] = duty
+        trigger = self.trigger_outputs.get(gpio)
+        if trigger is not None:
+            trigger.duty = duty
+            self.mark_dirty(gpio)
 
     def start_PPS_input_sychronization(self):
         """
         Starts synchronization by enabling the callback functions for wave timing.
         """
         if (self.PPS_input_gpio != -1) and not self.callbacks_set:
-            self.PPS_input_callback = self.pi.callback(self.PPS_input_gpio, pigpio.RISING_EDGE, self.wave_callback)
-            self.PPS_output_callback = self.pi.callback(self.PPS_output_gpio, pigpio.RISING_EDGE, self.wave_callback)
+            self.apply_modes()
+            sources = self.PPS_sources.gpios if self.PPS_sources is not None else [self.PPS_input_gpio]
+            if self.edge_script_enabled and len(sources) > 1:
+                print ("The PPS edge script times one input, using callbacks for %d PPS sources" % len(sources))
+            elif self.edge_script_enabled and self.PPS_output_gpio != -1:
+                self.start_edge_script()
+            if self.edge_script is not None:
+                if self.PPS_sources is not None:
+                    # The script reads the levels, which the glitch filter does not delay
+                    self.PPS_sources.tick_delay = 0
+            elif self.PPS_sources is not None:
+                self.start_source_callbacks()
+            else:
+                self.PPS_input_callback = self.pi.callback(self.PPS_input_gpio, pigpio.RISING_EDGE, self.wave_callback)
             self.callbacks_set = True
+            self.start_output_callback()
+            self.replace_hardware_outputs()
         elif not self.callbacks_set:
             print ("Synchronization to external PPS already running")
         else:
@@ -241,102 +523,973 @@ class waveform_engine:
         Stops synchronization by disabling the callback functions for wave timing.
         """
         if self.callbacks_set:
-            self.PPS_input_callback.cancel()
-            self.PPS_output_callback.cancel()
+            if self.edge_script is not None:
+                self.edge_script.stop()
+                self.edge_script = None
+            elif self.PPS_source_callbacks:
+                self.stop_source_callbacks()
+            else:
+                self.PPS_input_callback.cancel()
             self.callbacks_set = False
+            self.stop_output_callback()
+            if self.output_callback_needed():
+                self.start_output_callback()
+            self.replace_hardware_outputs()
+
+    def replace_hardware_outputs(self):
+        """
+        Places the triggers onto the hardware outputs again when synchronization starts or stops,
+        as hardware PWM is only used while the output PPS runs from the Pi oscillator, or where the
+        wave could not hold its triggers. If the outputs cannot be updated, the running ones are kept.
+        """
+        if self.hardware_offload and not self.stopped and (self.wave is not None or self.chain_waves):
+            for gpio in self.trigger_outputs:
+                self.mark_dirty(gpio)
+            try:
+                self.update()
+            except (ValueError, pigpio.error) as e:
+                print ("Outputs not placed again: %s" % e)
+
+    def start_source_callbacks(self):
+        """
+        Sets the glitch filters of the input PPS sources and starts their callbacks, on both edges
+        to check the pulse widths.
+        """
+        sources = self.PPS_sources
+        for gpio in sources.gpios:
+            self.pi.set_glitch_filter(gpio, sources.glitch_filter)
+            self.PPS_source_callbacks.append(self.pi.callback(gpio, pigpio.EITHER_EDGE, self.wave_callback))
+        sources.tick_delay = sources.glitch_filter
+
+    def stop_source_callbacks(self):
+        """
+        Stops the callbacks of the input PPS sources and clears their glitch filters.
+        """
+        for callback in self.PPS_source_callbacks:
+            self.pi.set_glitch_filter(callback.gpio, 0)
+            callback.cancel()
+        self.PPS_source_callbacks = []
+
+    def start_edge_script(self):
+        """
+        Starts timing the PPS edges with a script in pigpiod in place of the callbacks, or falls
+        back to the callbacks if pigpiod cannot run it.
+        """
+        script = edge_script.edge_script(self.pi, self.PPS_input_gpio, self.PPS_output_gpio, self.wave_callback, self.PPS_output_cycle_time, poll_interval=self.edge_script_poll_interval)
+        try:
+            script.start()
+        except pigpio.error as e:
+            print ("PPS edge script not started, using callbacks: {}".format(e))
+            return
+        self.edge_script = script
+        if self.PPS_output_callback is not None:
+            self.PPS_output_callback.cancel()
+            self.PPS_output_callback = None
+
+    def start_output_callback(self):
+        """
+        Starts the output PPS callback if it is not running and the edge script does not time the output PPS.
+        """
+        if self.PPS_output_callback is None and self.edge_script is None and self.PPS_output_gpio != -1:
+            self.PPS_output_callback = self.pi.callback(self.PPS_output_gpio, pigpio.RISING_EDGE, self.wave_callback)
+
+    def output_callback_needed(self):
+        """
+        Returns whether synchronization, NMEA spoofing, the trigger log, hardware outputs or a wave
+        spanning several PPS periods need the output PPS edges.
+        """
+        return bool(self.callbacks_set or self.spoof_NMEA or self.trigger_log is not None or self.hardware_outputs or self.hyperperiod > 1)
+
+    def stop_output_callback(self):
+        """
+        Stops the output PPS callback unless it is still needed, see output_callback_needed().
+        """
+        if not self.output_callback_needed() and self.PPS_output_callback is not None:
+            self.PPS_output_callback.cancel()
+            self.PPS_output_callback = None
 
     def wave_callback(self, gpio, level, tick):
         """
-        Callback function for PPS waveform rising edges.
+        Callback function for PPS waveform rising edges, and both edges of validated input PPS sources.
         """
         slack = 0
-        if gpio == self.PPS_input_gpio:
-            if self.PPS_input_tick > 0:
-                time_since_last_tick = tick - self.PPS_input_tick
-                if time_since_last_tick < self.PPS_overtime_reject:
-                    self.PPS_input_cycle_time = time_since_last_tick
-                    self.PPS_output_cycle_time = self.PPS_input_cycle_time
-                #print ('Cycle time: %d'%self.PPS_output_cycle_time)
-            self.PPS_input_tick = tick
-            self.PPS_input_has_ticked = True
-            #print('Input: %d'%tick)
+        if self.PPS_sources is not None and gpio in self.PPS_sources.sources:
+            for edge, cycle_time in self.PPS_sources.edge(gpio, level, tick):
+                self.input_PPS_edge(edge, cycle_time)
+
+        elif gpio == self.PPS_input_gpio:
+            self.input_PPS_edge(tick)
 
         elif gpio == self.PPS_output_gpio:
             self.PPS_output_tick = tick
-            #print('Output: %d'%tick)
-            if self.PPS_input_has_ticked:
+            self.handover_edge(tick)
+            if self.holdover_enabled and self.callbacks_set and self.holdover.lost(tick):
+                self.holdover_edge(tick)
+            # Without input PPS edges, the output edges start the seconds
+            age = self.timebase.age(tick)
+            if not self.callbacks_set or age is None or age > 2 * self.PPS_output_cycle_time:
+                self.timebase.add_anchor(tick)
+            # Logged with the wave transmitted up to this edge, before any correction replaces it
+            if self.trigger_log is not None and self.active_timeline is not None:
+                flags = 0
+                if self.holdover.state == holdover.HOLDOVER:
+                    flags |= trigger_log.FLAG_HOLDOVER
+                if not self.callbacks_set:
+                    flags |= trigger_log.FLAG_UNSYNCHRONIZED
+                position = self.wave_position(tick) if self.hyperperiod > 1 else None
+                self.trigger_log.edge(tick, self.active_timeline, self.PPS_output_gpio, flags, position)
+            self.frame_edge(tick)
+            if self.hardware_outputs:
+                self.check_hardware_outputs(tick)
+            if self.PPS_servo is not None:
+                self.servo_correction(tick)
+                if self.PPS_servo.error is not None:
+                    self.telemetry.record(telemetry.OUTPUT, tick, self.PPS_servo.error)
+            elif self.PPS_input_has_ticked:
                 self.PPS_input_has_ticked = False
-                slack = self.PPS_output_tick - self.PPS_input_tick
-                #print('Slack: %d'%slack)
+                slack = pigpio.tickDiff(self.PPS_input_tick, self.PPS_output_tick)
+                if slack >= self.PPS_output_cycle_time:
+                    # The input edge of this second is still to come, i.e. late through a glitch filter
+                    slack -= int(round(self.PPS_output_cycle_time))
+                self.PPS_slack = slack - self.PPS_output_cycle_time if slack > self.PPS_output_cycle_time / 2 else slack
+                self.telemetry.record(telemetry.OUTPUT, tick, self.PPS_slack)
+                if self.holdover.state == holdover.REACQUIRING:
+                    slack = self.reacquire_slack(slack)
                 if slack > self.PPS_slack_threshold and slack < (self.PPS_output_cycle_time - self.PPS_slack_threshold):
                     offset = self.PPS_output_offset + slack
                     if offset >= self.PPS_output_cycle_time:
                         offset = offset - self.PPS_output_cycle_time
-            	    #print('Offset: %d ... UPDATE'%offset)
-                    self.PPS_output_offset = offset
+                    self.set_PPS_output_offset(offset)
+                    self.telemetry.record(telemetry.OFFSET, tick, offset)
                     self.update()
-                else:
-                    #print('Offset: %d'%self.PPS_output_offset)
-                    pass
+
+            if self.lock_time is None and self.callbacks_set and self.lock_state() == pps_servo.LOCKED:
+                self.lock_time = time.time()
 
             # NMEA spoofing
             if self.spoof_NMEA:
-                localticks = time.time() #NOTE: this is only accurate to ~100 micros. Have to fix this later.
-                localtime = time.localtime(localticks)
-                message = b'$GPGGA,%02d%02d%02d.%03d,4321.428,S,17242.305,E,1,12,1.0,0.0,M,0.0,M,,'%(localtime.tm_hour,localtime.tm_min,localtime.tm_sec, (localticks % 1)*1000)
-                checksum = utils.get_nmea_checksum(message)
-                nmea_message = message + '*' + checksum + '\r\n'
-                self.socket.sendall(nmea_message)
+                self.NMEA_sender.edge(tick)
+
+            if self.pending_changes:
+                self.apply_changes()
+
+    def input_PPS_edge(self, tick, cycle_time=None):
+        """
+        Handles an input PPS rising edge. cycle_time is the smoothed period of a validated source,
+        used in place of the interval from the edge before.
+        """
+        self.telemetry.record(telemetry.INPUT, tick, pigpio.tickDiff(self.PPS_input_tick, tick) if self.PPS_input_tick > 0 else 0)
+        if self.holdover_enabled:
+            was_holding = self.holdover.state == holdover.HOLDOVER
+            self.holdover.add_edge(tick)
+            if was_holding:
+                self.end_holdover()
+        self.input_edge(tick, cycle_time if self.holdover.state == holdover.TRACKING else None)
+        # Unless the timebase rejected the edge as an anchor
+        if self.refclock is not None and self.timebase.age(tick) == 0:
+            self.refclock.edge(tick, int(round(self.timebase.utc_at(tick))))
+
+    def frame_edge(self, tick):
+        """
+        Follows the start of the PPS period, or of the hyperperiod, that waves started at once are entered
+        from, at an output PPS rising edge.
+        Should a wave spanning several PPS periods be a whole number of them off its hyperperiod, as when
+        the timebase was relabelled, it is re-entered at the right position.
+        """
+        self.frame_offset = self.PPS_output_offset
+        origin = self.frame_origin(tick, self.hyperperiod, self.frame_offset)
+        length = int(self.PPS_output_cycle_time * self.hyperperiod)
+        moved = False
+        if self.frame_origin_tick is not None:
+            moved = abs((timebase.tick_diff(self.frame_origin_tick, origin) + length // 2) % length - length // 2) > self.PPS_output_cycle_time / 2
+        self.frame_origin_tick = origin
+        if moved and self.hyperperiod > 1 and not self.stopped:
+            self.mark_dirty()
+            self.update()
+
+    def frame_origin(self, tick, seconds, offset):
+        """
+        Returns the tick the PPS period, or hyperperiod of seconds PPS periods, holding the output PPS rising
+        edge at tick started at, for the offset the edge was output with.
+        Hyperperiods start on the UTC seconds a whole number of hyperperiods from the hyperperiod epoch.
+        """
+        cycle_time = self.PPS_output_cycle_time
+        length = int(cycle_time * seconds)
+        second = 0
+        if seconds > 1:
+            if self.timebase.valid():
+                second = (int(round(self.timebase.utc_at(tick))) - self.hyperperiod_epoch) % seconds
+            elif self.frame_origin_tick is not None:
+                position = timebase.tick_diff(self.frame_origin_tick, tick) % length
+                second = int(round((position + offset) / cycle_time)) % seconds
+        return (tick - int((second * cycle_time - offset) % length)) & 0xFFFFFFFF
 
-    def update(self):
+    def wave_position(self, tick):
+        """
+        Returns the time in the wave spanning several PPS periods being transmitted of the output PPS
+        rising edge at tick, the edge of the wave closest to where its start tick puts it.
+        """
+        timeline = self.active_timeline
+        edges = timeline.rising_edges(self.PPS_output_gpio)
+        if self.wave_start_tick is None or not len(edges):
+            return None
+        estimate = timebase.tick_diff(self.wave_start_tick, tick) % timeline.length
+        distances = [abs((int(edge) - estimate + timeline.length // 2) % timeline.length - timeline.length // 2) for edge in edges]
+        position = int(edges[distances.index(min(distances))])
+        self.wave_start_tick = (tick - position) & 0xFFFFFFFF
+        return position
+
+    def input_edge(self, tick, cycle_time=None):
+        """
+        Handles an input PPS rising edge, measured or predicted during holdover.
+        cycle_time is the modelled input cycle time of a predicted edge, or the smoothed one of a
+        validated source.
+        """
+        self.timebase.add_anchor(tick)
+        if self.PPS_servo is not None:
+            self.PPS_servo.input_edge(tick)
+        if cycle_time is None and self.PPS_input_tick > 0:
+            time_since_last_tick = pigpio.tickDiff(self.PPS_input_tick, tick)
+            if self.holdover.state == holdover.REACQUIRING:
+                # The interval from the last predicted edge holds the holdover error, which is slewed out instead
+                cycle_time = float(int(round(self.holdover.period())))
+            elif time_since_last_tick < self.PPS_overtime_reject:
+                cycle_time = time_since_last_tick
+        if cycle_time is not None:
+            self.PPS_input_cycle_time = cycle_time
+            if self.edge_script is not None:
+                self.edge_script.set_period(cycle_time)
+            if self.PPS_servo is None and self.PPS_output_cycle_time != self.PPS_input_cycle_time:
+                self.PPS_output_cycle_time = self.PPS_input_cycle_time
+                self.mark_dirty()
+        self.PPS_input_tick = tick
+        self.PPS_input_has_ticked = True
+
+    def holdover_edge(self, tick):
+        """
+        Stands in for the lost input PPS at an output PPS rising edge, with the input edge predicted
+        by the holdover model.
+        """
+        if self.holdover.state != holdover.HOLDOVER:
+            self.holdover.start(tick)
+            print ('PPS input lost, holding over at %.3f ppm drifting %.3f ppm/hour' % (self.holdover.frequency_offset(), self.holdover.drift_rate()))
+        edge, period = self.holdover.predict_edge(tick)
+        if timebase.tick_diff(edge, tick) < 0:
+            # Like a measured one, the input edge precedes the output edge it is compared to
+            edge = (edge - int(round(period))) & 0xFFFFFFFF
+        if edge != self.PPS_input_tick:
+            self.input_edge(edge, period if self.PPS_servo is not None else float(int(round(period))))
+
+    def end_holdover(self):
+        """
+        Starts reacquiring the input PPS after a holdover.
+        """
+        error = self.holdover.measured_error
+        print ('PPS input back after %d s of holdover, off by %.1f us (estimated %.1f us)' % (self.holdover.holdover_periods, error, self.holdover.estimated_error))
+        if self.PPS_servo is not None:
+            self.PPS_servo.reacquire(error)
+
+    def reacquire_slack(self, slack):
+        """
+        Limits the offset step while reacquiring the input PPS after a holdover without servo.
+        """
+        if slack > self.PPS_output_cycle_time / 2:
+            slack -= self.PPS_output_cycle_time
+        if abs(slack) <= self.PPS_slack_threshold:
+            self.holdover.reacquired()
+        slack = max(-self.PPS_reacquire_step, min(self.PPS_reacquire_step, slack))
+        return slack % self.PPS_output_cycle_time
+
+    def servo_correction(self, tick):
+        """
+        Runs the PPS servo for an output PPS rising edge and applies its correction.
+        """
+        action, value = self.PPS_servo.output_edge(tick)
+        if self.holdover.state == holdover.REACQUIRING and not self.PPS_servo.reacquiring():
+            self.holdover.reacquired()
+        if action == pps_servo.STEP:
+            self.set_PPS_output_offset((self.PPS_output_offset + value) % self.PPS_output_cycle_time)
+            self.telemetry.record(telemetry.OFFSET, tick, self.PPS_output_offset)
+            self.slew_remainder = 0.0
+            self.update()
+        elif action == pps_servo.SLEW:
+            self.slew(value, self.PPS_servo.cycle_time)
+
+    def slew(self, cycle_time, period=None):
+        """
+        Runs the output at a fractional cycle time in microseconds.
+        The flat wave alternates between its one microsecond longer and shorter variants so the average
+        cycle time matches, saturating when the correction goes beyond them. It is rebuilt when the
+        estimated input period (if given) drifts off their lengths, or to slew faster when the cycle
+        time is more than the rebuild threshold away from them.
+        A wave chain, or a wave spanning several PPS periods, has no variants, so its offset is stepped
+        by whole microseconds.
+        """
+        base = self.PPS_output_cycle_time
+        if period is None:
+            period = cycle_time
+        if abs(cycle_time - base - 0.5) > 0.5 + self.slew_rebuild_threshold:
+            base = float(int(cycle_time))
+        elif period < base - 0.25 or period > base + 1.25:
+            base = float(int(period))
+        if base != self.PPS_output_cycle_time:
+            self.set_PPS_output_cycle_time(base)
+            self.slew_remainder = 0.0
+            self.update()
+            return
+
+        self.slew_remainder += cycle_time - base
+        if self.wave_variants:
+            longer = self.slew_remainder >= 0.5
+            if longer:
+                self.slew_remainder -= 1.0
+            self.slew_remainder = max(-1.0, min(1.0, self.slew_remainder))
+            variant = self.wave_variants[1 if longer else 0]
+            if variant != self.wave and not self.stopped:
+                self.pi.wave_send_using_mode(variant, pigpio.WAVE_MODE_REPEAT_SYNC)
+                self.wave = variant
+        elif abs(self.slew_remainder) >= 1.0:
+            steps = int(self.slew_remainder)
+            self.slew_remainder -= steps
+            self.set_PPS_output_offset((self.PPS_output_offset - steps) % self.PPS_output_cycle_time)
+            self.update()
+
+    def lock_state(self):
+        """
+        Returns the state of the output PPS lock to the input PPS: FREE_RUNNING without synchronization,
+        pps_servo.UNLOCKED while the input is lost without holdover, holdover.HOLDOVER and
+        holdover.REACQUIRING around a holdover, and pps_servo.ACQUIRING or pps_servo.LOCKED otherwise.
+        Without servo, the output counts as locked while its slack is within PPS_lock_threshold.
+        """
+        if not self.callbacks_set:
+            return FREE_RUNNING
+        if self.holdover.state != holdover.TRACKING:
+            return self.holdover.state
+        if self.PPS_input_tick == 0 or timebase.tick_diff(self.PPS_input_tick, self.PPS_output_tick) > self.holdover.loss_timeout * self.PPS_output_cycle_time:
+            return pps_servo.UNLOCKED
+        if self.PPS_servo is not None:
+            return pps_servo.LOCKED if self.PPS_servo.locked() else pps_servo.ACQUIRING
+        if self.PPS_slack is not None and abs(self.PPS_slack) <= self.PPS_lock_threshold:
+            return pps_servo.LOCKED
+        return pps_servo.ACQUIRING
+
+    def schedule_change(self, change, done=None):
+        """
+        Queues a change of the settings made from another thread, as a function calling the setters.
+        Queued changes are applied together, followed by a single update, at the next output PPS rising
+        edge, or by housekeeping() when no output PPS callback is running, so a burst of changes causes
+        one rebuild and the settings are only changed from the thread that updates the wave.
+        done is called with None, or the exception the change raised, once the update is sent.
+        """
+        self.pending_changes.append((change, done))
+
+    def apply_changes(self):
+        """
+        Applies the queued changes and updates the outputs.
+        If the update fails, the triggers are set back to their settings before the changes, which are
+        all reported the error, and the outputs are updated again with them.
+        """
+        triggers = self.triggers()
+        applied = []
+        while self.pending_changes:
+            change, done = self.pending_changes.popleft()
+            try:
+                change()
+                applied.append((done, None))
+            except Exception as e:
+                applied.append((done, e))
+        try:
+            self.update()
+        except (ValueError, pigpio.error) as e:
+            # Raised on the callback thread, so reported to the changes instead
+            print ("Outputs not updated, changes rolled back: %s" % e)
+            applied = [(done, error or e) for done, error in applied]
+            self.restore_triggers(triggers, isinstance(e, pigpio.error))
+        for done, error in applied:
+            if done is not None:
+                done(error)
+
+    def restore_triggers(self, triggers, clear_wave=False):
+        """
+        Sets the triggers back to a list returned by triggers() and updates the outputs, which restarts
+        or stops the hardware outputs placed for the failed settings. With clear_wave, pulses a failed
+        update left added to the next wave are discarded first.
+        """
+        current = dict((trigger[0], trigger) for trigger in self.triggers())
+        restored = dict((trigger[0], trigger) for trigger in triggers)
+        self.trigger_outputs.clear()
+        for gpio, frequency, phase, duty in triggers:
+            self.trigger_outputs[gpio] = trigger_output(gpio, frequency, phase, duty)
+        for gpio in set(current) | set(restored):
+            if current.get(gpio) != restored.get(gpio):
+                self.mark_dirty(gpio)
+        try:
+            if clear_wave:
+                self.pi.wave_add_new()
+            self.update()
+        except (ValueError, pigpio.error) as e:
+            print ("Outputs not restored: %s" % e)
+
+    def triggers(self):
+        """
+        Returns the output triggers as a list of (gpio, frequency, phase, duty).
+        """
+        return [(trigger.gpio, trigger.frequency, trigger.phase, trigger.duty) for trigger in self.trigger_outputs.values()]
+
+    def wave_triggers(self):
+        """
+        Returns the output triggers generated by the wave, as triggers() does.
+        """
+        return [trigger for trigger in self.triggers() if trigger[0] not in self.hardware_outputs]
+
+    def mark_dirty(self, gpio=None):
+        """
+        Marks an output as changed, so the next update rebuilds the wave.
+        Without a GPIO, marks every output (for changes to the PPS cycle time or offset).
+        """
+        if gpio is None:
+            self.dirty_all = True
+        else:
+            self.dirty_gpios.add(gpio)
+
+    def is_dirty(self):
+        """
+        Returns True if any setting changed since the last update.
+        """
+        return self.dirty_all or bool(self.dirty_gpios)
+
+    def dirty_outputs(self):
+        """
+        Returns the GPIOs of the outputs changed since the last update.
+        """
+        if self.dirty_all:
+            gpios = set(self.trigger_outputs)
+            if self.PPS_output_gpio != -1:
+                gpios.add(self.PPS_output_gpio)
+            return gpios | self.dirty_gpios
+        return set(self.dirty_gpios)
+
+    def compile(self):
+        """
+        Compiles the current settings into the merged edge timeline of one PPS period, or of the hyperperiod
+        of the triggers, without sending it.
+        All outputs are combined into one pulse per distinct edge time.
+        Compiled outputs are cached by their settings, and the offset is applied by rotating the cached
+        timeline, so only changed outputs are recompiled.
+        """
+        triggers = self.wave_triggers()
+        return self.segments.timeline(self.PPS_output_cycle_time, self.PPS_output_offset, self.PPS_output_gpio, self.PPS_duty_cycle_fraction, triggers, wave_compiler.hyperperiod(triggers))
+
+    def update(self, force=False):
         """
         Updates the waveform for each GPIO to reflect the current settings.
+        Does nothing if no setting changed since the last update, unless force is set.
+        The wave is kept if only outputs generated by hardware before and after changed.
+        GPIO modes changed since the last update are set first.
+        Raises ValueError and keeps the running wave when the outputs take more pulses than a single wave
+        holds and, with wave chaining, fit no wave chain either.
         """
-        on_time = self.PPS_duty_cycle_fraction * self.PPS_output_cycle_time
-        if self.PPS_output_gpio != -1:
-            if self.PPS_output_offset >= on_time:
-                self.pi.wave_add_generic([
-                    pigpio.pulse(0, 1<<self.PPS_output_gpio, self.PPS_output_cycle_time - self.PPS_output_offset),
-                    pigpio.pulse(1<<self.PPS_output_gpio, 0, on_time),
-                    pigpio.pulse(0, 1<<self.PPS_output_gpio, self.PPS_output_offset - on_time)
-                ])
+        self.apply_modes()
+        self.rebuild(force)
+        if self.first_edge_time is None and (self.wave is not None or self.chain_waves):
+            self.first_edge_time = time.time()
+
+    def rebuild(self, force=False):
+        """
+        Rebuilds and sends the wave for update().
+        """
+        if not force and not self.is_dirty():
+            return
+        dirty = self.dirty_outputs()
+        self.dirty_all = False
+        self.dirty_gpios.clear()
+
+        hardware = set(self.hardware_outputs)
+        if self.place_hardware_outputs():
+            self.resume_wave()
+        if not force and dirty <= hardware & set(self.hardware_outputs):
+            return
+
+        seconds = wave_compiler.hyperperiod(self.wave_triggers())
+        if seconds != self.hyperperiod and self.PPS_output_tick:
+            # The wave is entered from the start of its own hyperperiod
+            self.frame_origin_tick = self.frame_origin(self.PPS_output_tick, seconds, self.frame_offset)
+
+        chain_error = None
+        if self.wave_chaining and not self.stopped:
+            try:
+                plan = wave_compiler.compile_chain(self.PPS_output_cycle_time, self.PPS_output_offset, self.PPS_output_gpio, self.PPS_duty_cycle_fraction, self.wave_triggers(), seconds)
+            except ValueError as e:
+                chain_error = e
             else:
-                self.pi.wave_add_generic([
-                    pigpio.pulse(1<<self.PPS_output_gpio, 0, on_time - self.PPS_output_offset),
-                    pigpio.pulse(0, 1<<self.PPS_output_gpio, self.PPS_output_cycle_time - on_time),
-                    pigpio.pulse(1<<self.PPS_output_gpio, 0, self.PPS_output_offset)
-                ])
-
-        for gpio, frequency, phase, duty in zip(self.trigger_output_gpio, self.trigger_output_frequency, self.trigger_output_phase, self.trigger_duty_cycle_fraction):
-            trigger_cycle_time = self.PPS_output_cycle_time/frequency
-            offset = (self.PPS_output_offset + (self.PPS_output_cycle_time * (360 - phase/frequency) / 360)) % trigger_cycle_time
-            on_time = duty*trigger_cycle_time
-            waves = []
-            for i in range(frequency):
-                if offset >= on_time:
-                    waves.append(pigpio.pulse(0, 1<<gpio, trigger_cycle_time - offset))
-                    waves.append(pigpio.pulse(1<<gpio, 0, on_time))
-                    waves.append(pigpio.pulse(0, 1<<gpio, offset - on_time))
-                else:
-                    waves.append(pigpio.pulse(1<<gpio, 0, on_time - offset))
-                    waves.append(pigpio.pulse(0, 1<<gpio, trigger_cycle_time - on_time))
-                    waves.append(pigpio.pulse(1<<gpio, 0, offset))
-
-            self.pi.wave_add_generic(waves)
-
-        if (len(self.trigger_output_gpio) or (self.PPS_output_gpio != -1)) and not self.stopped:
+                self.send_chain(plan)
+                self.set_hyperperiod(seconds)
+                self.rebuild_count += 1
+                self.telemetry.record(telemetry.REBUILD, self.PPS_output_tick, self.rebuild_count)
+                return
+
+        timeline = self.compile()
+        if len(timeline) > wave_compiler.MAX_WAVE_PULSES:
+            # Keeps the running wave
+            error = 'the wave of %d pulses exceeds the %d pigpiod takes' % (len(timeline), wave_compiler.MAX_WAVE_PULSES)
+            if chain_error is not None:
+                raise ValueError('%s, and %s' % (chain_error, error))
+            raise ValueError(error)
+        self.timeline = timeline
 
+        if len(self.timeline) and not self.stopped and (seconds > 1 or self.hyperperiod > 1):
+            # A switchover at the end of the wave cycle could wait for most of a hyperperiod
+            self.send_wave(self.timeline, seconds, self.PPS_servo is not None and seconds == 1)
+            self.set_hyperperiod(seconds)
+            self.rebuild_count += 1
+            self.telemetry.record(telemetry.REBUILD, self.PPS_output_tick, self.rebuild_count)
+
+        elif len(self.timeline) and not self.stopped:
+
+            pulses = self.timeline.pulses()
+            self.pi.wave_add_generic(pulses)
             new_wave = self.pi.wave_create()
+            new_variants = []
+            if self.PPS_servo is not None:
+                last = pulses[-1]
+                self.pi.wave_add_generic(pulses[:-1] + [pigpio.pulse(last.gpio_on, last.gpio_off, last.delay + 1)])
+                new_variants = [new_wave, self.pi.wave_create()]
 
             if self.wave is not None:
                 self.pi.wave_send_using_mode(new_wave, pigpio.WAVE_MODE_REPEAT_SYNC)
-                while self.pi.wave_tx_at() != new_wave:
-                   pass
-                self.pi.wave_delete(self.wave)
+                self.start_handover()
             else:
                 self.pi.wave_send_repeat(new_wave)
+                self.delete_chain_waves()
+                self.active_timeline = self.timeline
 
+            cycle_time = int(self.PPS_output_cycle_time)
+            self.wave_PPS_position = (cycle_time, (cycle_time - int(round(self.PPS_output_offset))) % cycle_time)
             self.wave = new_wave
+            self.wave_variants = new_variants
+            self.rebuild_count += 1
+            self.telemetry.record(telemetry.REBUILD, self.PPS_output_tick, self.rebuild_count)
+
+    def set_gpio_mode(self, gpio, mode):
+        """
+        Sets the mode of a GPIO with the next update, together with the other changed modes,
+        unless the GPIO is already in that mode.
+        """
+        if self.gpio_modes.get(gpio) != mode:
+            self.pending_modes[gpio] = mode
+        else:
+            self.pending_modes.pop(gpio, None)
+
+    def apply_modes(self):
+        """
+        Sets the GPIO modes queued by set_gpio_mode().
+        """
+        while self.pending_modes:
+            gpio, mode = self.pending_modes.popitem(last=False)
+            self.pi.set_mode(gpio, mode)
+            self.gpio_modes[gpio] = mode
+
+    def startup_times(self):
+        """
+        Returns the seconds from the start of the service to the first output edge and to the first
+        lock of the output PPS to the input PPS, as a (first edge, lock) tuple, None for those not reached yet.
+        """
+        first_edge = self.first_edge_time - self.start_time if self.first_edge_time is not None else None
+        lock = self.lock_time - self.start_time if self.lock_time is not None else None
+        return first_edge, lock
+
+    def place_hardware_outputs(self):
+        """
+        Moves the triggers onto and off the hardware outputs for the current settings, starting,
+        restarting and stopping them as needed. Returns True if a hardware PWM command cancelled the wave.
+        """
+        with self.hardware_lock:
+            return self._place_hardware_outputs()
+
+    def _place_hardware_outputs(self):
+        placement = {}
+        if self.hardware_offload and self.PPS_output_gpio != -1 and not self.stopped:
+            if self.hardware_revision is None:
+                self.hardware_revision = self.pi.get_hardware_revision()
+            # The PPS runs from the Pi oscillator, as the hardware does, unless it follows an input PPS
+            crystal_ppm = None if self.callbacks_set else 0.0
+            placement = hardware_outputs.place(self.triggers(), self.hardware_min_frequency, self.hardware_revision, crystal_ppm=crystal_ppm,
+                                               tolerance=self.hardware_phase_tolerance, min_pwm_restart_interval=self.hardware_pwm_restart_interval)
+            if crystal_ppm is None and self.hardware_pwm_restart_interval > 0:
+                # PWM pins stay on PWM, restarted however often, where the wave could not hold them
+                restarted = hardware_outputs.place(self.triggers(), self.hardware_min_frequency, self.hardware_revision, crystal_ppm=crystal_ppm,
+                                                   tolerance=self.hardware_phase_tolerance, min_pwm_restart_interval=0)
+                if restarted != placement and not self.wave_fits([trigger for trigger in self.triggers() if trigger[0] not in placement]):
+                    if set(restarted) - set(self.hardware_outputs):
+                        print ("Triggers on PWM pins kept on hardware PWM while synchronized, as the wave cannot hold them")
+                    placement = restarted
+
+        cancelled = False
+        started = []
+        for gpio in set(self.hardware_outputs) | set(placement):
+            output = self.hardware_outputs.get(gpio)
+            trigger = self.trigger_outputs.get(gpio)
+            if output is not None:
+                if gpio in placement and output.kind == placement[gpio][0] and output.settings() == (gpio, trigger.frequency, trigger.phase, trigger.duty):
+                    continue
+                cancelled |= self.stop_hardware_output(output)
+                del self.hardware_outputs[gpio]
+                if gpio not in placement:
+                    # Back to the wave
+                    self.pi.set_mode(gpio, pigpio.OUTPUT)
+                    self.gpio_modes[gpio] = pigpio.OUTPUT
+            if gpio in placement:
+                # The hardware output sets its own mode
+                self.gpio_modes.pop(gpio, None)
+                kind, actual_frequency = placement[gpio]
+                output = hardware_outputs.hardware_output(gpio, kind, trigger.frequency, trigger.phase, trigger.duty, actual_frequency)
+                self.hardware_outputs[gpio] = output
+                started.append(output)
+        for output in started:
+            cancelled |= self.start_hardware_output(output)
+
+        if self.hardware_outputs:
+            self.start_output_callback()
+        else:
+            self.stop_output_callback()
+        return cancelled
+
+    def wave_fits(self, triggers):
+        """
+        Returns True if the output PPS and the triggers fit a single wave or, with wave chaining, a wave chain.
+        """
+        seconds = wave_compiler.hyperperiod(triggers)
+        timeline = self.segments.timeline(self.PPS_output_cycle_time, self.PPS_output_offset, self.PPS_output_gpio, self.PPS_duty_cycle_fraction, triggers, seconds)
+        if len(timeline) <= wave_compiler.MAX_WAVE_PULSES:
+            return True
+        if self.wave_chaining:
+            try:
+                wave_compiler.compile_chain(self.PPS_output_cycle_time, self.PPS_output_offset, self.PPS_output_gpio, self.PPS_duty_cycle_fraction, triggers, seconds)
+            except ValueError:
+                return False
+            return True
+        return False
+
+    def start_hardware_output(self, output):
+        """
+        Starts a hardware output timed onto its next wanted rising edge, going by the last output PPS
+        rising edge, and records when it started. Returns True if it cancelled the wave.
+        """
+        now = self.pi.get_current_tick()
+        if self.PPS_output_tick:
+            since = timebase.tick_diff(self.PPS_output_tick, now)
+            # Far enough ahead to cover the wait for the command to take effect
+            lead = self.hardware_start_latency
+            edge = hardware_outputs.next_edge(since, self.PPS_output_cycle_time, output.frequency, output.phase, 3 * lead)
+            now = self.wait_until((now + int(round(edge - lead))) & 0xFFFFFFFF, now)
+
+        before = now
+        if output.kind == hardware_outputs.PWM:
+            self.pi.hardware_PWM(output.gpio, output.frequency, int(round(output.duty * 1000000)))
+        else:
+            self.pi.hardware_clock(output.gpio, output.frequency)
+        after = self.pi.get_current_tick()
+        self.hardware_start_latency = pigpio.tickDiff(before, after) / 2.0
+        output.reference_phase = 0.0
+        output.phase_error = None
+        # Last, as the output PPS callback only checks outputs with a reference tick
+        output.reference_tick = (before + int(round(self.hardware_start_latency))) & 0xFFFFFFFF
+        return output.kind == hardware_outputs.PWM
+
+    def stop_hardware_output(self, output):
+        """
+        Stops a hardware output. Returns True if it cancelled the wave.
+        """
+        if output.kind == hardware_outputs.PWM:
+            self.pi.hardware_PWM(output.gpio, 0, 0)
+            return True
+        self.pi.hardware_clock(output.gpio, 0)
+        return False
+
+    def wait_until(self, tick, now):
+        """
+        Waits until about tick, from the current tick now, and returns the current tick.
+        The last part is waited by polling the tick, a command latency at a time, which ends within
+        half of it from tick.
+        """
+        while True:
+            remaining = timebase.tick_diff(now, tick)
+            if remaining <= self.hardware_start_latency / 2:
+                return now
+            if remaining > 2000:
+                time.sleep((remaining - 1000) / 1000000.0)
+            now = self.pi.get_current_tick()
+
+    def check_hardware_outputs(self, tick):
+        """
+        Measures the phase of the hardware outputs at an output PPS rising edge, and restarts those
+        which drifted beyond the phase tolerance (or a quarter period) onto their wanted edges.
+        The phase is followed from the tick each output started at, as the outputs run from the
+        same crystal as the tick.
+        Clocks are queued for housekeeping() to restart, as waiting for the wanted edge here would
+        hold up the pigpio callbacks. PWM is restarted at once, as the wave it cancels must be
+        resumed at once; it is only placed where that is rarer than the PWM restart interval.
+        """
+        drifted = []
+        for output in self.hardware_outputs.values():
+            if output.reference_tick is None:
+                continue
+            output.phase_error = hardware_outputs.phase_error(output, timebase.tick_diff(output.reference_tick, tick), self.PPS_output_cycle_time)
+            output.reference_tick = tick
+            # Errors wrap at half a period, so faster outputs are kept within a quarter period
+            if abs(output.phase_error) > min(self.hardware_phase_tolerance, self.PPS_output_cycle_time / output.frequency / 4):
+                drifted.append(output)
+        cancelled = False
+        for output in drifted:
+            if output.kind == hardware_outputs.CLOCK:
+                # Not checked again until restarted
+                output.reference_tick = None
+                self.hardware_restarts.append(output)
+                continue
+            with self.hardware_lock:
+                cancelled |= self.stop_hardware_output(output)
+                cancelled |= self.start_hardware_output(output)
+                self.hardware_realignments += 1
+        if cancelled:
+            self.resume_wave()
+
+    def restart_hardware_outputs(self):
+        """
+        Restarts the clocks found drifted at output PPS edges onto their wanted edges, unless they
+        were replaced or stopped meanwhile. Called by housekeeping().
+        """
+        with self.hardware_lock:
+            while self.hardware_restarts:
+                output = self.hardware_restarts.popleft()
+                if self.stopped or self.hardware_outputs.get(output.gpio) is not output:
+                    continue
+                self.stop_hardware_output(output)
+                self.start_hardware_output(output)
+                self.hardware_realignments += 1
+
+    def resume_wave(self):
+        """
+        Restarts the output wave cancelled by a hardware PWM command at the position it would have
+        reached, so the phase of the outputs is kept. The edges due while it was stopped are lost.
+        """
+        if self.stopped:
+            return
+        if self.chain_waves:
+            self.send_chain(self.chain_plan)
+        elif self.wave is not None and self.timeline is not None and len(self.timeline):
+            self.send_wave(self.timeline, self.hyperperiod, bool(self.wave_variants))
+
+    def send_wave(self, timeline, seconds, variants=False):
+        """
+        Creates a wave from a timeline of seconds PPS periods and starts transmitting it at once, entered
+        at the position the previous output has reached in the PPS period or hyperperiod, so the phase of
+        the outputs is kept. The edges due while no wave is transmitted are lost.
+        A wave of one PPS period is sent rotated to the position, which moves the start of its cycles, so
+        the offset is moved with it. With variants, the wave one microsecond longer the servo switches to
+        is created as well.
+        """
+        before = self.pi.get_current_tick()
+        latency = self.wave_start_latency
+        if not latency:
+            # Adding the pulses, creating the waves, reading the tick and sending take a round trip each
+            now = self.pi.get_current_tick()
+            latency = (4 + 2 * bool(variants)) * pigpio.tickDiff(before, now)
+            before = now
+        start = (before + int(latency)) & 0xFFFFFFFF
+        position = 0
+        if self.frame_origin_tick is not None:
+            position = timebase.tick_diff(self.frame_origin_tick, start) % timeline.length
+        sent = timeline.rotate(position)
+
+        pulses = sent.pulses()
+        self.pi.wave_add_generic(pulses)
+        new_wave = self.pi.wave_create()
+        new_variants = []
+        if variants:
+            last = pulses[-1]
+            self.pi.wave_add_generic(pulses[:-1] + [pigpio.pulse(last.gpio_on, last.gpio_off, last.delay + 1)])
+            new_variants = [new_wave, self.pi.wave_create()]
+        ready = self.pi.get_current_tick()
+        self.pi.wave_send_repeat(new_wave)
+        after = self.pi.get_current_tick()
+        started = (ready + pigpio.tickDiff(ready, after) // 2) & 0xFFFFFFFF
+        self.wave_start_latency = timebase.tick_diff(before, started)
+
+        self.delete_chain_waves()
+        self.delete_waves()
+        self.wave = new_wave
+        self.wave_variants = new_variants
+        self.active_timeline = sent
+        self.wave_start_tick = started
+        if seconds == 1:
+            cycle_time = int(self.PPS_output_cycle_time)
+            self.timeline = sent
+            self.PPS_output_offset = (self.PPS_output_offset + position) % self.PPS_output_cycle_time
+            self.wave_PPS_position = (cycle_time, (cycle_time - int(round(self.PPS_output_offset))) % cycle_time)
+            self.frame_origin_tick = started
+        else:
+            self.wave_PPS_position = None
+            self.frame_origin_tick = (started - position) & 0xFFFFFFFF
+        if self.trigger_log is not None:
+            self.trigger_log.switch(started, sent, started)
+
+    def set_hyperperiod(self, seconds):
+        """
+        Records the PPS periods spanned by the wave just sent. The output PPS callback follows the
+        hyperperiods of waves spanning several.
+        """
+        self.hyperperiod = seconds
+        if seconds > 1:
+            self.start_output_callback()
+        else:
+            self.stop_output_callback()
+
+    def start_handover(self):
+        """
+        Waits for the wave just sent to take over at the end of the current wave cycle, without blocking.
+        The waves it replaces are kept until the switchover is confirmed by handover_edge() on an output
+        PPS rising edge, which comes from a temporary callback if none is set for synchronization.
+        """
+        self.retired_waves.extend(wave for wave in set([self.wave] + self.wave_variants) if wave not in self.retired_waves)
+        if self.handover_tick is None:
+            self.handover_tick = self.pi.get_current_tick()
+            self.handover_switch_tick = None
+            if self.PPS_output_tick and self.wave_PPS_position is not None:
+                # The current wave cycle started at its last output PPS edge less the edge's position in the wave
+                cycle_time, position = self.wave_PPS_position
+                start = (self.PPS_output_tick - position) & 0xFFFFFFFF
+                self.handover_switch_tick = (self.handover_tick + timebase.tick_diff(self.handover_tick, start) % cycle_time) & 0xFFFFFFFF
+        if self.PPS_output_callback is None and self.edge_script is None and self.handover_callback is None and self.PPS_output_gpio != -1:
+            self.handover_callback = self.pi.callback(self.PPS_output_gpio, pigpio.RISING_EDGE, self.handover_callback_edge)
+
+    def handover_callback_edge(self, gpio, level, tick):
+        """
+        Callback function for output PPS rising edges while a switchover is pending.
+        """
+        self.handover_edge(tick)
+
+    def handover_edge(self, tick):
+        """
+        Checks a pending switchover at an output PPS rising edge, with one query of the transmitted wave.
+        Once the new wave transmits, the replaced waves are deleted and the switchover latency measured.
+        If it does not within handover_timeout cycles, the new wave is restarted immediately.
+        Edges at or before the switchover was sent, reaching the callback late, are skipped.
+        """
+        if self.handover_tick is None:
+            return
+        elapsed = timebase.tick_diff(self.handover_tick, tick)
+        if elapsed <= 0:
+            return
+        wave = self.pi.wave_tx_at()
+        if wave == self.wave or wave in self.wave_variants:
+            switched = self.handover_switch_tick
+            if switched is None:
+                # Without an earlier output edge, the switch is taken as the cycle start of the new wave
+                # before this edge, which is off by the phase change of the switchover
+                cycle_time, position = self.wave_PPS_position
+                switched = (tick - position) & 0xFFFFFFFF
+            self.switch_latency = timebase.tick_diff(self.handover_tick, switched) % int(self.PPS_output_cycle_time)
+            self.telemetry.record(telemetry.SWITCH, tick, self.switch_latency)
+        elif elapsed > self.handover_timeout * self.PPS_output_cycle_time:
+            print ("Wave switchover timed out, restarting output wave")
+            self.handover_timeouts += 1
+            self.pi.wave_send_repeat(self.wave)
+            if self.trigger_log is not None:
+                restart = self.pi.get_current_tick()
+                self.trigger_log.switch(restart, self.timeline, restart)
+        else:
+            return
+        self.active_timeline = self.timeline
+        self.delete_retired_waves()
+
+    def housekeeping(self):
+        """
+        Periodic maintenance, to be called about once a second from the main thread.
+        Completes a pending switchover no output PPS edge can confirm, as without a PPS output,
+        applies the queued changes when no output PPS edges do, and restarts the drifted clocks.
+        """
+        if self.pending_changes and self.PPS_output_callback is None and self.edge_script is None:
+            self.apply_changes()
+        if self.hardware_restarts:
+            self.restart_hardware_outputs()
+        if self.handover_tick is not None and self.PPS_output_gpio == -1:
+            wave = self.pi.wave_tx_at()
+            if wave == self.wave or wave in self.wave_variants:
+                self.active_timeline = self.timeline
+                self.delete_retired_waves()
+            elif timebase.tick_diff(self.handover_tick, self.pi.get_current_tick()) > self.handover_timeout * self.PPS_output_cycle_time:
+                self.handover_timeouts += 1
+                self.pi.wave_send_repeat(self.wave)
+                self.active_timeline = self.timeline
+                self.delete_retired_waves()
+
+    def delete_retired_waves(self):
+        """
+        Deletes the waves replaced by a completed switchover.
+        """
+        retired = [wave for wave in self.retired_waves if wave != self.wave and wave not in self.wave_variants]
+        self.retired_waves = []
+        for wave in retired:
+            self.pi.wave_delete(wave)
+        self.end_handover()
+
+    def end_handover(self):
+        self.handover_tick = None
+        self.handover_switch_tick = None
+        if self.handover_callback is not None:
+            self.handover_callback.cancel()
+            self.handover_callback = None
+
+    def send_chain(self, plan):
+        """
+        Creates the waves of a compressed PPS period and starts transmitting them as a wave chain.
+        The chain enters the period at the position the previous output has reached, so the phase
+        of the outputs is kept across updates.
+        """
+        wave_ids = []
+        for pulses in plan.waves:
+            self.pi.wave_add_generic(pulses)
+            wave_ids.append(self.pi.wave_create())
+
+        before = self.pi.get_current_tick()
+        start = (before + int(self.chain_start_latency)) & 0xFFFFFFFF
+        position = 0
+        if self.frame_origin_tick is not None:
+            position = pigpio.tickDiff(self.frame_origin_tick, start) % plan.length
+        self.pi.wave_chain(plan.chain_data(wave_ids, position))
+        after = self.pi.get_current_tick()
+        self.chain_start_latency = pigpio.tickDiff(before, after) / 2.0
+        self.frame_origin_tick = (start - position) & 0xFFFFFFFF
+        self.wave_start_tick = self.frame_origin_tick
+        if self.trigger_log is not None:
+            self.active_timeline = plan.timeline()
+            self.trigger_log.switch(start, self.active_timeline, self.frame_origin_tick)
+
+        self.delete_chain_waves()
+        self.delete_waves()
+        self.chain_waves = wave_ids
+        self.chain_plan = plan
+
+    def delete_waves(self):
+        """
+        Deletes the previous flat wave, its variants and the waves of a pending switchover.
+        """
+        for wave in set([self.wave] + self.wave_variants + self.retired_waves):
+            if wave is not None:
+                self.pi.wave_delete(wave)
+        self.wave = None
+        self.wave_variants = []
+        self.retired_waves = []
+        self.end_handover()
+
+    def delete_chain_waves(self):
+        """
+        Deletes the waves of the previous wave chain.
+        """
+        for wave in self.chain_waves:
+            self.pi.wave_delete(wave)
+        self.chain_waves = []
+        self.chain_plan = None
 
     def cancel(self):
         """
@@ -345,6 +1498,9 @@ class waveform_engine:
         self.stopped = True
         self.stop_PPS_input_sychronization()
         self.stop_NMEA_spoof()
+        self.stop_refclock()
+        self.stop_trigger_log()
+        self.place_hardware_outputs()
         self.pi.wave_tx_stop()
-        if self.wave is not None:
-            self.pi.wave_delete(self.wave)
+        self.delete_waves()
+        self.delete_chain_waves()
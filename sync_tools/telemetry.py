@@ -0,0 +1,283 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  telemetry.py
+#
+#  Synchronization quality telemetry.
+#
+#  The pigpio callback thread records events (input and output PPS edges, applied offsets,
+#  wave rebuilds and switchovers) into preallocated arrays used as a ring buffer, without
+#  locks or allocating containers. The arrays are standard library arrays, whose item
+#  assignment is cheaper than that of NumPy arrays. Readers copy a snapshot and check the write count
+#  around the copy, so they never block the callback thread. Rolling statistics, including
+#  the Allan deviation of the input PPS, are computed from snapshots and served as
+#  Prometheus text metrics over HTTP.
+#
+
+import array
+import math
+import threading
+
+import numpy as np
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+INPUT = 1               # Input PPS rising edge, value is the interval from the previous one in microseconds
+OUTPUT = 2              # Output PPS rising edge, value is its slack (step mode) or phase error (servo) in microseconds
+OFFSET = 3              # Output offset applied, value is the new offset in microseconds
+REBUILD = 4             # Output wave rebuilt, value is the rebuild count
+SWITCH = 5              # Wave switchover confirmed, value is its latency in microseconds
+
+EVENT_NAMES = {INPUT: 'input', OUTPUT: 'output', OFFSET: 'offset', REBUILD: 'rebuild', SWITCH: 'switch'}
+
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+class telemetry_buffer:
+
+    def __init__(self, capacity=4096):
+        """
+        Ring buffer of the last capacity events, with one writer.
+        """
+        self.capacity = capacity
+        self.kinds = array.array('b', [0]) * capacity
+        self.ticks = array.array('I', [0]) * capacity
+        self.values = array.array('d', [0.0]) * capacity
+        self.written = 0            # Events recorded since the start, the next one goes to written % capacity
+
+    def record(self, kind, tick, value):
+        """
+        Records an event. Meant for one thread, the pigpio callback thread; a concurrent writer
+        (such as an update from the main thread) can at worst overwrite one event.
+        """
+        index = self.written % self.capacity
+        self.kinds[index] = kind
+        self.ticks[index] = tick
+        self.values[index] = value
+        self.written += 1
+
+    def snapshot(self, retries=3):
+        """
+        Returns (kinds, ticks, values) of the recorded events, oldest first, as copies.
+        Events overwritten while copying are left out.
+        """
+        for attempt in range(retries):
+            before = self.written
+            kinds, ticks, values = np.array(self.kinds), np.array(self.ticks), np.array(self.values)
+            after = self.written
+            # Events written during the copy (and the one being written) may be torn, as may the
+            # older events whose slots they took, so only complete events before the copy are kept
+            first = max(0, after + 1 - self.capacity)
+            if first <= before:
+                break
+        else:
+            first = before = 0
+        order = np.arange(first, before) % self.capacity
+        return kinds[order], ticks[order], values[order]
+
+
+def _rms(values):
+    return float(np.sqrt(np.mean(np.square(values)))) if len(values) else None
+
+
+def allan_deviation(ticks, cycle_time=1000000.0, taus=(1, 2, 4, 8, 16, 32)):
+    """
+    Returns {tau: Allan deviation} of consecutive PPS edge ticks, for averaging times of tau periods.
+    The phase data is the edge time less the mean period, so it is measured against the Pi oscillator.
+    """
+    ticks = np.asarray(ticks, dtype=np.int64)
+    if len(ticks) < 3:
+        return {}
+    phases = np.cumsum(np.concatenate(([0], (np.diff(ticks) & 0xFFFFFFFF)))).astype(float)
+    phases -= np.arange(len(phases)) * (phases[-1] / (len(phases) - 1))
+    phases *= 1e-6
+    deviations = {}
+    for tau in taus:
+        if len(phases) < 2 * tau + 1:
+            break
+        second_differences = phases[2 * tau:] - 2 * phases[tau:-tau] + phases[:-2 * tau]
+        tau_seconds = tau * cycle_time * 1e-6
+        deviations[tau] = math.sqrt(np.mean(np.square(second_differences)) / (2 * tau_seconds * tau_seconds))
+    return deviations
+
+
+def statistics(buffer, cycle_time=1000000.0, tolerance=0.1):
+    """
+    Returns rolling statistics of the events in a telemetry buffer as a dictionary.
+    Input intervals further than tolerance (as a fraction) from the cycle time are left out.
+    """
+    kinds, ticks, values = buffer.snapshot()
+    counts = dict((name, int(np.count_nonzero(kinds == kind))) for kind, name in EVENT_NAMES.items())
+
+    intervals = values[kinds == INPUT]
+    intervals = intervals[np.abs(intervals - cycle_time) < tolerance * cycle_time]
+    jitter = intervals - np.mean(intervals) if len(intervals) else intervals
+
+    # Allan deviation over the last run of consecutive input edges
+    input_ticks = ticks[kinds == INPUT].astype(np.int64)
+    gaps = np.nonzero(np.abs(values[kinds == INPUT] - cycle_time) >= tolerance * cycle_time)[0]
+    run_start = int(gaps[-1]) if len(gaps) else 0
+
+    slacks = values[kinds == OUTPUT]
+    # Cumulative counts of the slacks at or below each bucket bound, as Prometheus buckets are
+    cumulative = np.searchsorted(np.sort(np.abs(slacks)), HISTOGRAM_BUCKETS, side='right').tolist() + [len(slacks)]
+    switches = values[kinds == SWITCH]
+
+    return {
+        'events': counts,
+        'input_interval_mean': float(np.mean(intervals)) if len(intervals) else None,
+        'input_jitter_mean': float(np.mean(np.abs(jitter))) if len(jitter) else None,
+        'input_jitter_rms': _rms(jitter),
+        'slack_mean': float(np.mean(slacks)) if len(slacks) else None,
+        'slack_rms': _rms(slacks),
+        'slack_histogram': list(zip(HISTOGRAM_BUCKETS + ['+Inf'], cumulative)),
+        'slack_abs_sum': float(np.sum(np.abs(slacks))),
+        'switch_latency_mean': float(np.mean(switches)) if len(switches) else None,
+        'allan_deviation': allan_deviation(input_ticks[run_start:], cycle_time),
+    }
+
+
+def render_metrics(generator, coordinator=None, lidar=None):
+    """
+    Returns the telemetry and state of a waveform_engine as Prometheus text metrics, with the
+    state of the cluster when given its cluster_coordinator, and of the cameras locked to a
+    LiDAR when given the lidar_phase_tracker.
+    """
+    stats = statistics(generator.telemetry, generator.PPS_output_cycle_time)
+    lines = []
+
+    def metric(name, value, help_text, kind='gauge', labels=''):
+        if value is None:
+            return
+        if help_text:
+            lines.append('# HELP sync_%s %s' % (name, help_text))
+            lines.append('# TYPE sync_%s %s' % (name, kind))
+        lines.append('sync_%s%s %s' % (name, labels, repr(float(value))))
+
+    for i, (name, count) in enumerate(sorted(stats['events'].items())):
+        metric('events', count, 'Events in the telemetry window' if i == 0 else None, labels='{event="%s"}' % name)
+    metric('input_interval_microseconds', stats['input_interval_mean'], 'Mean input PPS interval in Pi ticks')
+    metric('input_jitter_rms_microseconds', stats['input_jitter_rms'], 'RMS jitter of the input PPS intervals')
+    metric('input_jitter_mean_microseconds', stats['input_jitter_mean'], 'Mean absolute jitter of the input PPS intervals')
+    metric('slack_rms_microseconds', stats['slack_rms'], 'RMS output PPS slack or servo phase error')
+    metric('slack_mean_microseconds', stats['slack_mean'], 'Mean output PPS slack or servo phase error')
+    if stats['events']['output']:
+        lines.append('# HELP sync_slack_abs_microseconds Absolute output PPS slack or servo phase error')
+        lines.append('# TYPE sync_slack_abs_microseconds histogram')
+        for bucket, count in stats['slack_histogram']:
+            lines.append('sync_slack_abs_microseconds_bucket{le="%s"} %d' % (bucket, count))
+        lines.append('sync_slack_abs_microseconds_count %d' % stats['events']['output'])
+        lines.append('sync_slack_abs_microseconds_sum %r' % stats['slack_abs_sum'])
+    for i, (tau, deviation) in enumerate(sorted(stats['allan_deviation'].items())):
+        metric('input_allan_deviation', deviation, 'Allan deviation of the input PPS against the Pi oscillator' if i == 0 else None, labels='{tau="%d"}' % tau)
+    metric('rebuilds_total', generator.rebuild_count, 'Output wave rebuilds', 'counter')
+    metric('switch_latency_microseconds', generator.switch_latency, 'Latency of the last wave switchover')
+    metric('switch_timeouts_total', generator.handover_timeouts, 'Wave switchovers forced after a timeout', 'counter')
+    metric('hardware_realignments_total', generator.hardware_realignments, 'Hardware outputs restarted after drifting off the output PPS', 'counter')
+    for i, output in enumerate(sorted(generator.hardware_outputs.values(), key=lambda output: output.gpio)):
+        if output.phase_error is not None:
+            metric('hardware_phase_error_microseconds', output.phase_error, 'Phase error of a hardware output at the last output PPS edge' if i == 0 else None, labels='{gpio="%d",path="%s"}' % (output.gpio, output.kind))
+    if generator.edge_script is not None:
+        metric('edge_script_polls_total', generator.edge_script.polls, 'Polls of the pigpiod script timing the PPS edges', 'counter')
+        metric('edge_script_lost_edges_total', generator.edge_script.lost_edges, 'PPS edges timed by the script but replaced before a poll', 'counter')
+    if generator.refclock is not None:
+        metric('refclock_samples_total', generator.refclock.samples, 'Input PPS edges fed to the system clock', 'counter')
+        metric('refclock_offset_seconds', generator.refclock.offset, 'Input PPS time less system clock at the last edge fed to it')
+        metric('refclock_round_trip_microseconds', generator.refclock.round_trip, 'Tick read round trip the last edge was placed against the system clock with')
+    if generator.PPS_sources is not None:
+        sources = generator.PPS_sources.status()
+        metric('input_source_switches_total', sources['switches'], 'Switches between the input PPS sources', 'counter')
+        metric('input_source_carry_microseconds', sources['carry'], 'Offset carried over by the last input PPS source switch still to slew out')
+        for i, source in enumerate(sources['sources']):
+            labels = '{gpio="%d"}' % source['gpio']
+            metric('input_source_active', 1 if source['gpio'] == sources['active'] else 0, 'Whether the input PPS source is the one followed' if i == 0 else None, labels=labels)
+            metric('input_source_score_microseconds', source['score'], 'Score of the input PPS source, lower is better' if i == 0 else None, labels=labels)
+            metric('input_source_jitter_microseconds', source['jitter_rms'], 'RMS interval jitter of the input PPS source' if i == 0 else None, labels=labels)
+            metric('input_source_offset_microseconds', source['offset'], 'Offset of the input PPS source against the one followed' if i == 0 else None, labels=labels)
+            metric('input_source_fault_rate', source['faults'], 'Smoothed rate of rejected edges and bad pulse widths of the input PPS source' if i == 0 else None, labels=labels)
+            metric('input_source_rejected_edges_total', source['rejected'] + source['bad_widths'], 'Input PPS edges rejected or ending pulses of the wrong width' if i == 0 else None, 'counter', labels=labels)
+    first_edge, lock = generator.startup_times()
+    metric('startup_first_edge_seconds', first_edge, 'Time from the start of the service to the first output edge')
+    metric('startup_lock_seconds', lock, 'Time from the start of the service to the first lock to the input PPS')
+    metric('output_offset_microseconds', generator.PPS_output_offset, 'Output PPS offset')
+    metric('output_cycle_time_microseconds', generator.PPS_output_cycle_time, 'Output PPS cycle time')
+    if generator.PPS_servo is not None:
+        metric('servo_locked', 1 if generator.PPS_servo.locked() else 0, 'Whether the PPS servo is locked')
+    state, periods, estimated_error, measured_error = generator.holdover_status()
+    metric('holdover', 1 if state == 'holdover' else 0, 'Whether the output PPS is held over without input')
+    metric('holdover_error_microseconds', estimated_error, 'Estimated accumulated holdover error')
+    if coordinator is not None:
+        cluster = coordinator.status()
+        metric('cluster_plan_revision', cluster['revision'], 'Revision of the cluster trigger plan')
+        metric('cluster_unplaced_triggers', len(cluster['unplaced']), 'Cluster triggers not placed on a node')
+        metric('cluster_phase_spread_microseconds', cluster['phase_spread'], 'Largest less smallest PPS residual of the locked cluster nodes')
+        for i, (name, node) in enumerate(sorted(cluster['nodes'].items())):
+            labels = '{node="%s"}' % name
+            metric('cluster_node_locked', 1 if node['state'] == 'locked' else 0, 'Whether a cluster node reports its output PPS locked' if i == 0 else None, labels=labels)
+            metric('cluster_node_residual_microseconds', node['residual'], 'PPS residual last reported by a cluster node' if i == 0 else None, labels=labels)
+            metric('cluster_node_report_age_seconds', node['age'], 'Time since the last report of a cluster node' if i == 0 else None, labels=labels)
+    if lidar is not None:
+        state = lidar.status()
+        metric('lidar_rpm', state['rpm'], 'Rotation speed of the LiDAR estimated from its packets')
+        metric('lidar_second_azimuth_degrees', state['second_azimuth'], 'Azimuth of the LiDAR at the top of the second')
+        metric('lidar_packets_total', state['packets'], 'LiDAR data packets received', 'counter')
+        metric('lidar_phase_updates_total', state['updates'], 'Camera trigger phase updates following the LiDAR', 'counter')
+        for i, (gpio, error) in enumerate(sorted(state['azimuth_errors'].items())):
+            metric('lidar_camera_azimuth_error_degrees', error, 'LiDAR azimuth at mid-exposure less the camera mounting azimuth' if i == 0 else None, labels='{gpio="%d"}' % gpio)
+    return '\n'.join(lines) + '\n'
+
+
+class metrics_server(threading.Thread):
+
+    def __init__(self, generator, port=9108, host='127.0.0.1', coordinator=None, lidar=None):
+        """
+        Thread serving the metrics of a waveform_engine, and of the cluster of coordinator and the
+        lidar_phase_tracker lidar if given, at http://host:port/metrics.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        engine = generator
+        self.coordinator = coordinator
+        self.lidar = lidar
+        server = self
+
+        class handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = render_metrics(engine, server.coordinator, server.lidar).encode('ascii')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer((host, port), handler)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,163 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  timebase.py
+#
+#  Maps pigpio ticks to UTC.
+#
+#  pigpio ticks are 32-bit microsecond counts that wrap every ~71.6 minutes. They are
+#  extended to 64 bits relative to the last anchor, and a line is fitted through the
+#  (tick, UTC second) pairs of recent PPS edges, which start whole UTC seconds. The
+#  second of the first anchor is taken from the system clock, later ones continue from
+#  the fit, so a step of the system clock does not disturb the mapping.
+#
+
+import collections
+import math
+import time
+
+import numpy as np
+
+TICK_MASK = 0xFFFFFFFF
+TICK_WRAP = TICK_MASK + 1
+
+
+def tick_diff(t1, t2):
+    """
+    Returns t2 - t1 in microseconds for 32-bit ticks, negative if t2 is before t1.
+    Valid for ticks within ~35 minutes of each other.
+    """
+    diff = (t2 - t1) & TICK_MASK
+    if diff >= TICK_WRAP // 2:
+        diff -= TICK_WRAP
+    return diff
+
+
+class timebase:
+
+    def __init__(self, window=64, tolerance=200.0, relabel_count=3):
+        """
+        window is the number of PPS anchors the mapping is fitted over.
+        Anchors more than tolerance microseconds off the fitted mapping are rejected. After more
+        than relabel_count consecutive rejections, or relabel_count consecutive anchors disagreeing
+        with the system clock by a second or more, the mapping is restarted from the system clock.
+        """
+        self.window = window
+        self.tolerance = tolerance
+        self.relabel_count = relabel_count
+        self.reset()
+
+    def reset(self):
+        self.anchors = collections.deque(maxlen=self.window)     # (extended tick, UTC second)
+        # (last anchor tick, its extended tick, extended tick of the origin, UTC second of the origin,
+        # microseconds per UTC second), replaced as a whole so other threads read a consistent mapping
+        self.mapping = (None, 0, 0.0, 0, 1000000.0)
+        self.rejected = 0
+        self.rejected_in_row = 0
+        self.mislabelled = 0
+
+    def valid(self):
+        return len(self.anchors) > 0
+
+    def age(self, tick):
+        """
+        Returns the microseconds from the last anchor to a pigpio tick, or None without anchors.
+        """
+        last_tick = self.mapping[0]
+        if last_tick is None:
+            return None
+        return tick_diff(last_tick, tick)
+
+    def extend(self, tick):
+        """
+        Returns the 64-bit tick for a 32-bit pigpio tick within ~35 minutes of the last anchor.
+        """
+        return _extend(self.mapping, tick)
+
+    def add_anchor(self, tick, system_time=None):
+        """
+        Adds a PPS rising edge, which starts a UTC second.
+        system_time is the system clock (seconds since the epoch) close to the edge, time.time() by default.
+        Returns False if the edge was rejected.
+        """
+        if system_time is None:
+            system_time = time.time()
+        extended = self.extend(tick)
+        if self.valid():
+            utc = self.utc_at(tick)
+            second = int(round(utc))
+            if abs(utc - second) * self.mapping[4] > self.tolerance or second <= self.anchors[-1][1]:
+                self.rejected += 1
+                self.rejected_in_row += 1
+                if self.rejected_in_row > self.relabel_count or len(self.anchors) == 1:
+                    # The PPS source changed, start over
+                    self.reset()
+                    return self.add_anchor(tick, system_time)
+                return False
+            self.rejected_in_row = 0
+            if abs(second - system_time) >= 1.0:
+                self.mislabelled += 1
+                if self.mislabelled >= self.relabel_count:
+                    self.reset()
+                    return self.add_anchor(tick, system_time)
+            else:
+                self.mislabelled = 0
+        else:
+            second = int(round(system_time))
+
+        self.anchors.append((extended, second))
+        origin_tick, micros_per_second = float(extended), 1000000.0
+        if len(self.anchors) > 1:
+            ticks = np.array([anchor[0] - extended for anchor in self.anchors], dtype=float)
+            seconds = np.array([anchor[1] - second for anchor in self.anchors], dtype=float)
+            micros_per_second, intercept = np.polyfit(seconds, ticks, 1)
+            micros_per_second = float(micros_per_second)
+            origin_tick = extended + float(intercept)
+        self.mapping = (tick, extended, origin_tick, second, micros_per_second)
+        return True
+
+    def utc_at(self, tick):
+        """
+        Returns the UTC time of a pigpio tick in seconds since the epoch.
+        """
+        mapping = self.mapping
+        return mapping[3] + (_extend(mapping, tick) - mapping[2]) / mapping[4]
+
+    def split(self, tick):
+        """
+        Returns the UTC time of a pigpio tick as (whole seconds since the epoch, microseconds),
+        without the rounding of a float holding the whole time.
+        """
+        mapping = self.mapping
+        seconds = (_extend(mapping, tick) - mapping[2]) / mapping[4]
+        whole = int(math.floor(seconds + 0.5e-6))    # Ticks a rounding error before a second belong to it
+        return mapping[3] + whole, max(0.0, (seconds - whole) * 1000000.0)
+
+    def next_second(self, tick):
+        """
+        Returns (UTC second, pigpio tick) of the first whole second after a pigpio tick.
+        """
+        mapping = self.mapping
+        seconds = (_extend(mapping, tick) - mapping[2]) / mapping[4]
+        second = mapping[3] + int(math.floor(seconds + 0.5e-6)) + 1
+        extended = mapping[2] + (second - mapping[3]) * mapping[4]
+        return second, int(round(extended)) & TICK_MASK
+
+
+def _extend(mapping, tick):
+    if mapping[0] is None:
+        return tick
+    return mapping[1] + tick_diff(mapping[0], tick)
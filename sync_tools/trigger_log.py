@@ -0,0 +1,301 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  trigger_log.py
+#
+#  Log of trigger edge times, for matching sensor data to the trigger that caused it.
+#
+#  The edges are not captured with callbacks. At each output PPS rising edge, the rising
+#  edges of all outputs over the PPS period it ends are derived from the edge timelines of
+#  the waves transmitted, and timestamped in UTC through the timebase: the part of the
+#  period up to the end of the wave cycle counts forward from the PPS edge starting it, and
+#  the rest back from the PPS edge ending it, so edges stay exact across switchovers to a new
+#  wave and wave cycles lengthened by the servo. Waves started immediately, as wave chains
+#  are, are handed over as switches within the period. This is done by a separate thread, which appends fixed size records to memory mapped files
+#  rotated at a fixed size, so memory use does not grow with the log. Every batch of
+#  records (one PPS period) adds an entry to a sparse per-second index kept next to each
+#  file, through which the reader finds a time range with a bisection.
+#
+
+import bisect
+import collections
+import os
+import threading
+
+import numpy as np
+
+import timebase
+
+RECORD = np.dtype([('time', '<i8'), ('tick', '<u4'), ('gpio', 'u1'), ('flags', 'u1'), ('reserved', '<u2')])
+INDEX = np.dtype([('second', '<i8'), ('position', '<i8')])
+
+MAGIC = b'TRIGLOG1'
+HEADER_SIZE = 16            # Magic and the number of records written, as little endian uint64
+
+FLAG_HOLDOVER = 1           # The input PPS was lost, times come from the holdover model
+FLAG_UNSYNCHRONIZED = 2     # No input PPS synchronization, times come from the system clock
+
+_EDGE = 0
+_SWITCH = 1
+
+
+def _file_name(directory, second, sequence, extension):
+    # Named by the UTC second of the first record, and a sequence number as a file can fill within a second
+    return os.path.join(directory, 'triggers-%011d-%06d.%s' % (second, sequence % 1000000, extension))
+
+
+class trigger_log_writer(threading.Thread):
+
+    def __init__(self, directory, timebase, file_records=1 << 22, max_files=64, max_edges=16):
+        """
+        Thread writing the trigger edges of each PPS period to the files in directory.
+        Each file holds file_records records (16 bytes each); the oldest files are deleted to keep
+        at most max_files.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.directory = directory
+        self.timebase = timebase
+        self.file_records = file_records
+        self.max_files = max_files
+        self.edges = collections.deque(maxlen=max_edges)     # Output PPS edges and switches to write
+        self.event = threading.Event()
+        self.running = False
+
+        self.records = None         # Memory map of the records of the current file
+        self.header = None          # Memory map of the record count of the current file
+        self.index_file = None
+        self.position = 0
+        self.sequence = 0
+        self.written = 0
+        self.dropped_edges = 0
+        self.period_start = None    # (tick, timeline, PPS gpio, flags, position) at the PPS edge starting the period
+        self.switches = []          # (tick, timeline, cycle start tick) of the waves started since
+        self.rising_edges = []      # [(timeline, rising edges)] of the last timelines
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def edge(self, tick, timeline, PPS_gpio, flags=0, position=None):
+        """
+        Hands an output PPS rising edge over to the writer, with the timeline of the wave being sent.
+        position is the time of the edge in a wave spanning several PPS periods, by default the
+        first PPS rising edge of the timeline.
+        The edges of each PPS period are written at the PPS edge ending it.
+        Safe to call from the pigpio callback thread.
+        """
+        if len(self.edges) == self.edges.maxlen:
+            self.dropped_edges += 1
+        self.edges.append((_EDGE, tick, timeline, PPS_gpio, flags, position))
+        self.event.set()
+
+    def switch(self, tick, timeline, cycle_start):
+        """
+        Tells the writer that transmission of a wave with the given timeline started at tick without waiting
+        for the current wave cycle to end, with its cycle aligned to start at the cycle_start tick.
+        """
+        self.edges.append((_SWITCH, tick, timeline, cycle_start, 0, None))
+
+    def start(self):
+        self.running = True
+        threading.Thread.start(self)
+
+    def stop(self):
+        self.running = False
+        self.event.set()
+        if self.is_alive():
+            self.join(1.0)
+        self._close()
+
+    def run(self):
+        while self.running:
+            self.event.wait(1.0)
+            self.event.clear()
+            while self.edges:
+                kind, tick, timeline, value, flags, position = self.edges.popleft()
+                if kind == _SWITCH:
+                    self.switches.append((tick, timeline, value))
+                    continue
+                edge = (tick, timeline, value, flags, position)
+                if self.period_start is not None:
+                    self._write_period(self.period_start, edge)
+                self.period_start = edge
+
+    def _rising_edges(self, timeline, PPS_gpio):
+        # (wave times, gpios) of the rising edges of all outputs and the wave time of the PPS rising edge
+        for cached, edges in self.rising_edges:
+            if cached is timeline:
+                return edges
+        times = np.asarray(timeline.times, dtype=np.int64)
+        # Rising edges from the levels, as the first event of a rotated timeline sets all levels
+        states = np.asarray(timeline.states(), dtype=np.int64)
+        on_masks = states & ~np.roll(states, 1)
+        PPS = np.nonzero(on_masks & (1 << PPS_gpio))[0]
+        position = int(times[PPS[0]]) if len(PPS) else 0
+        edge_times, gpios = [], []
+        for gpio in range(32):
+            rising = times[(on_masks >> gpio) & 1 == 1]
+            if len(rising):
+                edge_times.append(rising)
+                gpios.append(np.full(len(rising), gpio, dtype=np.uint8))
+        edge_times = np.concatenate(edge_times) if edge_times else np.zeros(0, dtype=np.int64)
+        gpios = np.concatenate(gpios) if gpios else np.zeros(0, dtype=np.uint8)
+        order = np.argsort(edge_times, kind='mergesort')
+        edges = (edge_times[order], gpios[order], position)
+        self.rising_edges = self.rising_edges[-1:] + [(timeline, edges)]
+        return edges
+
+    def _write_period(self, period_start, period_end):
+        tick, timeline, PPS_gpio, flags, position = period_start
+        end_tick, end_timeline, end_PPS_gpio, end_flags, end_position = period_end
+        duration = (end_tick - tick) & 0xFFFFFFFF
+        if position is None:
+            position = self._rising_edges(timeline, PPS_gpio)[2]
+        # The waves transmitted over the period, as (start, timeline, cycle start) in ticks from the PPS edge:
+        # the wave of the PPS edge, the waves started within the period, and the wave of the ending PPS
+        # edge from the start of its wave cycle, unless a wave started within the period goes on to it
+        segments = [(0, timeline, -position)]
+        # Switches before the period are already in the timeline of its starting edge
+        switches = [switch for switch in self.switches if 0 < timebase.tick_diff(tick, switch[0]) < duration]
+        self.switches = [switch for switch in self.switches if timebase.tick_diff(end_tick, switch[0]) >= 0]
+        for switch_tick, switch_timeline, cycle_start in switches:
+            segments.append((timebase.tick_diff(tick, switch_tick), switch_timeline, timebase.tick_diff(tick, cycle_start)))
+        if end_position is None:
+            end_position = self._rising_edges(end_timeline, end_PPS_gpio)[2]
+        boundary = duration - end_position
+        if boundary > segments[-1][0]:
+            segments.append((boundary, end_timeline, boundary))
+
+        offsets, batch_gpios = [], []
+        for i, (start, segment_timeline, cycle_start) in enumerate(segments):
+            finish = segments[i + 1][0] if i + 1 < len(segments) else duration
+            if i == 0:
+                finish = min(finish, timeline.length - position)
+            segment_times, segment_gpios, segment_position = self._rising_edges(segment_timeline, PPS_gpio)
+            cycle_start += (start - cycle_start) // segment_timeline.length * segment_timeline.length
+            segment_offsets = segment_times + cycle_start
+            keep = (segment_offsets >= start) & (segment_offsets < finish)
+            offsets.append(segment_offsets[keep])
+            batch_gpios.append(segment_gpios[keep])
+        offsets = np.concatenate(offsets)
+        gpios = np.concatenate(batch_gpios)
+        if not len(offsets):
+            return
+
+        second, micros = self.timebase.split(tick)
+        micros_per_tick = 1000000.0 / self.timebase.mapping[4]
+        batch = np.zeros(len(offsets), dtype=RECORD)
+        batch['time'] = second * 1000000000 + np.round((micros + offsets * micros_per_tick) * 1000.0).astype(np.int64)
+        batch['tick'] = (tick + offsets) & 0xFFFFFFFF
+        batch['gpio'] = gpios
+        batch['flags'] = flags
+
+        start = 0
+        while start < len(batch):
+            if self.records is None or self.position == self.file_records:
+                self._open(second)
+            count = min(len(batch) - start, self.file_records - self.position)
+            self.index_file.write(np.array([(second, self.position)], dtype=INDEX).tobytes())
+            self.records[self.position:self.position + count] = batch[start:start + count]
+            self.position += count
+            self.header[0] = self.position
+            start += count
+        self.index_file.flush()
+        self.written += len(batch)
+
+    def _open(self, second):
+        self._close()
+        self.sequence += 1
+        name = _file_name(self.directory, second, self.sequence, 'bin')
+        with open(name, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.zeros(1, dtype='<u8').tobytes())
+            f.truncate(HEADER_SIZE + self.file_records * RECORD.itemsize)
+        self.header = np.memmap(name, dtype='<u8', mode='r+', offset=len(MAGIC), shape=(1,))
+        self.records = np.memmap(name, dtype=RECORD, mode='r+', offset=HEADER_SIZE, shape=(self.file_records,))
+        self.index_file = open(_file_name(self.directory, second, self.sequence, 'idx'), 'wb')
+        self.position = 0
+
+        files = sorted(name for name in os.listdir(self.directory) if name.endswith('.bin'))
+        for old in files[:max(0, len(files) - self.max_files)]:
+            os.remove(os.path.join(self.directory, old))
+            index_name = os.path.join(self.directory, old[:-4] + '.idx')
+            if os.path.exists(index_name):
+                os.remove(index_name)
+
+    def _close(self):
+        if self.records is not None:
+            self.records.flush()
+            self.header.flush()
+            self.index_file.close()
+            self.records = self.header = self.index_file = None
+
+
+class trigger_log_reader:
+
+    def __init__(self, directory):
+        """
+        Reads the trigger edges logged to a directory. Can be used while the log is written.
+        """
+        self.directory = directory
+        self.indices = {}       # Sparse indices of the files, by name, for files no longer written
+
+    def _files(self):
+        names = sorted(name[:-4] for name in os.listdir(self.directory) if name.endswith('.bin'))
+        return [(int(name.split('-')[1]), name) for name in names]
+
+    def _index(self, name, last):
+        index = self.indices.get(name)
+        if index is None:
+            index = np.fromfile(os.path.join(self.directory, name + '.idx'), dtype=INDEX)
+            if not last:
+                self.indices[name] = index
+        return index
+
+    def edges(self, gpio, start, end):
+        """
+        Returns the records of the rising edges of a GPIO from start (inclusive) to end (exclusive),
+        given as UTC seconds since the epoch, with fields time (UTC nanoseconds since the epoch),
+        tick (pigpio tick), gpio and flags.
+        """
+        start_ns, end_ns = int(round(start * 1e9)), int(round(end * 1e9))
+        files = self._files()
+        first_seconds = [second for second, name in files]
+        # The file holding start is the last one starting at or before its second
+        first = max(0, bisect.bisect_right(first_seconds, int(start) - 1) - 1)
+        results = []
+        for i in range(first, len(files)):
+            second, name = files[i]
+            if second >= end:
+                break
+            path = os.path.join(self.directory, name + '.bin')
+            try:
+                index = self._index(name, i == len(files) - 1)
+                count = int(np.fromfile(path, dtype='<u8', count=2)[1])
+            except (IOError, OSError, IndexError):
+                continue    # Deleted by the writer's rotation, or not written yet
+            # Batches start at the output PPS edges, so the batch of the second before start covers it
+            low, high = np.searchsorted(index['second'], [int(start) - 1, int(end) + 1])
+            begin = int(index['position'][low]) if low < len(index) else count
+            stop = min(count, int(index['position'][high])) if high < len(index) else count
+            if stop <= begin:
+                continue
+            records = np.memmap(path, dtype=RECORD, mode='r', offset=HEADER_SIZE, shape=(count,))[begin:stop]
+            match = records[(records['gpio'] == gpio) & (records['time'] >= start_ns) & (records['time'] < end_ns)]
+            results.append(np.array(match))
+        if not results:
+            return np.zeros(0, dtype=RECORD)
+        return np.concatenate(results)
@@ -2,6 +2,7 @@
 
 import socket
 import operator
+from functools import reduce
 
 
 ## Verifies if the port on the specified ip is available in a non blocking way.
@@ -20,8 +21,10 @@ def check_ip_port_open(ip, port):
 
 
 ## Obtains the checksum of an nmea sentence
-# @param nmea sentence string
-# @return checksum string
+# @param nmea sentence string, with or without the leading '$'
+# @return checksum string of two hexadecimal digits
 def get_nmea_checksum(nmea_sentence):
-    checksum = reduce(operator.xor, (ord(c) for c in nmea_sentence), 0)
-    return checksum
\ No newline at end of file
+    if isinstance(nmea_sentence, bytes):
+        nmea_sentence = nmea_sentence.decode('ascii')
+    checksum = reduce(operator.xor, (ord(c) for c in nmea_sentence.lstrip('$')), 0)
+    return '%02X' % checksum
\ No newline at end of file
@@ -0,0 +1,681 @@
+#
+#  Copyright 2020 The Autoware Foundation. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#  ********************
+#
+#  wave_compiler.py
+#
+#  Compiles the output configuration of a waveform_engine into pigpio pulse lists.
+#
+#  The edges of all outputs are computed as NumPy arrays and merged into a single
+#  edge_timeline holding one pulse per distinct edge time, with the GPIOs switched
+#  on and off at that time combined into set and clear bitmasks.
+#
+#  Compressed waveforms split one PPS period into blocks spanning a whole number of
+#  periods of the common sub-period of all triggers (the PPS period divided by the GCD
+#  of the trigger frequencies). Every block has the same trigger pattern, so only a
+#  short base wave per PPS output level (plus a one microsecond longer variant to absorb
+#  the fractional block length) and the blocks holding the PPS output edges are created,
+#  and a pigpio wave chain repeats them with loop counts.
+#
+#  Triggers with rational frequencies (like 7.5 or 30000/1001 Hertz) only repeat after
+#  several PPS periods, so their waves span the hyperperiod: the least number of PPS periods
+#  holding a whole number of cycles of every trigger. Compressed hyperperiods use blocks of
+#  the common sub-period of the hyperperiod. Where the triggers share no sub-period (a slow
+#  rational trigger with a fast one), or its blocks are too large, the hyperperiod is cut into
+#  sub-blocks on the cycle grid of one output, and the sub-blocks in which every output has its
+#  next edge at the same microsecond are shared: the blocks of the fast trigger between the edges
+#  of the others repeat. Sub-blocks are told apart by the phases of the outputs at their starts,
+#  so only the distinct ones are compiled and the hyperperiod is never unrolled.
+#  A chain can only tell its blocks apart by their order, so outputs whose relative phase
+#  differs in every PPS period of a long hyperperiod (30000/1001 Hertz against the PPS output
+#  over 1001 seconds) need more distinct blocks and loops than pigpiod has, and are refused.
+#
+
+import bisect
+import collections
+import fractions
+
+import numpy as np
+import pigpio
+
+MAX_CHAIN_BYTES = 600               # pigpiod chain buffer, see pi.wave_chain()
+MAX_CHAIN_LOOPS = 20                # pigpiod loop counters per chain
+MAX_CHAIN_DELAY = 65535             # longest single chain delay command in microseconds
+MAX_BLOCK_ERROR = 1.0               # allowed block start error against the ideal grid in microseconds
+LOOP_THRESHOLD = 8                  # runs of a wave longer than this are encoded as loops
+MAX_CHAIN_WAVES = 128               # distinct block waves of a chain, of pigpiod's 250 waves
+MAX_CHAIN_PULSES = 6000             # pulses of all block waves, so a chain and its replacement fit pigpiod's 25016 control blocks
+MAX_WAVE_PULSES = 12000             # pigpiod pulses per wave, see pi.wave_get_max_pulses()
+MIN_SUB_BLOCK = 100                 # shortest sub-block in microseconds
+MAX_SUB_BLOCKS = 100000             # most sub-blocks of a hyperperiod
+MAX_HYPERPERIOD = 3600              # longest hyperperiod in PPS periods
+
+
+def rational_frequency(frequency):
+    """
+    Returns a trigger frequency in Hertz as an int, or as a fractions.Fraction if it is not whole.
+    Takes ints, Fractions, floats (as the decimal they print as, so 29.97 is 2997/100) and strings
+    such as '12.5' or '30000/1001'.
+    Raises ValueError if the frequency is not positive or only repeats after more than MAX_HYPERPERIOD seconds.
+    """
+    if isinstance(frequency, float):
+        frequency = repr(frequency)
+    if isinstance(frequency, str):
+        frequency = frequency.strip()
+    try:
+        value = fractions.Fraction(frequency)
+    except ZeroDivisionError:
+        raise ValueError('invalid frequency %r' % (frequency,))
+    if value <= 0:
+        raise ValueError('frequency must be positive')
+    if value.denominator > MAX_HYPERPERIOD:
+        raise ValueError('frequency %s only repeats after %d seconds' % (format_frequency(value), value.denominator))
+    return int(value) if value.denominator == 1 else value
+
+
+def format_frequency(frequency):
+    """
+    Returns a frequency as a decimal number if it has one, or as a fraction.
+    """
+    value = fractions.Fraction(frequency)
+    denominator = value.denominator
+    for factor in (2, 5):
+        while denominator % factor == 0:
+            denominator //= factor
+    if value.denominator == 1:
+        return '%d' % value
+    if denominator == 1:
+        return repr(float(value))
+    return '%d/%d' % (value.numerator, value.denominator)
+
+
+def hyperperiod(triggers):
+    """
+    Returns the number of PPS periods after which the triggers, given as (gpio, frequency, phase, duty), repeat.
+    """
+    seconds = 1
+    for gpio, frequency, phase, duty in triggers:
+        denominator = fractions.Fraction(frequency).denominator
+        seconds = seconds * denominator // _gcd(seconds, denominator)
+    return seconds
+
+
+class edge_timeline:
+
+    def __init__(self, times, on_masks, off_masks, length):
+        """
+        Merged edges of all outputs of one wave.
+        times are the distinct edge times in microseconds from the start of the wave, and
+        on_masks and off_masks the GPIO bitmasks switched on and off at those times.
+        length is the total length of the wave in microseconds.
+        """
+        self.times = times
+        self.on_masks = on_masks
+        self.off_masks = off_masks
+        self.length = length
+        self._pulses = None
+        self._states = None
+
+    def __len__(self):
+        return len(self.times)
+
+    def pulses(self):
+        """
+        Returns the timeline as a pigpio pulse list, one pulse per distinct edge time.
+        The list is built once and shared with rotated copies, so it must not be modified.
+        """
+        if self._pulses is None:
+            delays = np.diff(np.append(self.times, self.length))
+            self._pulses = [pigpio.pulse(on_mask, off_mask, delay) for on_mask, off_mask, delay in zip(self.on_masks.tolist(), self.off_masks.tolist(), delays.tolist())]
+        return self._pulses
+
+    def states(self):
+        """
+        Returns the bitmask of the GPIOs that are on after every edge time.
+        """
+        if self._states is None:
+            count = len(self.times)
+            self._states = np.zeros(count, dtype=np.int64)
+            switched = np.bitwise_or.reduce(self.on_masks | self.off_masks) if count else 0
+            index = np.arange(count)
+            for gpio in range(64):
+                bit = 1 << gpio
+                if bit > switched:
+                    break
+                if not switched & bit:
+                    continue
+                last = np.maximum.accumulate(np.where(((self.on_masks | self.off_masks) & bit) != 0, index, -1))
+                level = (self.on_masks[last] & bit) != 0
+                self._states |= np.where(level, bit, 0)
+        return self._states
+
+    def rotate(self, shift):
+        """
+        Returns the timeline started shift microseconds later, wrapping the skipped part to the end.
+        The timeline must set the level of all its outputs at time zero, as compile_timeline() does.
+        If the pulses of this timeline were built, only the pulses around the wrap point are rebuilt
+        and the others are shared.
+        """
+        shift = int(shift) % self.length
+        if shift == 0 or len(self.times) == 0:
+            return self
+        times = self.times
+        index = int(np.searchsorted(times, shift))
+        exact = index < len(times) and times[index] == shift
+        after = index + 1 if exact else index
+        outputs = int(self.on_masks[0] | self.off_masks[0])
+        state = int(self.states()[index if exact else index - 1])
+
+        rotated = edge_timeline(
+            np.concatenate(([0], times[after:] - shift, times[:index] + self.length - shift)),
+            np.concatenate(([state & outputs], self.on_masks[after:], self.on_masks[:index])),
+            np.concatenate(([outputs & ~state], self.off_masks[after:], self.off_masks[:index])),
+            self.length)
+
+        if self._pulses is None:
+            return rotated
+        pulses = self._pulses
+        first_delay = (times[after] if after < len(times) else self.length) - shift
+        last = pulses[index - 1]
+        rotated._pulses = ([pigpio.pulse(state & outputs, outputs & ~state, int(first_delay))] + pulses[after:] + pulses[:index - 1] +
+                           [pigpio.pulse(last.gpio_on, last.gpio_off, shift - int(times[index - 1]))])
+        return rotated
+
+    def events(self):
+        """
+        Returns the timeline as a {time: (on_mask, off_mask)} dictionary.
+        """
+        return dict(zip(self.times.tolist(), zip(self.on_masks.tolist(), self.off_masks.tolist())))
+
+    def edges(self, gpio, level=1):
+        """
+        Returns the times of the rising (level 1) or falling (level 0) edges of a GPIO.
+        """
+        masks = self.on_masks if level else self.off_masks
+        return self.times[(masks & (1 << gpio)) != 0]
+
+    def rising_edges(self, gpio):
+        """
+        Returns the times of the rising edges of a GPIO from its levels, so unlike edges(), the level set at
+        time zero of a rotated timeline is only a rising edge if the GPIO is off at the end.
+        """
+        states = self.states()
+        bit = 1 << gpio
+        return self.times[((states & bit) != 0) & ((np.roll(states, 1) & bit) == 0)]
+
+
+def output_phases(cycle_time, offset, PPS_gpio, PPS_duty, triggers):
+    """
+    Returns (gpio, period, rising, on_time) for the output PPS and every trigger, where rising is the
+    time of the first rising edge in the wave. Times are in microseconds.
+    triggers is a list of (gpio, frequency, phase, duty). The phase of a trigger whose frequency is not
+    whole is relative to the start of the hyperperiod.
+    """
+    outputs = []
+    if PPS_gpio != -1:
+        outputs.append((PPS_gpio, cycle_time, (cycle_time - offset) % cycle_time, PPS_duty * cycle_time))
+    for gpio, frequency, phase, duty in triggers:
+        period = cycle_time / frequency
+        outputs.append((gpio, period, (period * phase / 360.0 - offset) % period, duty * period))
+    return outputs
+
+
+def compile_timeline(outputs, length, start=0.0, span=None):
+    """
+    Computes the edges of all outputs between start and start + span (defaults to length) and merges
+    them into an edge_timeline of the given length. Edge times are truncated to whole microseconds
+    and the level of every output is set at time zero so the wave is self contained.
+    outputs is a list of (gpio, period, rising, on_time) as returned by output_phases.
+    """
+    if span is None:
+        span = length
+    return merge_edges([output_edges(output, start, span) for output in outputs], length)
+
+
+def output_edges(output, start, span):
+    """
+    Computes the edges of one output between start and start + span.
+    Returns (gpios, times, levels) arrays, starting with the level of the output at time zero.
+    output is (gpio, period, rising, on_time) as returned by output_phases.
+    """
+    gpio, period, rising, on_time = output
+    if on_time <= 0 or on_time >= period:
+        return np.array([gpio], dtype=np.int64), np.zeros(1), np.array([1 if on_time >= period else 0], dtype=np.int64)
+    falling = (rising + on_time) % period
+    rises = _edge_times(period, rising, start, span)
+    falls = _edge_times(period, falling, start, span)
+    initial = 1 if (start - rising) % period < on_time else 0
+    gpios = np.full(len(rises) + len(falls) + 1, gpio, dtype=np.int64)
+    times = np.concatenate(([0.0], rises, falls))
+    levels = np.concatenate(([initial], np.ones(len(rises), dtype=np.int64), np.zeros(len(falls), dtype=np.int64)))
+    return gpios, times, levels
+
+
+def merge_edges(edges, length):
+    """
+    Merges the (gpios, times, levels) arrays of several outputs into an edge_timeline of the given length.
+    """
+    if not edges:
+        return edge_timeline(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), length)
+    gpios = np.concatenate([edge[0] for edge in edges])
+    times = np.concatenate([edge[1] for edge in edges])
+    levels = np.concatenate([edge[2] for edge in edges])
+
+    # Per GPIO in time order, keep the last edge of those truncated to the same microsecond
+    order = np.lexsort((times, gpios))
+    gpios, times, levels = gpios[order], times[order], levels[order]
+    ticks = np.minimum(np.floor(times + 1e-6), length).astype(np.int64)
+    keep = np.ones(len(ticks), dtype=bool)
+    keep[:-1] = (gpios[1:] != gpios[:-1]) | (ticks[1:] != ticks[:-1])
+    gpios, ticks, levels = gpios[keep], ticks[keep], levels[keep]
+
+    # Combine the GPIOs switching at the same microsecond into one pulse
+    bits = np.left_shift(1, gpios)
+    on_masks = np.where(levels == 1, bits, 0)
+    off_masks = np.where(levels == 0, bits, 0)
+    order = np.argsort(ticks, kind='mergesort')
+    ticks, on_masks, off_masks = ticks[order], on_masks[order], off_masks[order]
+    starts = np.flatnonzero(np.concatenate(([True], ticks[1:] != ticks[:-1])))
+    return edge_timeline(ticks[starts], np.bitwise_or.reduceat(on_masks, starts), np.bitwise_or.reduceat(off_masks, starts), length)
+
+
+class segment_store:
+
+    def __init__(self, max_entries=256):
+        """
+        Cache of compiled outputs keyed by their parameters.
+        Output edges are compiled without PPS offset and kept per output, so a change to one output only
+        recompiles that output. Merged timelines are kept per set of outputs, and an offset is applied by
+        rotating the merged timeline, so an offset-only change recompiles nothing.
+        """
+        self.max_entries = max_entries
+        self.edges = collections.OrderedDict()
+        self.timelines = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def timeline(self, cycle_time, offset, PPS_gpio, PPS_duty, triggers, seconds=1):
+        """
+        Returns the merged edge_timeline of seconds PPS periods, as compile_timeline() would for output_phases().
+        """
+        length = int(cycle_time * seconds)
+        outputs = output_phases(cycle_time, 0.0, PPS_gpio, PPS_duty, triggers)
+        key = (length, tuple(outputs))
+        base = self._get(self.timelines, key)
+        if base is not None:
+            base.pulses()
+        else:
+            edges = []
+            for output in outputs:
+                output_key = (output, cycle_time, seconds)
+                edge = self._get(self.edges, output_key)
+                if edge is None:
+                    edge = output_edges(output, 0.0, cycle_time * seconds)
+                    self._put(self.edges, output_key, edge)
+                edges.append(edge)
+            base = merge_edges(edges, length)
+            self._put(self.timelines, key, base)
+        return base.rotate(int(round(offset)))
+
+    def clear(self):
+        self.edges.clear()
+        self.timelines.clear()
+
+    def _get(self, cache, key):
+        value = cache.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def _put(self, cache, key, value):
+        cache[key] = value
+        while len(cache) > self.max_entries:
+            cache.popitem(last=False)
+
+
+def _edge_times(period, phase, start, span):
+    first = np.ceil((start - phase) / period)
+    last = np.ceil((start + span - phase) / period)
+    return phase + np.arange(first, last) * period - start
+
+
+class wave_chain_plan:
+
+    def __init__(self, length, waves, sequence, block_starts):
+        """
+        A compressed PPS period.
+        length is the period in whole microseconds, waves the pulse lists to create,
+        sequence the index into waves for every block and block_starts the block start times.
+        """
+        self.length = length
+        self.waves = waves
+        self.sequence = sequence
+        self.block_starts = block_starts
+        self.body, self.body_loops = encode_sequence(sequence)
+
+    def pulse_count(self):
+        """
+        Returns the number of pulses that have to be created in pigpiod.
+        """
+        return sum(len(pulses) for pulses in self.waves)
+
+    def timeline(self):
+        """
+        Returns the edge timeline of the period as transmitted by the chain.
+        """
+        events = {}
+        for start, index in zip(self.block_starts, self.sequence):
+            time = start
+            for pulse in self.waves[index]:
+                if pulse.gpio_on or pulse.gpio_off:
+                    on_mask, off_mask = events.get(time, (0, 0))
+                    events[time] = ((on_mask & ~pulse.gpio_off) | pulse.gpio_on, (off_mask & ~pulse.gpio_on) | pulse.gpio_off)
+                time += pulse.delay
+        times = sorted(events)
+        return edge_timeline(np.array(times, dtype=np.int64), np.array([events[time][0] for time in times], dtype=np.int64),
+                             np.array([events[time][1] for time in times], dtype=np.int64), self.length)
+
+    def start_block(self, position):
+        """
+        Returns (block index, delay) for starting the chain at the given position in the period:
+        the first block starting at or after the position and the delay until it starts.
+        """
+        position = position % self.length
+        index = bisect.bisect_left(self.block_starts, position)
+        if index == len(self.block_starts):
+            return 0, self.length - position
+        return index, self.block_starts[index] - position
+
+    def chain_data(self, wave_ids, position=0):
+        """
+        Returns the wave_chain() data transmitting the period forever, entering it at the given position.
+        The part of the period after the entry point is sent once before the repeating body,
+        so the chain keeps the phase of a wave started at position 0.
+        """
+        index, delay = self.start_block(position)
+        data = []
+        while delay > 0:
+            step = min(delay, MAX_CHAIN_DELAY)
+            data += [255, 2, step & 0xFF, step >> 8]
+            delay -= step
+        if index > 0:
+            data += encode_sequence(self.sequence[index:])[0]
+        data += [255, 0] + self.body + [255, 3]
+        return [wave_ids[-i - 1] if i < 0 else i for i in data]
+
+
+def encode_sequence(sequence):
+    """
+    Run length encodes a sequence of wave indices into wave chain entries.
+    Wave indices are encoded as -index - 1 so they can be told apart from command bytes
+    until chain_data() substitutes the wave ids.
+    Repeated runs and repeated groups of two or three runs become chain loops.
+    Returns the entries and the number of loop counters used.
+    """
+    tokens = []
+    for wave in sequence:
+        if tokens and tokens[-1][0] == wave:
+            tokens[-1] = (wave, tokens[-1][1] + 1)
+        else:
+            tokens.append((wave, 1))
+
+    data = []
+    loops = 0
+    i = 0
+    while i < len(tokens):
+        best_repeats, best_unit = 1, 1
+        for unit in (2, 3):
+            repeats = 1
+            while tokens[i + repeats * unit:i + (repeats + 1) * unit] == tokens[i:i + unit]:
+                repeats += 1
+            if repeats > 1 and repeats * unit > best_repeats * best_unit:
+                best_repeats, best_unit = repeats, unit
+        if best_unit > 1:
+            data.append(255)
+            data.append(0)
+            for wave, count in tokens[i:i + best_unit]:
+                loops += _encode_run(data, wave, count)
+            data += [255, 1, best_repeats & 0xFF, best_repeats >> 8]
+            loops += 1
+            i += best_repeats * best_unit
+        else:
+            loops += _encode_run(data, tokens[i][0], tokens[i][1])
+            i += 1
+    return data, loops
+
+
+def _encode_run(data, wave, count):
+    loops = 0
+    while count > 0:
+        run = min(count, 0xFFFF)
+        if run > LOOP_THRESHOLD:
+            data += [255, 0, -wave - 1, 255, 1, run & 0xFF, run >> 8]
+            loops += 1
+        else:
+            data += [-wave - 1] * run
+        count -= run
+    return loops
+
+
+def compile_chain(cycle_time, offset, PPS_gpio, PPS_duty, triggers, seconds=1):
+    """
+    Compiles one PPS period, or a hyperperiod of seconds PPS periods, into a wave_chain_plan.
+    triggers is a list of (gpio, frequency, phase, duty) with frequencies whose cycles over the
+    hyperperiod are whole.
+    Blocks of the common sub-period of the triggers are tried first, then sub-blocks shared across
+    the hyperperiod, taking those with the fewest pulses.
+    Raises ValueError when no split into repeated blocks fits a wave chain.
+    """
+    nearest = None
+    divisor = 0
+    for gpio, frequency, phase, duty in triggers:
+        divisor = _gcd(divisor, int(frequency * seconds))
+    for blocks_per_divisor in _divisors(divisor):
+        block_count = divisor // blocks_per_divisor
+        if block_count <= 1:
+            break
+        plan = _compile_blocks(cycle_time, offset, PPS_gpio, PPS_duty, triggers, block_count, seconds)
+        if plan is not None:
+            if chain_usage(plan) <= 1.0:
+                return plan
+            nearest = _nearest(nearest, plan)
+
+    best = None
+    outputs = output_phases(cycle_time, offset, PPS_gpio, PPS_duty, triggers)
+    for block_count in _sub_block_counts(cycle_time, PPS_gpio, triggers, seconds):
+        plan = _compile_sub_blocks(outputs, int(cycle_time * seconds), block_count)
+        if plan is None:
+            continue
+        if chain_usage(plan) > 1.0:
+            nearest = _nearest(nearest, plan)
+        elif best is None or plan.pulse_count() < best.pulse_count():
+            best = plan
+    if best is not None:
+        return best
+
+    period = 'the PPS period' if seconds == 1 else 'the %d s hyperperiod' % seconds
+    if nearest is None:
+        raise ValueError('every split of %s into blocks takes more than %d waves or %d pulses for a wave chain' % (period, 2 * MAX_CHAIN_WAVES, 2 * MAX_CHAIN_PULSES))
+    body = len(nearest.body) + 4
+    raise ValueError('no split of %s into repeated blocks fits a wave chain: the closest takes %d waves (of %d), %d pulses (of %d), '
+                     '%d chain bytes (of %d) and %d loops (of %d)' % (period, len(nearest.waves), MAX_CHAIN_WAVES, nearest.pulse_count(), MAX_CHAIN_PULSES,
+                                                                   body, MAX_CHAIN_BYTES // 2, nearest.body_loops + 1, MAX_CHAIN_LOOPS // 2))
+
+
+def chain_usage(plan):
+    """
+    Returns the largest share of a pigpiod chain resource a wave_chain_plan takes: block waves, pulses,
+    chain bytes and loop counters, of which the repeating body may take half as the entry takes the rest.
+    The plan fits a wave chain up to 1.0.
+    """
+    return max(len(plan.waves) / float(MAX_CHAIN_WAVES), plan.pulse_count() / float(MAX_CHAIN_PULSES),
+               (len(plan.body) + 4) / float(MAX_CHAIN_BYTES // 2), (plan.body_loops + 1) / float(MAX_CHAIN_LOOPS // 2))
+
+
+def _nearest(nearest, plan):
+    if nearest is None or chain_usage(plan) < chain_usage(nearest):
+        return plan
+    return nearest
+
+
+def _compile_blocks(cycle_time, offset, PPS_gpio, PPS_duty, triggers, block_count, seconds=1):
+    length = int(cycle_time * seconds)
+    block_time = cycle_time * seconds / block_count
+    short_length = int(block_time)
+    long_count = length - block_count * short_length
+
+    layout = _block_layout(block_count, long_count)
+    block_starts = []
+    start = 0
+    for j, long_block in enumerate(layout):
+        if abs(start - j * block_time) > MAX_BLOCK_ERROR:
+            return None
+        block_starts.append(start)
+        start += short_length + long_block
+
+    trigger_outputs = output_phases(cycle_time, offset, -1, 0, triggers)
+    trigger_events = [compile_timeline(trigger_outputs, short_length, span=block_time).events()]
+    if long_count:
+        trigger_events.append(compile_timeline(trigger_outputs, short_length + 1, span=block_time).events())
+
+    # Every block also sets the PPS output level at its start, so the chain can be entered at any block
+    block_edges = [[] for j in block_starts]
+    if PPS_gpio != -1:
+        on_time = PPS_duty * cycle_time
+        rising = (cycle_time - offset) % cycle_time
+        for j, start in enumerate(block_starts):
+            block_edges[j].append((0, 1 if (start - rising) % cycle_time < on_time else 0))
+        if 0 < on_time < cycle_time:
+            for second in range(seconds):
+                for edge, level in ((rising, 1), ((rising + on_time) % cycle_time, 0)):
+                    edge = min(edge + second * cycle_time, length - 1)
+                    j = bisect.bisect_right(block_starts, int(edge)) - 1
+                    block_edges[j].append((int(edge) - block_starts[j], level))
+
+    waves = []
+    wave_index = {}
+    sequence = []
+    pulse_count = 0
+    for j, long_block in enumerate(layout):
+        key = (long_block, tuple(block_edges[j]))
+        if key not in wave_index:
+            events = dict(trigger_events[long_block])
+            for edge, level in block_edges[j]:
+                on_mask, off_mask = events.get(edge, (0, 0))
+                if level:
+                    events[edge] = (on_mask | 1 << PPS_gpio, off_mask & ~(1 << PPS_gpio))
+                else:
+                    events[edge] = (on_mask & ~(1 << PPS_gpio), off_mask | 1 << PPS_gpio)
+            pulse_count += len(events)
+            if len(waves) >= 2 * MAX_CHAIN_WAVES or pulse_count > 2 * MAX_CHAIN_PULSES:
+                return None
+            wave_index[key] = len(waves)
+            waves.append(_events_to_pulses(events, short_length + long_block))
+        sequence.append(wave_index[key])
+
+    return wave_chain_plan(length, waves, sequence, block_starts)
+
+
+def _sub_block_counts(cycle_time, PPS_gpio, triggers, seconds):
+    # Sub-block counts putting a whole number of cycles of one output in every sub-block
+    cycles = [int(frequency * seconds) for gpio, frequency, phase, duty in triggers]
+    if PPS_gpio != -1:
+        cycles.append(seconds)
+    limit = min(MAX_SUB_BLOCKS, int(cycle_time * seconds) // MIN_SUB_BLOCK)
+    return sorted(set(count for cycle_count in cycles for count in _divisors(cycle_count) if 1 < count <= limit))
+
+
+def _compile_sub_blocks(outputs, length, block_count):
+    """
+    Cuts the outputs of a period of the given length into block_count sub-blocks of whole microseconds
+    and creates one wave per distinct sub-block, which sets the levels of all outputs at its start like
+    the blocks of _compile_blocks(), so the chain can be entered at any sub-block.
+    A sub-block is told apart by the microsecond of the next rising edge of every output after its start,
+    from which its edges are compiled, so the period is never unrolled and the edges are off by at most
+    a microsecond. outputs is a list of (gpio, period, rising, on_time) as returned by output_phases.
+    Returns None if the sub-blocks take far more waves or pulses than a chain can hold.
+    """
+    starts = np.arange(block_count + 1, dtype=np.int64) * length // block_count
+    sizes = np.diff(starts)
+    keys = [sizes]
+    for gpio, period, rising, on_time in outputs:
+        keys.append(np.floor((rising - starts[:-1]) % period + 1e-6).astype(np.int64))
+    distinct, first, sequence = np.unique(np.stack(keys, axis=1), axis=0, return_index=True, return_inverse=True)
+    if len(distinct) > 2 * MAX_CHAIN_WAVES:
+        return None
+    pulse_count = sum(len(distinct) * (2 * int(np.max(sizes) / period) + 3) for gpio, period, rising, on_time in outputs)
+    if pulse_count > 2 * MAX_CHAIN_PULSES:
+        return None
+
+    # The waves are created in the order their sub-blocks first appear
+    order = np.argsort(first, kind='mergesort')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    waves = []
+    for key in distinct[order].tolist():
+        size = key[0]
+        block_outputs = [(gpio, period, phase, on_time) for (gpio, period, rising, on_time), phase in zip(outputs, key[1:])]
+        timeline = compile_timeline(block_outputs, size)
+        waves.append(_events_to_pulses(timeline.events(), size))
+    return wave_chain_plan(length, waves, rank[np.ravel(sequence)].tolist(), starts[:-1].tolist())
+
+
+def _block_layout(block_count, long_count):
+    """
+    Spreads long_count one microsecond longer blocks over block_count blocks in a regular pattern
+    (groups of q - 1 or q common blocks followed by one rare block) so that the chain compresses.
+    """
+    if long_count == 0:
+        return [0] * block_count
+    rare = 1 if long_count * 2 <= block_count else 0
+    rare_count = long_count if rare else block_count - long_count
+    group, remainder = divmod(block_count, rare_count)
+    layout = []
+    for i in range(rare_count - remainder):
+        layout += [1 - rare] * (group - 1) + [rare]
+    for i in range(remainder):
+        layout += [1 - rare] * group + [rare]
+    return layout
+
+
+def _events_to_pulses(events, length):
+    offsets = sorted(events)
+    pulses = []
+    for i, offset in enumerate(offsets):
+        end = offsets[i + 1] if i + 1 < len(offsets) else length
+        on_mask, off_mask = events[offset]
+        pulses.append(pigpio.pulse(on_mask, off_mask, end - offset))
+    return pulses
+
+
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+
+def _divisors(n):
+    small = []
+    large = []
+    i = 1
+    while i * i <= n:
+        if n % i == 0:
+            small.append(i)
+            if i * i != n:
+                large.append(n // i)
+        i += 1
+    return small + large[::-1]
@@ -0,0 +1,82 @@
+import os
+import time
+import unittest
+
+import cluster
+import pigpio_sim
+import pps_servo
+import sync_generator
+
+PORT = 19000 + os.getpid() % 1000
+NODE_GPIOS = [3, 4]
+
+
+def simulated_node(seed):
+    # An engine locking its output PPS to a drifting input PPS, as the engine of a follower Pi
+    pi = pigpio_sim.simulated_pi()
+    pi.add_PPS_source(27, first_edge=300000, drift_ppm=20.0, jitter=2.0, seed=seed)
+    generator = sync_generator.waveform_engine(pi)
+    generator.set_PPS_input_gpio(27)
+    generator.set_PPS_output_gpio(2)
+    generator.set_PPS_servo(pps_servo.pps_servo())
+    generator.start_PPS_input_sychronization()
+    generator.update()
+    return pi, generator
+
+
+class cluster_test(unittest.TestCase):
+
+    def setUp(self):
+        # One coordinator and two followers on loopback, each follower offering two GPIOs
+        self.nodes = dict((name, simulated_node(seed)) for seed, name in enumerate(('a', 'b')))
+        triggers = [('camera%d' % i, 10, None, 0.5) for i in range(5)]
+        self.coordinator = cluster.cluster_coordinator('a', triggers, port=PORT, interface='127.0.0.1', publish_interval=0.1, node_timeout=1.0, lead=0)
+        self.followers = [cluster.cluster_follower(generator, name, NODE_GPIOS, port=PORT, interface='127.0.0.1', report_interval=0.1)
+                          for name, (pi, generator) in sorted(self.nodes.items())]
+        self.coordinator.start()
+        for follower in self.followers:
+            follower.start()
+
+    def tearDown(self):
+        for follower in self.followers:
+            follower.stop()
+        self.coordinator.stop()
+        for pi, generator in self.nodes.values():
+            generator.cancel()
+
+    def run_nodes(self, done, timeout=20.0):
+        # Runs the simulated Pis half a second per 50 ms until done() or the timeout
+        end = time.time() + timeout
+        while time.time() < end:
+            for pi, generator in self.nodes.values():
+                pi.advance(500000)
+                generator.housekeeping()
+            if done():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def applied(self):
+        status = self.coordinator.status()
+        return (not status['rolling'] and all(node['state'] == pps_servo.LOCKED and node['revision'] == node['planned_revision'] is not None
+                                               for node in status['nodes'].values()) and len(status['nodes']) == 2)
+
+    def test_spread_and_capacity(self):
+        self.assertTrue(self.run_nodes(self.applied))
+        status = self.coordinator.status()
+        # Two GPIOs on each of two nodes hold four of the five triggers, whose phases are spread across the nodes
+        triggers = [trigger for pi, generator in self.nodes.values() for trigger in generator.triggers()]
+        self.assertEqual(len(status['unplaced']), 1)
+        self.assertEqual(len(triggers), 4)
+        for pi, generator in self.nodes.values():
+            self.assertEqual(sorted(trigger[0] for trigger in generator.triggers()), NODE_GPIOS)
+        phases = sorted(trigger[2] for trigger in triggers)
+        spread = [round(360.0 * i / 5, 3) for i in range(5)]
+        self.assertEqual(len(set(phases)), 4)
+        self.assertTrue(set(phases) <= set(spread))
+        # Both nodes lock to PPS inputs of the same seconds, so their outputs are within a few microseconds
+        self.assertLess(status['phase_spread'], 20.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,19 @@
+import unittest
+
+import benchmark
+
+
+class cold_start_test(unittest.TestCase):
+
+    def test_precompiled(self):
+        # The wave compiled by the resource check is taken over, so nothing is compiled again before the first edge
+        cold = benchmark.benchmark_cold_start(precompiled=False)
+        warm = benchmark.benchmark_cold_start(precompiled=True)
+        self.assertGreater(cold['compiled_segments'], 0)
+        self.assertEqual(warm['compiled_segments'], 0)
+        self.assertEqual(warm['first_edge_round_trips'], cold['first_edge_round_trips'])
+        self.assertIsNotNone(warm['lock_ticks'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import control_server
+import pigpio_sim
+import sync_generator
+
+
+def running_engine(max_pulses=12000):
+    # An engine with the output PPS and a 10 Hz trigger running, without input so changes wait for housekeeping()
+    pi = pigpio_sim.simulated_pi(max_pulses=max_pulses)
+    generator = sync_generator.waveform_engine(pi)
+    generator.set_PPS_output_gpio(2)
+    generator.add_trigger_gpio(3, 10, 0, 0.5)
+    generator.update()
+    return generator
+
+
+class rollback_test(unittest.TestCase):
+
+    def check_rollback(self, generator, gpio, frequency):
+        # The failed change and the one applied with it are both reported the error and undone
+        errors = []
+        generator.schedule_change(lambda: generator.add_trigger_gpio(gpio, frequency, 45, 0.5), errors.append)
+        generator.schedule_change(lambda: generator.update_trigger_gpio_phase(3, 90), errors.append)
+        generator.housekeeping()
+        self.assertEqual(len(errors), 2)
+        self.assertIsNotNone(errors[0])
+        self.assertIs(errors[1], errors[0])
+        self.assertEqual(generator.triggers(), [(3, 10, 0, 0.5)])
+        self.assertFalse(generator.is_dirty())
+        generator.cancel()
+
+    def test_wave_too_large(self):
+        # Refused by the engine before sending, as ValueError
+        self.check_rollback(running_engine(), 4, '30000/1001')
+
+    def test_pigpio_error(self):
+        # Refused by pigpiod, as pigpio.error
+        self.check_rollback(running_engine(max_pulses=30), 4, 10)
+
+
+class control_plan_test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'control.sock')
+        self.generator = running_engine()
+        self.server = control_server.control_server(self.generator, path=self.path, apply_timeout=1.0)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.generator.cancel()
+        shutil.rmtree(self.directory)
+
+    def test_refused_by_planner(self):
+        # A trigger that does not fit is refused without being queued
+        with self.assertRaises(ValueError) as context:
+            control_server.send_command('add_trigger', path=self.path, gpio=4, frequency='30000/1001')
+        self.assertIn('does not fit', str(context.exception))
+        with self.assertRaises(ValueError):
+            control_server.send_command('update_trigger', path=self.path, gpio=3, frequency='30000/1001')
+        self.assertFalse(self.generator.pending_changes)
+        self.assertEqual(self.generator.triggers(), [(3, 10, 0, 0.5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+import benchmark
+import pigpio_sim
+import sync_generator
+
+
+class handover_test(unittest.TestCase):
+
+    def test_late_edge_skipped(self):
+        # An output edge from before the switchover, reaching the callback late, neither confirms nor restarts it
+        pi = pigpio_sim.simulated_pi()
+        generator = sync_generator.waveform_engine(pi)
+        generator.set_PPS_output_gpio(2)
+        generator.add_trigger_gpio(3, 10, 0, 0.5)
+        generator.update()
+        pi.advance(1500000)
+        generator.update_trigger_gpio_phase(3, 90)
+        generator.update()
+        self.assertIsNotNone(generator.handover_tick)
+        generator.handover_edge((generator.handover_tick - 250) & 0xFFFFFFFF)
+        self.assertIsNotNone(generator.handover_tick)
+        self.assertEqual(generator.handover_timeouts, 0)
+        pi.advance(2000000)
+        self.assertIsNone(generator.handover_tick)
+        self.assertEqual(generator.handover_timeouts, 0)
+        generator.cancel()
+
+    def test_no_timeouts_with_pwm_restarts(self):
+        # PWM restarts cancel and resend the wave while synchronized, each confirmed without a forced restart
+        result = benchmark.benchmark_hardware_outputs(1500, True, pwm_restart_interval=0)
+        self.assertIsNone(result['error'])
+        self.assertGreater(result['pwm_restarts'], 0)
+        self.assertEqual(result['switch_timeouts'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+
+import benchmark
+import hardware_outputs
+import pps_servo
+
+
+class hardware_outputs_test(unittest.TestCase):
+
+    def test_pwm_withheld_when_the_wave_holds_it(self):
+        # Synchronized, PWM pins go back into the wave, which holds three 1500 Hz triggers
+        result = benchmark.benchmark_hardware_outputs(1500, True)
+        self.assertIsNone(result['error'])
+        self.assertEqual(result['synchronized_paths']['12'], hardware_outputs.WAVE)
+        self.assertEqual(result['lock'], pps_servo.LOCKED)
+
+    def test_pwm_kept_when_the_wave_cannot_hold_it(self):
+        # Three 5 kHz triggers take more pulses than a wave holds, so synchronizing keeps them on PWM and locks
+        result = benchmark.benchmark_hardware_outputs(5000, True)
+        self.assertIsNone(result['error'])
+        self.assertEqual(result['synchronized_paths']['12'], hardware_outputs.PWM)
+        self.assertEqual(result['synchronized_paths']['4'], hardware_outputs.CLOCK)
+        self.assertEqual(result['lock'], pps_servo.LOCKED)
+        self.assertGreater(result['pwm_restarts'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+
+import numpy as np
+
+import holdover
+import pigpio_sim
+import sync_generator
+
+
+def simulated_holdover(seed, track_seconds, outage_seconds, jitter=2.0):
+    # Returns the measured and estimated errors of a holdover over an outage of the simulated input
+    pi = pigpio_sim.simulated_pi()
+    source = pi.add_PPS_source(27, first_edge=pi.now + 300000, drift_ppm=13.37, jitter=jitter, seed=seed)
+    source.add_outage(pi.now + track_seconds * 1000000, pi.now + (track_seconds + outage_seconds) * 1000000)
+    generator = sync_generator.waveform_engine(pi)
+    generator.set_PPS_input_gpio(27)
+    generator.set_PPS_output_gpio(2)
+    generator.add_trigger_gpio(3, 10, 0, 0.5)
+    generator.start_PPS_input_sychronization()
+    generator.update()
+    pi.advance((track_seconds + outage_seconds + 3) * 1000000)
+    state, periods, estimated_error, measured_error = generator.holdover_status()
+    generator.cancel()
+    return measured_error, estimated_error
+
+
+class holdover_error_test(unittest.TestCase):
+
+    def test_error_bound_matches_simulated_outages(self):
+        results = [simulated_holdover(seed, 300, 120) for seed in range(1, 9)]
+        for measured, estimated in results:
+            self.assertIsNotNone(measured)
+            self.assertLessEqual(abs(measured), 3 * estimated)
+        # The bound is a one sigma estimate, not a blanket margin
+        self.assertLess(max(estimated for measured, estimated in results), 3.0)
+        rms = np.sqrt(np.mean([measured * measured for measured, estimated in results]))
+        self.assertLess(rms, 2 * np.mean([estimated for measured, estimated in results]))
+
+    def test_drift_fitted_only_when_resolved(self):
+        for rate, edges in ((0.0, 7200), (2.0, 7200), (2.0, 600), (0.0, 200)):
+            random = np.random.RandomState(1)
+            curvature = rate / 3600.0 / 2.0      # Microseconds per period squared for a drift in ppm per hour
+            indices = np.arange(edges + 600)
+            ticks = 1000013.37 * indices + curvature * indices * indices + random.normal(0.0, 2.0, len(indices))
+            model = holdover.holdover_model()
+            for tick in ticks[:edges]:
+                model.add_edge(int(round(tick)) & 0xFFFFFFFF)
+            model.start(int(round(ticks[edges - 1])) & 0xFFFFFFFF)
+            if edges >= model.drift_span:
+                self.assertAlmostEqual(model.drift_rate(), rate, delta=0.1 * rate + 0.2)
+            else:
+                self.assertEqual(model.drift_rate(), 0.0)
+            edge, period = model.predict_edge(int(round(ticks[edges + 59])) & 0xFFFFFFFF)
+            error = (int(round(ticks[edges + 59])) - edge + (1 << 31)) % (1 << 32) - (1 << 31)
+            self.assertLessEqual(abs(error), 3 * model.estimated_error + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
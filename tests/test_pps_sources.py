@@ -0,0 +1,46 @@
+import unittest
+
+import numpy as np
+
+import pigpio_sim
+import pps_servo
+import sync_generator
+
+OUTAGE = 40000000
+DRIFT_PPM = 20.0
+
+
+class failover_test(unittest.TestCase):
+
+    def test_hitless_failover(self):
+        # The primary input is lost after 40 s, and the backup 150 us later takes over without an output phase step
+        pi = pigpio_sim.simulated_pi(record_edges=True)
+        primary = pi.add_PPS_source(27, first_edge=300000, drift_ppm=DRIFT_PPM, jitter=1.0, seed=1)
+        pi.add_PPS_source(17, first_edge=300150, drift_ppm=DRIFT_PPM, jitter=1.0, seed=2)
+        primary.add_outage(OUTAGE, OUTAGE + 100000000)
+        generator = sync_generator.waveform_engine(pi)
+        generator.set_PPS_sources([27, 17])
+        generator.set_PPS_output_gpio(2)
+        generator.set_PPS_servo(pps_servo.pps_servo())
+        generator.start_PPS_input_sychronization()
+        generator.update()
+        states = []
+        for second in range(80):
+            pi.advance(1000000)
+            states.append(generator.lock_state())
+        generator.cancel()
+
+        self.assertEqual(generator.PPS_sources.status()['active'], 17)
+        self.assertEqual(generator.PPS_sources.switches, 1)
+        locked = states.index(pps_servo.LOCKED)
+        self.assertLess(locked, 35)
+        self.assertEqual(states[locked:], [pps_servo.LOCKED] * (len(states) - locked))
+        # The output PPS period stays within the slew of the carried offset through the switch
+        rising = np.array([tick for tick, gpio, level in pi.edges if gpio == 2 and level == 1])
+        intervals = np.diff(rising)[rising[1:] > 35000000]
+        self.assertGreater(len(intervals), 40)
+        self.assertLessEqual(np.max(np.abs(intervals - 1000000 * (1 + DRIFT_PPM * 1e-6))), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import pigpio_sim
+import pps_servo
+import replay
+import sync_generator
+
+FIRST_EDGE = 1000000
+
+
+def recording_servo(corrections):
+    # Patches the servo class to list the tick and the returned action of every output edge
+    output_edge = pps_servo.pps_servo.output_edge
+
+    def recorded(servo, tick):
+        result = output_edge(servo, tick)
+        corrections.append((tick, result))
+        return result
+    return mock.patch.object(pps_servo.pps_servo, 'output_edge', recorded)
+
+
+def live_run(filename, seconds=60):
+    # Runs the servo against a simulated input as replay_engine() runs it against a recording, and records the input
+    pi = pigpio_sim.simulated_pi()
+    pi.add_PPS_source(replay.PPS_INPUT_GPIO, first_edge=FIRST_EDGE, drift_ppm=20.0, jitter=2.0, seed=5)
+    recorder = replay.tick_recorder(pi, replay.PPS_INPUT_GPIO, filename)
+    recorder.start()
+    generator = sync_generator.waveform_engine(pi)
+    generator.set_PPS_input_gpio(replay.PPS_INPUT_GPIO)
+    generator.set_PPS_output_gpio(replay.PPS_OUTPUT_GPIO)
+    generator.holdover_enabled = False
+    generator.set_PPS_servo(pps_servo.pps_servo(kp=0.3, ki=0.05))
+    generator.start_PPS_input_sychronization()
+    # The source jitters the first edge, which replay_engine() takes as the start of the recording
+    pi.run_until(FIRST_EDGE + 100000)
+    with open(filename) as recording:
+        first = int(recording.readline())
+    pi.run_until(first + replay.FIRST_OUTPUT)
+    generator.update()
+    pi.advance(seconds * 1000000)
+    state = generator.lock_state()
+    recorder.stop()
+    generator.cancel()
+    return first, state
+
+
+class replay_test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_servo_replay(self):
+        # The replay runs the same input edges, moved to start a second into the simulation, so every servo
+        # correction must repeat at the moved tick
+        filename = os.path.join(self.directory, 'ticks.txt')
+        live = []
+        with recording_servo(live):
+            first, state = live_run(filename)
+        replayed = []
+        with recording_servo(replayed):
+            result = replay.replay_engine(replay.load_ticks(filename), kp=0.3, ki=0.05)
+        ticks = replay.load_ticks(filename)
+        self.assertEqual(state, pps_servo.LOCKED)
+        self.assertGreater(result['edges'], 50)
+        self.assertFalse(result['unlocked_edges'])
+        # The live input goes on after the recording stops, so only the edges up to the last recorded input compare
+        shift = 1000000 - first
+        end = ticks[-1] + 1000000 + 500000
+        live = [(tick + shift, action) for tick, action in live if tick + shift <= end]
+        replayed = [correction for correction in replayed if correction[0] <= end]
+        self.assertGreater(len(live), 50)
+        self.assertEqual(replayed, live)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+
+import pigpio_sim
+import pps_servo
+import sync_generator
+
+TICK_WRAP = 1 << 32
+
+
+def simulated_lock(start_tick, chaining, servo, seconds=60):
+    # Returns the output edges from the start, the rebuild count, the lock state and whether a chain ran
+    pi = pigpio_sim.simulated_pi(start_tick=start_tick, record_edges=True)
+    pi.add_PPS_source(27, first_edge=start_tick + 300000, drift_ppm=20.0, jitter=2.0, seed=3)
+    generator = sync_generator.waveform_engine(pi)
+    generator.set_wave_chaining(chaining)
+    generator.set_PPS_input_gpio(27)
+    generator.set_PPS_output_gpio(2)
+    for gpio in (3, 4, 5):
+        generator.add_trigger_gpio(gpio, 10, 0, 0.5)
+    if servo:
+        generator.set_PPS_servo(pps_servo.pps_servo())
+    generator.start_PPS_input_sychronization()
+    generator.update()
+    pi.advance(seconds * 1000000)
+    edges = [(tick - start_tick, gpio, level) for tick, gpio, level in pi.edges if gpio != 27]
+    result = (edges, generator.rebuild_count, generator.lock_state(), bool(generator.chain_waves))
+    generator.cancel()
+    return result
+
+
+class tick_wrap_test(unittest.TestCase):
+
+    def check_lock(self, chaining, servo):
+        # The tick wraps half way through the run, which must not change a single output edge
+        wrapped = simulated_lock(TICK_WRAP - 30 * 1000000, chaining, servo)
+        unwrapped = simulated_lock(1000000, chaining, servo)
+        edges, rebuilds, state, chained = wrapped
+        self.assertEqual(state, pps_servo.LOCKED)
+        self.assertEqual(chained, chaining)
+        self.assertEqual(rebuilds, unwrapped[1])
+        self.assertEqual(edges, unwrapped[0])
+
+    def test_step_lock(self):
+        self.check_lock(False, False)
+
+    def test_servo_lock(self):
+        self.check_lock(False, True)
+
+    def test_chain_lock(self):
+        self.check_lock(True, True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import fractions
+import unittest
+
+import numpy as np
+
+import pigpio_sim
+import sync_generator
+import wave_compiler
+
+
+def transitions(timeline, gpio):
+    # Returns the rising and falling edge times of a GPIO from its levels, as every block of a chain sets all levels
+    levels = (timeline.states() >> gpio) & 1
+    previous = np.roll(levels, 1)
+    return timeline.times[(levels == 1) & (previous == 0)], timeline.times[(levels == 0) & (previous == 1)]
+
+
+class compile_chain_test(unittest.TestCase):
+
+    def check_round_trip(self, cycle_time, offset, PPS_gpio, PPS_duty, triggers, seconds=1):
+        # The chain must transmit the edges of the flat wave, up to the block start error
+        plan = wave_compiler.compile_chain(cycle_time, offset, PPS_gpio, PPS_duty, triggers, seconds)
+        length = int(cycle_time * seconds)
+        flat = wave_compiler.compile_timeline(wave_compiler.output_phases(cycle_time, offset, PPS_gpio, PPS_duty, triggers), length)
+        chained = plan.timeline()
+        self.assertEqual(plan.length, length)
+        self.assertLessEqual(wave_compiler.chain_usage(plan), 1.0)
+        gpios = [gpio for gpio, frequency, phase, duty in triggers]
+        if PPS_gpio != -1:
+            gpios.append(PPS_gpio)
+        for gpio in gpios:
+            for expected, transmitted in zip(transitions(flat, gpio), transitions(chained, gpio)):
+                self.assertGreater(len(expected), 0)
+                self.assertEqual(len(transmitted), len(expected))
+                self.assertLessEqual(np.max(np.abs(transmitted - expected)), wave_compiler.MAX_BLOCK_ERROR)
+        return plan
+
+    def test_whole_frequencies(self):
+        self.check_round_trip(1000000.0, 0.0, 2, 0.1, [(3, 10, 0, 0.5), (4, 100, 90, 0.25)])
+
+    def test_offset(self):
+        self.check_round_trip(1000020.0, 37.5, 2, 0.1, [(3, 10, 0, 0.5), (4, 100, 90, 0.25)])
+
+    def test_hyperperiod(self):
+        triggers = [(3, fractions.Fraction(15, 2), 0, 0.5), (4, 10, 45, 0.5)]
+        self.check_round_trip(999980.3, 120.7, 2, 0.2, triggers, wave_compiler.hyperperiod(triggers))
+
+    def test_sub_blocks(self):
+        # Half a Hertz has no common sub-period with 1 kHz within the hyperperiod, so sub-blocks are shared
+        triggers = [(3, fractions.Fraction(1, 2), 30, 0.5), (4, 1000, 0, 0.3)]
+        plan = self.check_round_trip(1000003.7, 250.2, -1, 0.1, triggers, wave_compiler.hyperperiod(triggers))
+        self.assertLess(plan.pulse_count(), wave_compiler.MAX_CHAIN_PULSES)
+
+    def test_rational_alone(self):
+        # 30000/1001 Hz repeats every 3 cycles, so its 1001 s hyperperiod loops a few sub-blocks
+        triggers = [(3, fractions.Fraction(30000, 1001), 0, 0.5)]
+        plan = self.check_round_trip(1000020.0, 0.0, -1, 0.1, triggers, wave_compiler.hyperperiod(triggers))
+        self.assertLessEqual(len(plan.waves), 4)
+
+    def test_no_fit(self):
+        # 29.97 Hz repeats after 1001 seconds with a different phase against the PPS in every period
+        with self.assertRaises(ValueError):
+            wave_compiler.compile_chain(1000000.0, 0.0, 2, 0.1, [(3, fractions.Fraction(30000, 1001), 0, 0.5)], 1001)
+
+
+class wave_limit_test(unittest.TestCase):
+
+    def check_refused(self, chaining):
+        # 30000/1001 Hz against the output PPS fits neither a chain nor a wave, which must keep the running wave
+        pi = pigpio_sim.simulated_pi()
+        generator = sync_generator.waveform_engine(pi)
+        generator.set_wave_chaining(chaining)
+        generator.set_PPS_output_gpio(2)
+        generator.add_trigger_gpio(4, 10, 0, 0.5)
+        generator.update()
+        wave, chain_waves = generator.wave, list(generator.chain_waves)
+        generator.add_trigger_gpio(3, '30000/1001', 0, 0.5)
+        with self.assertRaises(ValueError):
+            generator.update()
+        self.assertEqual(generator.wave, wave)
+        self.assertEqual(generator.chain_waves, chain_waves)
+        generator.cancel()
+
+    def test_wave_refused(self):
+        self.check_refused(False)
+
+    def test_chain_refused(self):
+        self.check_refused(True)
+
+
+if __name__ == '__main__':
+    unittest.main()